@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://bitten.edgewall.org/wiki/License.
+
+"""Compare the implementations of `bitten.build.api.CommandLine.execute()`
+that wait for the pipes of the command with ``poll()``/``select()``, and that
+read them in separate threads.
+
+Commands producing a lot of output on both streams are executed, as well as
+many short commands, and the elapsed and CPU time of the build slave process
+are measured. The output collected by both implementations is checked to be
+identical.
+
+Usage: python benchmarks/commandline.py [number of lines] [number of commands]
+"""
+
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bitten.build import api
+
+OUTPUT_SCRIPT = """
+import sys
+for idx in range(%d):
+    sys.stdout.write('Compiling module %%d of the benchmark\\n' %% idx)
+    if not idx %% 10:
+        sys.stderr.write('warning: module %%d is deprecated\\n' %% idx)
+"""
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(read_pipes, commands):
+    api._read_pipes = read_pipes
+    output = []
+    start, start_cpu = time.time(), cpu_time()
+    for args in commands:
+        cmdline = api.CommandLine(sys.executable, args)
+        output.extend(cmdline.execute(timeout=600))
+    return time.time() - start, cpu_time() - start_cpu, output
+
+
+def main(args):
+    lines = len(args) > 0 and int(args[0]) or 500000
+    count = len(args) > 1 and int(args[1]) or 200
+    scenarios = [
+        ('%d lines of output' % lines, [['-c', OUTPUT_SCRIPT % lines]]),
+        ('%d short commands' % count, [['-c', 'print "Done"']] * count),
+    ]
+    for title, commands in scenarios:
+        thread_time, thread_cpu, thread_out = \
+                measure(api._read_pipes_threaded, commands)
+        select_time, select_cpu, select_out = \
+                measure(api._read_pipes_select, commands)
+        assert sorted(thread_out) == sorted(select_out), 'Output differs'
+        print '%-24s threads %6.2f s (%6.2f s CPU), select %6.2f s ' \
+              '(%6.2f s CPU)' % (title, thread_time, thread_cpu, select_time,
+                                 select_cpu)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
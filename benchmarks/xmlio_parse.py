@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://bitten.edgewall.org/wiki/License.
+
+"""Compare the parser backends of `bitten.util.xmlio`.
+
+A JUnit-style test result file is generated and parsed with every available
+backend, using both `xmlio.parse()` and `xmlio.iterparse()`, each in a
+separate process so that the peak memory usage can be measured. The elements
+are traversed the way the report commands do.
+
+Usage: python benchmarks/xmlio_parse.py [number of test cases]
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bitten.util import xmlio
+
+
+def generate(filename, count):
+    fileobj = open(filename, 'w')
+    try:
+        fileobj.write('<testsuite name="benchmark" tests="%d">\n' % count)
+        for idx in range(count):
+            fileobj.write('  <testcase classname="org.example.Test%d" '
+                          'name="test%d" time="0.%03d">\n' % (idx % 100, idx,
+                                                              idx % 1000))
+            if idx % 10 == 0:
+                fileobj.write('    <failure type="AssertionError">'
+                              'expected:&lt;1&gt; but was:&lt;2&gt;'
+                              '</failure>\n')
+            fileobj.write('    <system-out>Output of test %d</system-out>\n'
+                          '  </testcase>\n' % idx)
+        fileobj.write('</testsuite>\n')
+    finally:
+        fileobj.close()
+
+
+def run(backend, func, filename):
+    start = time.time()
+    fileobj = open(filename, 'rb')
+    try:
+        if func == 'iterparse':
+            testcases = xmlio.iterparse(fileobj, 'testcase', backend=backend)
+        else:
+            testcases = xmlio.parse(fileobj, backend=backend) \
+                             .children('testcase')
+        tests = 0
+        for testcase in testcases:
+            test = dict(testcase.attr.items())
+            for child in testcase.children():
+                test[child.name] = child.gettext()
+            tests += 1
+    finally:
+        fileobj.close()
+    elapsed = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%-8s %-9s %8d tests %8.2f s %10d KB peak RSS' % (backend, func,
+                                                            tests, elapsed,
+                                                            maxrss)
+
+
+def main(args):
+    if len(args) == 4 and args[0] == '--run':
+        run(args[1], args[2], args[3])
+        return
+    count = args and int(args[0]) or 100000
+    fd, filename = tempfile.mkstemp(suffix='.xml')
+    os.close(fd)
+    try:
+        generate(filename, count)
+        print 'Parsing %s (%d KB)' % (filename,
+                                      os.path.getsize(filename) / 1024)
+        for backend in xmlio.BACKENDS:
+            for func in ('parse', 'iterparse'):
+                subprocess.call([sys.executable, __file__, '--run', backend,
+                                 func, filename])
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://bitten.edgewall.org/wiki/License.
+
+"""Compare the serialization of `bitten.util.xmlio.Element` trees with the
+previous implementation, which wrote every piece of markup to the output
+stream separately.
+
+A step result with the given number of test results is built the way the
+report commands do and serialized with both writers. The output of both is
+checked to be identical.
+
+Usage: python benchmarks/xmlio_write.py [number of tests]
+"""
+
+import os
+from StringIO import StringIO
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bitten.util import xmlio
+
+
+def legacy_write(node, out, newlines=False):
+    """The serializer of `Element.write()` and `Fragment.write()` before the
+    output was collected in a buffer."""
+    if isinstance(node, xmlio.Element):
+        out.write('<')
+        out.write(xmlio._to_utf8(node.name))
+        for name, value in node.attr.items():
+            out.write(xmlio._to_utf8(' %s="%s"' % (name,
+                                                   xmlio._escape_attr(value))))
+        if node.children:
+            out.write('>')
+            for child in node.children:
+                legacy_write(child, out, newlines)
+            out.write('</' + xmlio._to_utf8(node.name) + '>')
+        else:
+            out.write('/>')
+        if newlines:
+            out.write(os.linesep)
+    elif isinstance(node, xmlio.Fragment):
+        for child in node.children:
+            legacy_write(child, out, newlines)
+    elif node.startswith('<'):
+        out.write('<![CDATA[' + xmlio._to_utf8(node) + ']]>')
+    else:
+        out.write(xmlio._to_utf8(xmlio._escape_text(node)))
+
+
+def build(count):
+    results = xmlio.Fragment()
+    for idx in range(count):
+        test = xmlio.Element('test', fixture='org.example.Test%d' % (idx % 100),
+                             name='test%d' % idx, duration=0.001 * idx,
+                             status=idx % 10 and 'success' or 'failure',
+                             file=u'src/T\xe9st%d.java' % (idx % 100))
+        if not idx % 10:
+            test.append(xmlio.Element('traceback')[
+                'AssertionError: expected:<1> but was:<2>\n'
+                '\tat org.example.Test%d.test%d' % (idx % 100, idx)
+            ])
+        test.append(xmlio.Element('stdout')['Output of "test" %d & more'
+                                            % idx])
+        results.append(test)
+    return xmlio.Element('result', step='test', status='failure',
+                         time='2007-04-01T15:30:00.0000',
+                         duration=120.5)[
+        xmlio.Element('report', category='test')[results]
+    ]
+
+
+def measure(write, xml, newlines):
+    out = StringIO()
+    start = time.time()
+    write(xml, out, newlines)
+    return time.time() - start, out.getvalue()
+
+
+def main(args):
+    count = args and int(args[0]) or 100000
+    xml = build(count)
+    for newlines in (False, True):
+        legacy_time, legacy_out = measure(legacy_write, xml, newlines)
+        new_time, new_out = measure(lambda xml, out, newlines:
+                                    xml.write(out, newlines=newlines),
+                                    xml, newlines)
+        assert legacy_out == new_out, 'Serialized output differs'
+        print '%d tests, newlines=%-5s %6d KB: legacy %6.2f s, ' \
+              'buffered %6.2f s (%.1fx)' % (count, newlines,
+                                            len(new_out) / 1024, legacy_time,
+                                            new_time, legacy_time / new_time)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -19,4 +19,5 @@ except:
         pass
 
 # The master-slave protocol/configuration version
-PROTOCOL_VERSION = 3
+# (version 4 added gzip encoded step results and recipes)
+PROTOCOL_VERSION = 4
@@ -17,6 +17,7 @@ from trac.admin import IAdminPanelProvider
 from trac.web.chrome import add_stylesheet, add_script, add_warning, add_notice
 
 from bitten.model import BuildConfig, TargetPlatform
+from bitten.queue import PlatformIndex
 from bitten.recipe import Recipe, InvalidRecipeError
 from bitten.util import xmlio
 
@@ -66,6 +67,12 @@ class BuildMasterAdminPageProvider(Component):
             self.config['bitten'].set('stabilize_wait', str(stabilize_wait))
             changed = True
 
+        populate_interval = int(req.args.get('populate_interval', 0))
+        if populate_interval != master.populate_interval:
+            self.config['bitten'].set('populate_interval',
+                                      str(populate_interval))
+            changed = True
+
         slave_timeout = int(req.args.get('slave_timeout', 0))
         if slave_timeout != master.slave_timeout:
             self.config['bitten'].set('slave_timeout', str(slave_timeout))
@@ -232,6 +239,7 @@ class BuildConfigurationsAdminPageProvider(Component):
             config.active = config.name in active
             config.update(db=db)
         db.commit()
+        PlatformIndex.invalidate(self.env)
 
     def _create_config(self, req):
         req.perm.assert_permission('BUILD_CREATE')
@@ -261,6 +269,7 @@ class BuildConfigurationsAdminPageProvider(Component):
                 raise TracError('Configuration %r not found' % name)
             config.delete(db=db)
         db.commit()
+        PlatformIndex.invalidate(self.env)
 
     def _update_config(self, req, config):
         warnings = []
@@ -339,6 +348,7 @@ class BuildConfigurationsAdminPageProvider(Component):
                 raise TracError('Target platform %r not found' % platform_id)
             platform.delete(db=db)
         db.commit()
+        PlatformIndex.invalidate(self.env)
 
     def _update_platform(self, req, platform):
         platform.name = req.args.get('name')
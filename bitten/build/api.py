@@ -10,14 +10,23 @@
 
 """Functions and classes used to simplify the implementation recipe commands."""
 
+import errno
 import logging
 import fnmatch
 import os
+import re
+import select
 import shlex
+import signal
 import time
 import subprocess
 import sys
 
+try:
+    from scandir import walk as _walk
+except ImportError:
+    _walk = os.walk
+
 
 log = logging.getLogger('bitten.build.api')
 
@@ -46,6 +55,164 @@ def _decode(text):
     except UnicodeDecodeError:
         return text.decode(sys.stdout.encoding, 'replace')
 
+def _kill(p):
+    """Terminate a subprocess that has timed out."""
+    if hasattr(p, 'kill'): # Python 2.6+
+        p.kill()
+    elif hasattr(os, 'kill'):
+        os.kill(p.pid, signal.SIGKILL)
+
+def _split_lines(data, final=False):
+    """Split data read from a pipe into lines, translating all newline
+    conventions the way the universal newlines mode of files does.
+
+    Return the list of complete lines and the data of the incomplete last
+    line, which is included in the list instead if `final` is true.
+    """
+    rest = ''
+    if data.endswith('\r') and not final:
+        # Could be the first half of a CRLF sequence
+        data, rest = data[:-1], '\r'
+    lines = data.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    last = lines.pop()
+    if final:
+        if last:
+            lines.append(last)
+    else:
+        rest = last + rest
+    return lines, rest
+
+def _wait_for_pipes(reading, writing, timeout):
+    """Wait until one of the given file descriptors can be read from or
+    written to without blocking, and return the lists of those that can."""
+    try:
+        if hasattr(select, 'poll'):
+            # Unlike select(), poll() is not limited to low file descriptors
+            poller = select.poll()
+            for fd in reading:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+            for fd in writing:
+                poller.register(fd, select.POLLOUT)
+            if timeout is not None:
+                timeout = int(timeout * 1000) + 1
+            events = [fd for fd, event in poller.poll(timeout)]
+            return ([fd for fd in reading if fd in events],
+                    [fd for fd in writing if fd in events])
+        return select.select(reading, writing, [], timeout)[:2]
+    except select.error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return [], []
+
+def _read_pipes_select(p, in_data, limit):
+    """Feed the input data to a subprocess and collect its output, waking up
+    only when one of its pipes is ready or the time limit is reached.
+
+    Yields ``(pipe name, line)`` tuples until the output streams have been
+    closed and the process has exited.
+    """
+    names = {p.stdout.fileno(): 'stdout', p.stderr.fileno(): 'stderr'}
+    buffers = dict([(fd, '') for fd in names])
+    reading = names.keys()
+    writing = []
+    if in_data:
+        writing.append(p.stdin.fileno())
+    else:
+        p.stdin.close()
+    offset = 0
+
+    while reading or writing or p.poll() is None:
+        wait = None
+        if limit:
+            wait = limit - time.time()
+            if wait <= 0:
+                _kill(p)
+                raise TimeoutError()
+        if not (reading or writing):
+            # The process closed its output streams but did not exit yet
+            time.sleep(min(wait or .01, .01))
+            continue
+
+        readable, writable = _wait_for_pipes(reading, writing, wait)
+        for fd in writable:
+            try:
+                # Writing at most PIPE_BUF bytes to a writable pipe does not
+                # block
+                offset += os.write(fd, in_data[offset:offset + 512])
+            except OSError, e:
+                if e.errno != errno.EPIPE:
+                    raise
+                offset = len(in_data) # The process doesn't read its input
+            if offset >= len(in_data):
+                p.stdin.close()
+                writing.remove(fd)
+        for fd in readable:
+            data = os.read(fd, 65536)
+            if not data:
+                reading.remove(fd)
+            lines, buffers[fd] = _split_lines(buffers[fd] + data,
+                                              final=not data)
+            for line in lines:
+                yield names[fd], line
+
+    p.stdout.close()
+    p.stderr.close()
+
+def _read_pipes_threaded(p, in_data, limit):
+    """Feed the input data to a subprocess and collect its output using a
+    thread for each of its pipes.
+
+    Yields ``(pipe name, line)`` tuples until the process has exited and its
+    output has been read.
+    """
+    from threading import Thread
+    from Queue import Queue, Empty
+
+    def reader(pipe, pipe_name, queue):
+        while pipe and not pipe.closed:
+            line = pipe.readline()
+            if line == '':
+                break
+            queue.put((pipe_name, line))
+        if not pipe.closed:
+            pipe.close()
+
+    def writer(pipe, data):
+        if data and pipe and not pipe.closed:
+            pipe.write(data)
+        if not pipe.closed:
+            pipe.close()
+
+    queue = Queue()
+    returncode = None
+
+    pipe_in = Thread(target=writer, args=(p.stdin, in_data))
+    pipe_out = Thread(target=reader, args=(p.stdout, 'stdout', queue))
+    pipe_err = Thread(target=reader, args=(p.stderr, 'stderr', queue))
+    pipe_err.start(); pipe_out.start(); pipe_in.start()
+
+    while True:
+        if limit and limit < time.time():
+            _kill(p)
+            raise TimeoutError()
+        if p.poll() != None and returncode == None:
+            returncode = p.returncode
+        try:
+            name, line = queue.get(block=True, timeout=.01)
+            yield name, line
+        except Empty:
+            if returncode != None:
+                break
+
+    pipe_out.join(); pipe_in.join(); pipe_err.join()
+
+# Waiting for the pipes of a subprocess with select() or poll() is only
+# supported for pipes on POSIX systems
+if os.name == 'posix':
+    _read_pipes = _read_pipes_select
+else:
+    _read_pipes = _read_pipes_threaded
+
 
 class CommandLine(object):
     """Simple helper for executing subprocesses."""
@@ -78,24 +245,6 @@ class CommandLine(object):
                         should be aborted (not supported on Windows without
                         ``subprocess`` module / Python 2.4+)
         """
-        from threading import Thread
-        from Queue import Queue, Empty
-
-        def reader(pipe, pipe_name, queue):
-            while pipe and not pipe.closed:
-                line = pipe.readline()
-                if line == '':
-                    break
-                queue.put((pipe_name, line))
-            if not pipe.closed:
-                pipe.close()
-
-        def writer(pipe, data):
-            if data and pipe and not pipe.closed:
-                pipe.write(data)
-            if not pipe.closed:
-                pipe.close()
-
         args = [self.executable] + self.arguments
         try:
             p = subprocess.Popen(args, bufsize=1, # Line buffered
@@ -120,33 +269,18 @@ class CommandLine(object):
         else:
             in_data = None
         
-        queue = Queue()
         limit = timeout and timeout + time.time() or 0
 
-        pipe_in = Thread(target=writer, args=(p.stdin, in_data))
-        pipe_out = Thread(target=reader, args=(p.stdout, 'stdout', queue))
-        pipe_err = Thread(target=reader, args=(p.stderr, 'stderr', queue))
-        pipe_err.start(); pipe_out.start(); pipe_in.start()
-
-        while True:
-            if limit and limit < time.time():
-                if hasattr(subprocess, 'kill'): # Python 2.6+
-                    p.kill()
-                raise TimeoutError('Command %s timed out' % self.executable)
-            if p.poll() != None and self.returncode == None:
-                self.returncode = p.returncode
-            try:
-                name, line = queue.get(block=True, timeout=.01)
-                line = line and _decode(line.rstrip().replace('\x00', ''))
+        try:
+            for name, line in _read_pipes(p, in_data, limit):
+                line = _decode(line.rstrip().replace('\x00', ''))
                 if name == 'stderr':
                     yield (None, line)
                 else:
                     yield (line, None)
-            except Empty:
-                if self.returncode != None:
-                    break
-
-        pipe_out.join(); pipe_in.join(); pipe_err.join()
+        except TimeoutError:
+            raise TimeoutError('Command %s timed out' % self.executable)
+        self.returncode = p.returncode
 
         log.debug('%s exited with code %s', self.executable,
                   self.returncode)
@@ -154,10 +288,17 @@ class CommandLine(object):
 
 class FileSet(object):
     """Utility class for collecting a list of files in a directory that match
-    given name/path patterns."""
+    given name/path patterns.
+
+    A pattern matches a file if it matches either the path of the file
+    relative to the base directory, or just the file name. Directories are
+    not descended into if all of their contents are excluded by a pattern
+    ending in ``*``, such as ``.svn/*``.
+    """
 
     DEFAULT_EXCLUDES = ['CVS/*', '*/CVS/*', '.svn/*', '*/.svn/*',
-                        '.DS_Store', 'Thumbs.db']
+                        '.git/*', '*/.git/*', '.hg/*', '*/.hg/*',
+                        '.bzr/*', '*/.bzr/*', '.DS_Store', 'Thumbs.db']
 
     def __init__(self, basedir, include=None, exclude=None):
         """Create a file set.
@@ -179,32 +320,35 @@ class FileSet(object):
         if exclude is not None:
             self.exclude += shlex.split(exclude)
 
-        for dirpath, dirnames, filenames in os.walk(self.basedir):
+        included = _compile_patterns(self.include)
+        excluded = _compile_patterns(self.exclude)
+        # A pattern ending in a wildcard that matches the path of a directory
+        # matches the paths of everything inside of it as well
+        pruned = _compile_patterns([pattern for pattern in self.exclude
+                                    if pattern.endswith('*')])
+
+        for dirpath, dirnames, filenames in _walk(self.basedir):
             dirpath = dirpath[len(self.basedir) + 1:]
+            ndirpath = dirpath
+            if os.sep != '/':
+                ndirpath = ndirpath.replace(os.sep, '/')
+            if ndirpath:
+                ndirpath += '/'
+
+            if pruned:
+                dirnames[:] = [dirname for dirname in dirnames
+                               if not pruned(ndirpath + dirname + '/')]
 
             for filename in filenames:
-                filepath = nfilepath = os.path.join(dirpath, filename)
-                if os.sep != '/':
-                    nfilepath = nfilepath.replace(os.sep, '/')
-
-                if self.include:
-                    included = False
-                    for pattern in self.include:
-                        if fnmatch.fnmatchcase(nfilepath, pattern) or \
-                           fnmatch.fnmatchcase(filename, pattern):
-                            included = True
-                            break
-                    if not included:
-                        continue
-
-                excluded = False
-                for pattern in self.exclude:
-                    if fnmatch.fnmatchcase(nfilepath, pattern) or \
-                       fnmatch.fnmatchcase(filename, pattern):
-                        excluded = True
-                        break
-                if not excluded:
-                    self.files.append(filepath)
+                nfilepath = ndirpath + filename
+                if included and not (included(nfilepath) or
+                                     included(filename)):
+                    continue
+                if excluded(nfilepath) or excluded(filename):
+                    continue
+                self.files.append(os.path.join(dirpath, filename))
+
+        self._files = set(self.files)
 
     def __iter__(self):
         """Iterate over the names of all files in the set."""
@@ -216,4 +360,14 @@ class FileSet(object):
         
         :param filename: the name of the file to check
         """
-        return filename in self.files
+        return filename in self._files
+
+
+def _compile_patterns(patterns):
+    """Combine a list of shell-style patterns into a single regular
+    expression, and return its ``match`` method, or `None` if the list is
+    empty."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(['(?:%s)' % fnmatch.translate(pattern)
+                                for pattern in patterns])).match
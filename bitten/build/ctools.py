@@ -102,7 +102,8 @@ def autoreconf(ctxt, file_='configure', force=None, install=None, symlink=None,
     if returncode != 0:
         ctxt.error('autoreconf failed (%s)' % returncode)
 
-def make(ctxt, target=None, file_=None, keep_going=False, directory=None, jobs=None, args=None):
+def make(ctxt, target=None, file_=None, keep_going=False, directory=None, jobs=None, args=None,
+         log_head=None, log_tail=None):
     """Execute a Makefile target.
     
     :param ctxt: the build context
@@ -113,6 +114,10 @@ def make(ctxt, target=None, file_=None, keep_going=False, directory=None, jobs=N
     :param directory: directory in which to build; defaults to project source directory
     :param jobs: number of concurrent jobs to run
     :param args: command-line arguments to pass to the script
+    :param log_head: number of lines at the start of the output to include in
+                     the build log, if the output is to be truncated
+    :param log_tail: number of lines at the end of the output to include in
+                     the build log, if the output is to be truncated
     """
     executable = ctxt.config.get_filepath('make.path') or 'make'
 
@@ -135,7 +140,8 @@ def make(ctxt, target=None, file_=None, keep_going=False, directory=None, jobs=N
             margs += shlex.split(args)
 
     from bitten.build import shtools
-    returncode = shtools.execute(ctxt, executable=executable, args=margs)
+    returncode = shtools.execute(ctxt, executable=executable, args=margs,
+                                 log_head=log_head, log_tail=log_tail)
     if returncode != 0:
         ctxt.error('make failed (%s)' % returncode)
 
@@ -156,42 +162,39 @@ def cppunit(ctxt, file_=None, srcdir=None):
         try:
             total, failed = 0, 0
             results = xmlio.Fragment()
-            for group in xmlio.parse(fileobj):
-                if group.name not in ('FailedTests', 'SuccessfulTests'):
-                    continue
-                for child in group.children():
-                    test = xmlio.Element('test')
-                    name = child.children('Name').next().gettext()
-                    if '::' in name:
-                        parts = name.split('::')
-                        test.attr['fixture'] = '::'.join(parts[:-1])
-                        name = parts[-1]
-                    test.attr['name'] = name
-
-                    for location in child.children('Location'):
-                        for file_elem in location.children('File'):
-                            filepath = file_elem.gettext()
-                            if srcdir is not None:
-                                filepath = posixpath.join(srcdir, filepath)
-                            test.attr['file'] = filepath
-                            break
-                        for line_elem in location.children('Line'):
-                            test.attr['line'] = line_elem.gettext()
-                            break
+            for child in xmlio.iterparse(fileobj, ('FailedTest', 'Test')):
+                test = xmlio.Element('test')
+                name = child.children('Name').next().gettext()
+                if '::' in name:
+                    parts = name.split('::')
+                    test.attr['fixture'] = '::'.join(parts[:-1])
+                    name = parts[-1]
+                test.attr['name'] = name
+
+                for location in child.children('Location'):
+                    for file_elem in location.children('File'):
+                        filepath = file_elem.gettext()
+                        if srcdir is not None:
+                            filepath = posixpath.join(srcdir, filepath)
+                        test.attr['file'] = filepath
+                        break
+                    for line_elem in location.children('Line'):
+                        test.attr['line'] = line_elem.gettext()
                         break
+                    break
+
+                if child.name == 'FailedTest':
+                    for message in child.children('Message'):
+                        test.append(xmlio.Element('traceback')[
+                            message.gettext()
+                        ])
+                    test.attr['status'] = 'failure'
+                    failed += 1
+                else:
+                    test.attr['status'] = 'success'
 
-                    if child.name == 'FailedTest':
-                        for message in child.children('Message'):
-                            test.append(xmlio.Element('traceback')[
-                                message.gettext()
-                            ])
-                        test.attr['status'] = 'failure'
-                        failed += 1
-                    else:
-                        test.attr['status'] = 'success'
-
-                    results.append(test)
-                    total += 1
+                results.append(test)
+                total += 1
 
             if failed:
                 ctxt.error('%d of %d test%s failed' % (failed, total,
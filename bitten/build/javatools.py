@@ -118,7 +118,7 @@ def junit(ctxt, file_=None, srcdir=None):
         for path in glob(ctxt.resolve(file_)):
             fileobj = file(path, 'r')
             try:
-                for testcase in xmlio.parse(fileobj).children('testcase'):
+                for testcase in xmlio.iterparse(fileobj, 'testcase'):
                     test = xmlio.Element('test')
                     test.attr['fixture'] = testcase.attr['classname']
                     test.attr['name'] = testcase.attr['name']
@@ -27,21 +27,14 @@ log = logging.getLogger('bitten.build.monotools')
 __docformat__ = 'restructuredtext en'
 
 
-def _parse_suite(element):
-    for child in element.children('results'):
-        testcases = list(child.children('test-case'))
-        if testcases:
-            yield element, testcases
-
-        for xmlsuite in child.children('test-suite'):
-            for suite in _parse_suite(xmlsuite):
-                yield suite
-
-
 def _get_cases(fileobj):
-    for testsuite in xmlio.parse(fileobj).children('test-suite'):
-        for suite in _parse_suite(testsuite):
-            yield suite
+    # Nested suites are yielded and removed before the suites containing them,
+    # so only the test cases directly inside a suite are left when it is done
+    for suite in xmlio.iterparse(fileobj, 'test-suite'):
+        for child in suite.children('results'):
+            testcases = list(child.children('test-case'))
+            if testcases:
+                yield suite, testcases
 
 
 def nunit(ctxt, file_=None):
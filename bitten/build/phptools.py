@@ -113,17 +113,26 @@ def coverage(ctxt, file_=None):
                 class_coverage.attr['file'] = sourcefile
             coverage.append(class_coverage)
 
+    def _iter_descendants(element, name):
+        """Iterate over the descendants of an element with the given name in
+        document order, as ``(parent, descendant)`` tuples."""
+        for child in element.children():
+            if child.name == name:
+                yield element, child
+            for item in _iter_descendants(child, name):
+                yield item
+
     def _process_phpunit_coverage(ctxt, element, coverage):
-        for cls in element._node.getElementsByTagName('class'):
-            sourcefile = cls.parentNode.getAttribute('name')
+        for parent, cls in _iter_descendants(element, 'class'):
+            sourcefile = parent.attr.get('name', '')
             if not os.path.isabs(sourcefile):
                 sourcefile = os.path.join(ctxt.basedir, sourcefile)
             if sourcefile.startswith(ctxt.basedir):
                 loc, ncloc = 0, 0.0
-                for line in cls.parentNode.getElementsByTagName('line'):
-                    if str(line.getAttribute('type')) == 'stmt':
+                for _, line in _iter_descendants(parent, 'line'):
+                    if line.attr.get('type') == 'stmt':
                         loc += 1
-                        if int(line.getAttribute('count')) == 0:
+                        if int(line.attr['count']) == 0:
                             ncloc += 1
                 if loc > 0:
                     percentage = 100 - (ncloc / loc * 100)
@@ -133,7 +142,7 @@ def coverage(ctxt, file_=None):
                 if sourcefile.startswith(ctxt.basedir):
                     sourcefile = sourcefile[len(ctxt.basedir) + 1:]
                 class_coverage = xmlio.Element('coverage',
-                                    name=cls.getAttribute('name'),
+                                    name=cls.attr.get('name', ''),
                                     lines=int(loc),
                                     percentage=int(percentage),
                                     file=sourcefile.replace(os.sep, '/'))
@@ -447,7 +447,7 @@ def unittest(ctxt, file_=None):
         try:
             total, failed = 0, 0
             results = xmlio.Fragment()
-            for child in xmlio.parse(fileobj).children():
+            for child in xmlio.iterparse(fileobj):
                 test = xmlio.Element('test')
                 for name, value in child.attr.items():
                     if name == 'file':
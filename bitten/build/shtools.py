@@ -11,9 +11,12 @@
 """Generic recipe commands for executing external processes."""
 
 import codecs
+from collections import deque
 import logging
 import os
 import shlex
+import tempfile
+import time
 
 from bitten.build import CommandLine
 from bitten.util import xmlio
@@ -22,7 +25,12 @@ log = logging.getLogger('bitten.build.shtools')
 
 __docformat__ = 'restructuredtext en'
 
-def exec_(ctxt, executable=None, file_=None, output=None, args=None, dir_=None):
+# Interval in seconds at which the output of a running command is passed on
+# to the log listener of the build context
+LOG_INTERVAL = 10
+
+def exec_(ctxt, executable=None, file_=None, output=None, args=None, dir_=None,
+          log_head=None, log_tail=None):
     """Execute a program or shell script.
     
     :param ctxt: the build context
@@ -33,18 +41,23 @@ def exec_(ctxt, executable=None, file_=None, output=None, args=None, dir_=None):
     :param output: name of the file to which the output of the script should be
                    written
     :param args: command-line arguments to pass to the script
+    :param log_head: number of lines at the start of the output to include in
+                     the build log, if the output is to be truncated
+    :param log_tail: number of lines at the end of the output to include in
+                     the build log, if the output is to be truncated
     """
     assert executable or file_, \
         'Either "executable" or "file" attribute required'
 
     returncode = execute(ctxt, executable=executable, file_=file_,
-                         output=output, args=args, dir_=dir_)
+                         output=output, args=args, dir_=dir_,
+                         log_head=log_head, log_tail=log_tail)
     if returncode != 0:
         ctxt.error('Executing %s failed (error code %s)' % (executable or file_,
                                                             returncode))
 
 def pipe(ctxt, executable=None, file_=None, input_=None, output=None,
-         args=None, dir_=None):
+         args=None, dir_=None, log_head=None, log_tail=None):
     """Pipe the contents of a file through a program or shell script.
     
     :param ctxt: the build context
@@ -57,19 +70,24 @@ def pipe(ctxt, executable=None, file_=None, input_=None, output=None,
     :param output: name of the file to which the output of the script should be
                    written
     :param args: command-line arguments to pass to the script
+    :param log_head: number of lines at the start of the output to include in
+                     the build log, if the output is to be truncated
+    :param log_tail: number of lines at the end of the output to include in
+                     the build log, if the output is to be truncated
     """
     assert executable or file_, \
         'Either "executable" or "file" attribute required'
     assert input_, 'Missing required attribute "input"'
 
     returncode = execute(ctxt, executable=executable, file_=file_,
-                         input_=input_, output=output, args=args, dir_=dir_)
+                         input_=input_, output=output, args=args, dir_=dir_,
+                         log_head=log_head, log_tail=log_tail)
     if returncode != 0:
         ctxt.error('Piping through %s failed (error code %s)'
                    % (executable or file_, returncode))
 
 def execute(ctxt, executable=None, file_=None, input_=None, output=None,
-            args=None, dir_=None, filter_=None):
+            args=None, dir_=None, filter_=None, log_head=None, log_tail=None):
     """Generic external program execution.
     
     This function is not itself bound to a recipe command, but rather used from
@@ -86,6 +104,18 @@ def execute(ctxt, executable=None, file_=None, input_=None, output=None,
                    written
     :param args: command-line arguments to pass to the script
     :param filter\_: function to filter out messages from the executable stdout
+    :param log_head: number of lines at the start of the output to include in
+                     the build log
+    :param log_tail: number of lines at the end of the output to include in
+                     the build log
+
+    If either `log_head` or `log_tail` is given, only that many lines of the
+    output are kept in memory. When the output is longer, the build log only
+    contains those lines, and the complete output is written to a file that
+    is attached to the build.
+
+    Otherwise, if the build context has a log listener, the output collected
+    so far is logged every `LOG_INTERVAL` seconds while the program runs.
     """
     if args:
         if isinstance(args, basestring):
@@ -136,34 +166,112 @@ def execute(ctxt, executable=None, file_=None, input_=None, output=None,
     if not filter_:
         filter_=lambda s: s
 
+    if log_head is not None or log_tail is not None:
+        messages = _TruncatedLog(ctxt, int(log_head or 0), int(log_tail or 0))
+        streaming = False
+    else:
+        messages = []
+        streaming = ctxt.log_listener is not None
+    last_logged = time.time()
+
     try:
         cmdline = CommandLine(executable, args, input=input_file,
                               cwd=dir_, shell=shell)
-        log_elem = xmlio.Fragment()
         for out, err in cmdline.execute():
             if out is not None:
                 log.info(out)
                 info = filter_(out)
                 if info:
-                    log_elem.append(xmlio.Element('message', level='info')[
+                    messages.append(('info',
                         info.replace(ctxt.basedir + os.sep, '')
                             .replace(ctxt.basedir, '')
-                ])
+                    ))
                 if output:
                     output_file.write(out + os.linesep)
             if err is not None:
                 log.error(err)
-                log_elem.append(xmlio.Element('message', level='error')[
+                messages.append(('error',
                     err.replace(ctxt.basedir + os.sep, '')
                        .replace(ctxt.basedir, '')
-                ])
+                ))
                 if output:
                     output_file.write(err + os.linesep)
-        ctxt.log(log_elem)
+            if streaming and messages and \
+                    time.time() - last_logged >= LOG_INTERVAL:
+                _log_messages(ctxt, messages)
+                messages = []
+                last_logged = time.time()
+        if isinstance(messages, _TruncatedLog):
+            messages = messages.close()
+        _log_messages(ctxt, messages)
     finally:
         if input_:
             input_file.close()
         if output:
             output_file.close()
+        if isinstance(messages, _TruncatedLog):
+            messages.close()
 
     return cmdline.returncode
+
+def _log_messages(ctxt, messages):
+    ctxt.log(xmlio.Fragment()[
+        [xmlio.Element('message', level=level)[message]
+         for level, message in messages]
+    ])
+
+
+class _TruncatedLog(object):
+    """Collects the log messages of a command, keeping only the first and the
+    last messages in memory while writing all of them to a temporary file.
+
+    The file contains the messages as they appear in the build log, that is
+    after the command filter has been applied and the paths of the base
+    directory have been removed.
+    """
+
+    def __init__(self, ctxt, head, tail):
+        self.ctxt = ctxt
+        self.head = head
+        self.tail = tail
+        self.messages = []
+        self.last = deque()
+        self.omitted = 0
+        prefix = '%s-' % (ctxt.step and ctxt.step.id or 'output')
+        fd, self.filename = tempfile.mkstemp(prefix=prefix, suffix='.log')
+        self.fileobj = codecs.getwriter('utf-8')(os.fdopen(fd, 'w'))
+
+    def append(self, message):
+        self.fileobj.write(message[1] + os.linesep)
+        if len(self.messages) < self.head:
+            self.messages.append(message)
+            return
+        self.last.append(message)
+        if len(self.last) > self.tail:
+            self.last.popleft()
+            self.omitted += 1
+
+    def close(self):
+        """Close the file containing the complete output, and return the
+        messages to include in the build log.
+
+        If no messages had to be omitted, the file is removed. Otherwise it is
+        attached to the build, to be removed by the slave once it has been
+        sent, and a message pointing to it is inserted where messages were
+        omitted.
+        """
+        if self.fileobj is None:
+            return
+        self.fileobj.close()
+        self.fileobj = None
+        if not self.omitted:
+            os.remove(self.filename)
+            return self.messages + list(self.last)
+        basename = os.path.basename(self.filename)
+        self.ctxt.attach_temporary(self.filename,
+                                   description='Complete output of a build '
+                                               'command')
+        return self.messages + [
+            ('warning', '[%d lines omitted, see the attachment %s for the '
+                        'complete output]' % (self.omitted, basename))
+        ] + list(self.last)
@@ -14,6 +14,7 @@ import sys
 import tempfile
 import unittest
 
+from bitten.build import api
 from bitten.build import CommandLine, FileSet, TimeoutError, BuildError
 
 
@@ -151,6 +152,68 @@ print 'Done'
         except BuildError, e:
             self.failUnless("Error executing ['doesnotexist']" in str(e))
 
+    def test_large_output(self):
+        script_file = self._create_file('test.py', content="""
+import sys
+for i in range(20000):
+    print>>sys.stdout, 'out %d' % i
+    if not i % 1000:
+        print>>sys.stderr, 'err %d' % i
+""")
+        cmdline = CommandLine('python', [script_file])
+        stdout = []
+        stderr = []
+        for out, err in cmdline.execute(timeout=30.0):
+            if out is not None:
+                stdout.append(out)
+            if err is not None:
+                stderr.append(err)
+        self.assertEqual(['out %d' % i for i in range(20000)], stdout)
+        self.assertEqual(['err %d' % i for i in range(0, 20000, 1000)], stderr)
+        self.assertEqual(0, cmdline.returncode)
+
+    def test_large_input(self):
+        script_file = self._create_file('test.py', content="""
+import sys
+for line in sys.stdin:
+    sys.stdout.write(line)
+""")
+        data = ''.join(['line %d\n' % i for i in range(20000)])
+        cmdline = CommandLine('python', [script_file], input=data)
+        stdout = [out for out, err in cmdline.execute(timeout=30.0)]
+        self.assertEqual(['line %d' % i for i in range(20000)], stdout)
+        self.assertEqual(0, cmdline.returncode)
+
+    def test_newlines(self):
+        script_file = self._create_file('test.py', content="""
+import sys
+sys.stdout.write('dos\\r\\nmac\\runix\\n\\nlast')
+""")
+        cmdline = CommandLine('python', [script_file])
+        stdout = [out for out, err in cmdline.execute(timeout=5.0)]
+        self.assertEqual(['dos', 'mac', 'unix', '', 'last'], stdout)
+
+    def test_exit_code(self):
+        cmdline = CommandLine('python', ['-c', 'import sys; sys.exit(3)'])
+        self.assertEqual([], list(cmdline.execute(timeout=5.0)))
+        self.assertEqual(3, cmdline.returncode)
+
+
+class ThreadedCommandLineTestCase(CommandLineTestCase):
+    """Run the tests of `CommandLine` with the implementation that reads the
+    output of commands in threads, which is used where the pipes of
+    subprocesses can not be polled."""
+
+    def setUp(self):
+        CommandLineTestCase.setUp(self)
+        self._read_pipes = api._read_pipes
+        api._read_pipes = api._read_pipes_threaded
+
+    def tearDown(self):
+        api._read_pipes = self._read_pipes
+        CommandLineTestCase.tearDown(self)
+
+
 class FileSetTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -207,10 +270,46 @@ class FileSetTestCase(unittest.TestCase):
         fileset = FileSet(self.basedir, include='tests/*.txt', exclude='bar.*')
         assert foo_txt in fileset and bar_txt not in fileset
 
+    def test_files_in_subdir_with_filename_include(self):
+        self._create_dir('tests', 'sub')
+        foo_py = self._create_file('tests', 'sub', 'foo.py')
+        bar_txt = self._create_file('tests', 'bar.txt')
+        fileset = FileSet(self.basedir, include='*.py foo.txt')
+        self.assertEqual([foo_py], list(fileset))
+        assert bar_txt not in fileset
+
+    def test_default_excludes(self):
+        self._create_dir('.git')
+        self._create_dir('tests', '.svn')
+        self._create_file('.git', 'HEAD')
+        self._create_file('tests', '.svn', 'entries')
+        foo_txt = self._create_file('tests', 'foo.txt')
+        fileset = FileSet(self.basedir)
+        self.assertEqual([foo_txt], list(fileset))
+
+    def test_excluded_dirs_not_walked(self):
+        self._create_dir('tests', 'node_modules', 'lib')
+        foo_txt = self._create_file('tests', 'foo.txt')
+        self._create_file('tests', 'node_modules', 'lib', 'bar.txt')
+        walked = []
+        walk = api._walk
+        def _walk(top):
+            for dirpath, dirnames, filenames in walk(top):
+                walked.append(dirpath[len(self.basedir) + 1:])
+                yield dirpath, dirnames, filenames
+        api._walk = _walk
+        try:
+            fileset = FileSet(self.basedir, exclude='*/node_modules/*')
+        finally:
+            api._walk = walk
+        self.assertEqual([foo_txt], list(fileset))
+        self.assertEqual(['', 'tests'], walked)
+
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(CommandLineTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ThreadedCommandLineTestCase, 'test'))
     suite.addTest(unittest.makeSuite(FileSetTestCase, 'test'))
     return suite
 
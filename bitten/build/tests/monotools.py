@@ -141,6 +141,33 @@ class NUnitTestCase(unittest.TestCase):
         self.assertEqual('Test', test_elem.attr['fixture'])
 
 
+    def test_nested_suites_with_test_cases(self):
+        self.results_xml.write(
+'<?xml version="1.0" encoding="utf-8" standalone="no"?>'
+'<test-results name="Test.dll" total="2" failures="0" not-run="0" date="2009-01-05" time="16:32:46">'
+'  <test-suite name="Test.dll" success="True" time="0.081" asserts="0">'
+'    <results>'
+'      <test-case name="Lib.Test1" executed="True" success="True" time="0.001" asserts="1" />'
+'      <test-suite name="Lib" success="True" time="0.078" asserts="0">'
+'        <results>'
+'          <test-case name="Lib.Test2" executed="True" success="True" time="0.002" asserts="1" />'
+'        </results>'
+'      </test-suite>'
+'      <test-case name="Lib.Test3" executed="False" time="0.003" asserts="1" />'
+'    </results>'
+'  </test-suite>'
+'</test-results>'
+)
+        self.results_xml.close()
+        monotools.nunit(self.ctxt, self.results_xml.name)
+        type, category, generator, xml = self.ctxt.output.pop()
+        self.assertEqual([('Lib', '0.002', 'success'),
+                          ('Test.dll', '0.001', 'success'),
+                          ('Test.dll', '0.003', 'ignore')],
+                         [(test.attr['fixture'], test.attr['duration'],
+                           test.attr['status']) for test in xml.children])
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(NUnitTestCase, 'test'))
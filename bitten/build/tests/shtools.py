@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://bitten.edgewall.org/wiki/License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from bitten.build import shtools
+from bitten.recipe import Context, Recipe
+
+
+class ExecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.realpath(tempfile.mkdtemp())
+        self.ctxt = Context(self.basedir)
+        script = file(self.ctxt.resolve('test.py'), 'w')
+        script.write("""import sys
+stream = sys.argv[2:] == ['err'] and sys.stderr or sys.stdout
+for idx in range(int(sys.argv[1])):
+    print >>stream, 'line %d' % idx
+""")
+        script.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+        for type_, category, generator, xml in self.ctxt.output:
+            if type_ == Recipe.ATTACH:
+                os.remove(xml.attr['path'])
+
+    def _output(self, type):
+        output = [xml for type_, category, generator, xml in self.ctxt.output
+                  if type_ == type]
+        self.assertEqual(1, len(output))
+        return output[0]
+
+    def _messages(self):
+        return [(elem.attr['level'], elem.children[0])
+                for elem in self._output(Recipe.LOG).children]
+
+    def test_output(self):
+        shtools.exec_(self.ctxt, executable=sys.executable,
+                      args='test.py 3')
+        self.assertEqual([('info', 'line 0'), ('info', 'line 1'),
+                          ('info', 'line 2')], self._messages())
+        self.assertEqual(1, len(self.ctxt.output))
+
+    def test_error_output(self):
+        shtools.exec_(self.ctxt, executable=sys.executable,
+                      args='test.py 2 err')
+        self.assertEqual([('error', 'line 0'), ('error', 'line 1')],
+                         self._messages())
+        self.assertEqual(1, len(self.ctxt.output))
+
+    def test_truncated_output_within_limits(self):
+        shtools.exec_(self.ctxt, executable=sys.executable,
+                      args='test.py 4', log_head='2', log_tail='2')
+        self.assertEqual([('info', 'line 0'), ('info', 'line 1'),
+                          ('info', 'line 2'), ('info', 'line 3')],
+                         self._messages())
+        self.assertEqual(1, len(self.ctxt.output))
+        self.assertEqual(['test.py'], os.listdir(self.basedir))
+
+    def test_truncated_output(self):
+        shtools.exec_(self.ctxt, executable=sys.executable,
+                      args='test.py 1000', log_head='2', log_tail='3')
+        messages = self._messages()
+        self.assertEqual(6, len(messages))
+        self.assertEqual([('info', 'line 0'), ('info', 'line 1')],
+                         messages[:2])
+        self.assertEqual([('info', 'line 997'), ('info', 'line 998'),
+                          ('info', 'line 999')], messages[3:])
+
+        xml = self._output(Recipe.ATTACH)
+        filename = xml.attr['filename']
+        self.assertEqual(('warning', '[995 lines omitted, see the attachment '
+                                     '%s for the complete output]' % filename),
+                         messages[2])
+        self.assertEqual('true', xml.attr['temporary'])
+        self.assertEqual(['test.py'], os.listdir(self.basedir))
+        fileobj = file(xml.attr['path'])
+        try:
+            lines = fileobj.read().splitlines()
+        finally:
+            fileobj.close()
+        self.assertEqual(['line %d' % idx for idx in range(1000)], lines)
+
+    def test_tail_only(self):
+        shtools.exec_(self.ctxt, executable=sys.executable,
+                      args='test.py 1000', log_tail='1')
+        messages = self._messages()
+        self.assertEqual(2, len(messages))
+        self.assertEqual('warning', messages[0][0])
+        self.assertEqual(('info', 'line 999'), messages[1])
+
+    def test_output_passed_to_log_listener(self):
+        logged = []
+        def listener(generator, xml):
+            logged.append([(elem.attr['level'], elem.children[0])
+                           for elem in xml.children])
+            return True
+        self.ctxt.log_listener = listener
+        interval = shtools.LOG_INTERVAL
+        shtools.LOG_INTERVAL = 0
+        try:
+            shtools.exec_(self.ctxt, executable=sys.executable,
+                          args='test.py 3')
+        finally:
+            shtools.LOG_INTERVAL = interval
+        self.assertEqual([[('info', 'line 0')], [('info', 'line 1')],
+                          [('info', 'line 2')], []], logged)
+        self.assertEqual([], self.ctxt.output)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ExecTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
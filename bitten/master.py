@@ -11,15 +11,28 @@
 """Build master implementation."""
 
 import calendar
+import cgi
+import os
 import re
+import threading
 import time
 from StringIO import StringIO
+from xml.dom import pulldom
+from xml.sax import SAXException
 
 from trac.attachment import Attachment
 from trac.config import BoolOption, IntOption, Option
 from trac.core import *
 from trac.resource import ResourceNotFound
 from trac.web import IRequestHandler, RequestDone
+try:
+    from trac.admin.api import IAdminCommandProvider
+except ImportError: # Trac 0.11
+    IAdminCommandProvider = None
+try:
+    from trac.versioncontrol.api import IRepositoryChangeListener
+except ImportError: # Trac 0.11
+    IRepositoryChangeListener = None
 
 from bitten import PROTOCOL_VERSION
 from bitten.model import BuildConfig, Build, BuildStep, BuildLog, Report, \
@@ -29,8 +42,9 @@ from bitten.main import BuildSystem
 from bitten.queue import BuildQueue
 from bitten.recipe import Recipe
 from bitten.util import xmlio
+from bitten.util.compress import GzipReader, accepts_gzip, gzip
 
-__all__ = ['BuildMaster']
+__all__ = ['BuildMaster', 'BuildQueueScheduler']
 __docformat__ = 'restructuredtext en'
 
 
@@ -39,6 +53,7 @@ HTTP_FORBIDDEN = 403
 HTTP_NOT_FOUND = 404
 HTTP_METHOD_NOT_ALLOWED = 405
 HTTP_CONFLICT = 409
+HTTP_UNSUPPORTED_MEDIA_TYPE = 415
 
 
 class BuildMaster(Component):
@@ -62,6 +77,20 @@ class BuildMaster(Component):
         a group of related changes back to back without spawning multiple
         builds.""")
 
+    populate_interval = IntOption('bitten', 'populate_interval', 0, doc=
+        """The interval in seconds at which a background thread adds builds
+        for new changesets to the build queue. If set to 0 (the default), the
+        queue is populated whenever a slave asks for a build.""")
+
+    long_poll_timeout = IntOption('bitten', 'long_poll_timeout', 0, doc=
+        """The maximum time in seconds for which the request of a build slave
+        for a build is held open when there is no build for it, so that the
+        slave gets a build as soon as one is queued. Slaves can ask for a
+        shorter time. If set to 0 (the default), slaves are told right away
+        that there is no build, and ask again after their poll interval.
+        Builds for new changesets are queued while slaves wait when Trac is
+        notified of the changesets (``trac-admin changeset added``).""")
+
     slave_timeout = IntOption('bitten', 'slave_timeout', 3600, doc=
         """The time in seconds after which a build is cancelled if the slave
         does not report progress.""")
@@ -80,7 +109,7 @@ class BuildMaster(Component):
     # IRequestHandler methods
 
     def match_request(self, req):
-        match = re.match(r'/builds(?:/(\d+)(?:/(\w+)/([^/]+)?)?)?$',
+        match = re.match(r'/builds(?:/(\d+)(?:/(\w+)(?:/([^/]+)?)?)?)?$',
                          req.path_info)
         if match:
             if match.group(1):
@@ -97,6 +126,9 @@ class BuildMaster(Component):
         else:
             slave_token = req.session.sid
 
+        if self.populate_interval:
+            BuildQueueScheduler(self.env).start()
+
         if 'id' not in req.args:
             if req.method != 'POST':
                 self._send_response(req,
@@ -128,6 +160,12 @@ class BuildMaster(Component):
 
         if req.args['collection'] == 'steps':
             return self._process_build_step(req, config, build)
+        elif req.args['collection'] == 'logs':
+            return self._process_build_log(req, config, build)
+        elif req.args['collection'] == 'attachments':
+            return self._process_attachment(req, config, build)
+        elif req.args['collection'] == 'heartbeat':
+            return self._process_heartbeat(req, build)
         else:
             self._send_error(req, HTTP_NOT_FOUND,
                     "No such collection '%s'" % req.args['collection'])
@@ -150,15 +188,37 @@ class BuildMaster(Component):
                    'Content-Length': str(len(message))}
         self._send_response(req, code, body=message, headers=headers)
 
+    def _get_request_body(self, req):
+        """Return a file-like object for reading the request body, which is
+        decompressed while it is read if the slave sent it gzip encoded.
+
+        No more than ``Content-Length`` bytes are requested from `req`: the
+        server does not signal the end of the body, so reading beyond it would
+        wait for data that the slave is never going to send.
+        """
+        encoding = (req.get_header('Content-Encoding') or 'identity').lower()
+        length = req.get_header('Content-Length')
+        if length is not None:
+            length = int(length)
+        if encoding == 'identity':
+            if length is None:
+                return req
+            return _LimitedReader(req, length)
+        elif encoding in ('gzip', 'x-gzip'):
+            return GzipReader(req, length)
+        self._send_error(req, HTTP_UNSUPPORTED_MEDIA_TYPE,
+                         'Unsupported content encoding %s' % encoding)
+
     def _process_build_creation(self, req, slave_token):
         queue = BuildQueue(self.env, build_all=self.build_all, 
                            stabilize_wait=self.stabilize_wait,
                            timeout=self.slave_timeout)
-        queue.populate()
+        if not self.populate_interval:
+            queue.populate()
 
         try:
-            elem = xmlio.parse(req.read())
-        except xmlio.ParseError, e:
+            elem = xmlio.parse(self._get_request_body(req).read())
+        except (xmlio.ParseError, IOError), e:
             self.log.error('Error parsing build initialization request: %s', e,
                            exc_info=True)
             self._send_error(req, HTTP_BAD_REQUEST, 'XML parser error')
@@ -192,6 +252,12 @@ class BuildMaster(Component):
         self.log.debug('Build slave configuration: %r', properties)
 
         build = queue.get_build_for_slave(slavename, properties)
+        wait = min(int(elem.attr.get('wait', 0)), self.long_poll_timeout)
+        if not build and wait > 0:
+            build = queue.wait_for_build(slavename, properties, wait)
+            if not build:
+                # Let the slave know that it can ask again right away
+                self._send_response(req, 204, '', {'X-Bitten-Wait': str(wait)})
         if not build:
             self._send_response(req, 204, '', {})
 
@@ -209,6 +275,10 @@ class BuildMaster(Component):
         db = self.env.get_db_cnx()
         for step in list(BuildStep.select(self.env, build=build.id, db=db)):
             step.delete(db=db)
+        # Logs of the step that was in progress have no step to go with them
+        for log in list(BuildLog.select(self.env, build=build.id, db=db,
+                                        lazy=True)):
+            log.delete(db=db)
         build.update(db=db)
         db.commit()
 
@@ -221,7 +291,10 @@ class BuildMaster(Component):
         self.log.info('Build slave %r initiated build %d', build.slave,
                       build.id)
         build.started = int(time.time())
-        build.update()
+        db = self.env.get_db_cnx()
+        build.update(db=db)
+        build.touch(db=db)
+        db.commit()
 
         for listener in BuildSystem(self.env).listeners:
             listener.build_started(build)
@@ -235,21 +308,28 @@ class BuildMaster(Component):
         xml.attr['platform'] = target_platform.name
         xml.attr['name'] = build.slave
         body = str(xml)
+        headers = {'Content-Type': 'application/x-bitten+xml',
+                   'Content-Disposition':
+                        'attachment; filename=recipe_%s_r%s.xml' %
+                        (config.name, build.rev)}
+        if accepts_gzip(req.get_header('Accept-Encoding')):
+            body = gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(body))
 
         self.log.info('Build slave %r initiated build %d', build.slave,
                       build.id)
 
-        self._send_response(req, 200, body, headers={
-                    'Content-Type': 'application/x-bitten+xml',
-                    'Content-Length': str(len(body)),
-                    'Content-Disposition':
-                        'attachment; filename=recipe_%s_r%s.xml' %
-                        (config.name, build.rev)})
+        self._send_response(req, 200, body, headers=headers)
 
     def _process_build_step(self, req, config, build):
+        # The step result is parsed incrementally from the request body, so
+        # that log messages and report items can be stored as they arrive
+        # without ever holding the complete document in memory
+        stream = pulldom.parse(self._get_request_body(req))
         try:
-            elem = xmlio.parse(req.read())
-        except xmlio.ParseError, e:
+            elem = _read_root_element(stream)
+        except (SAXException, IOError), e:
             self.log.error('Error parsing build step result: %s', e,
                            exc_info=True)
             self._send_error(req, HTTP_BAD_REQUEST, 'XML parser error')
@@ -267,15 +347,12 @@ class BuildMaster(Component):
 
         recipe = Recipe(xmlio.parse(config.recipe))
         index = None
-        current_step = None
         for num, recipe_step in enumerate(recipe):
             if recipe_step.id == stepname:
                 index = num
-                current_step = recipe_step
         if index is None:
             self._send_error(req, HTTP_FORBIDDEN,
                                 'No such build step' % stepname)
-        last_step = index == num
 
         self.log.debug('Slave %s (build %d) completed step %d (%s) with '
                        'status %s', build.slave, build.id, index, stepname,
@@ -283,10 +360,13 @@ class BuildMaster(Component):
 
         db = self.env.get_db_cnx()
 
-        step = BuildStep(self.env, build=build.id, name=stepname)
+        step = BuildStep(self.env, build=build.id, name=stepname,
+                         orderno=index)
         try:
             step.started = int(_parse_iso_datetime(elem.attr['time']))
-            step.stopped = step.started + float(elem.attr['duration'])
+            # The step times are stored in whole seconds
+            step.stopped = int(round(step.started +
+                                     float(elem.attr['duration'])))
         except ValueError, e:
             self.log.error('Error parsing build step timestamp: %s', e,
                            exc_info=True)
@@ -294,67 +374,49 @@ class BuildMaster(Component):
         if elem.attr['status'] == 'failure':
             self.log.warning('Build %s step %s failed', build.id, stepname)
             step.status = BuildStep.FAILURE
-            if current_step.onerror == 'fail':
-                last_step = True
         else:
             step.status = BuildStep.SUCCESS
-        step.errors += [error.gettext() for error in elem.children('error')]
+
+        try:
+            self._process_step_contents(req, build, step, stream, db)
+        except (SAXException, IOError), e:
+            db.rollback()
+            self.log.error('Error parsing build step result: %s', e,
+                           exc_info=True)
+            self._send_error(req, HTTP_BAD_REQUEST, 'XML parser error')
         step.insert(db=db)
 
-        # Collect log messages from the request body
-        for idx, log_elem in enumerate(elem.children('log')):
-            build_log = BuildLog(self.env, build=build.id, step=stepname,
-                                 generator=log_elem.attr.get('generator'),
-                                 orderno=idx)
-            for message_elem in log_elem.children('message'):
-                build_log.messages.append((message_elem.attr['level'],
-                                           message_elem.gettext()))
-            build_log.insert(db=db)
-
-        # Collect report data from the request body
-        for report_elem in elem.children('report'):
-            report = Report(self.env, build=build.id, step=stepname,
-                            category=report_elem.attr.get('category'),
-                            generator=report_elem.attr.get('generator'))
-            for item_elem in report_elem.children():
-                item = {'type': item_elem.name}
-                item.update(item_elem.attr)
-                for child_elem in item_elem.children():
-                    item[child_elem.name] = child_elem.gettext()
-                report.items.append(item)
-            report.insert(db=db)
-
-        # Collect attachments from the request body
-        for attach_elem in elem.children(Recipe.ATTACH):
-            attach_elem = list(attach_elem.children('file'))[0] # One file only
-            filename = attach_elem.attr.get('filename')
-            resource_id = attach_elem.attr.get('resource') == 'config' \
-                                    and build.config or build.resource.id
-            try: # Delete attachment if it already exists
-                old_attach = Attachment(self.env, 'build',
-                                    parent_id=resource_id, filename=filename)
-                old_attach.delete()
-            except ResourceNotFound:
-                pass
-            attachment = Attachment(self.env, 'build', parent_id=resource_id)
-            attachment.description = attach_elem.attr.get('description')
-            attachment.author = req.authname
-            fileobj = StringIO(attach_elem.gettext().decode('base64'))
-            attachment.insert(filename, fileobj, fileobj.len, db=db)
-
-        # If this was the last step in the recipe we mark the build as
-        # completed
+        build.touch(db=db)
+
+        # Steps that do not depend on each other may be completed in any
+        # order, so the build is completed once every step of the recipe
+        # either has a result, or will not be executed because a step it
+        # depends on has failed
+        steps = dict([(s.name, s) for s
+                      in BuildStep.select(self.env, build=build.id, db=db)])
+        stopped = set()
+        last_step = True
+        for recipe_step in recipe:
+            if [dep for dep in recipe_step.depends if dep in stopped]:
+                stopped.add(recipe_step.id)
+            elif recipe_step.id not in steps:
+                last_step = False
+                break
+            elif steps[recipe_step.id].status == BuildStep.FAILURE and \
+                    recipe_step.onerror == 'fail':
+                stopped.add(recipe_step.id)
+
         if last_step:
             self.log.info('Slave %s completed build %d ("%s" as of [%s])',
                           build.slave, build.id, build.config, build.rev)
-            build.stopped = step.stopped
+            build.stopped = max([s.stopped for s in steps.values()])
 
             # Determine overall outcome of the build by checking the outcome
             # of the individual steps against the "onerror" specification of
             # each step in the recipe
-            for num, recipe_step in enumerate(recipe):
-                step = BuildStep.fetch(self.env, build.id, recipe_step.id)
-                if step.status == BuildStep.FAILURE:
+            for recipe_step in recipe:
+                if recipe_step.id in steps and \
+                        steps[recipe_step.id].status == BuildStep.FAILURE:
                     if recipe_step.onerror != 'ignore':
                         build.status = Build.FAILURE
                         break
@@ -376,6 +438,310 @@ class BuildMaster(Component):
                             'Location': req.abs_href.builds(
                                     build.id, 'steps', stepname)})
 
+    def _process_build_log(self, req, config, build):
+        # Log output of a step that is still being executed, which is stored
+        # right away so that the progress of the step can be followed
+        try:
+            elem = xmlio.parse(self._get_request_body(req).read())
+        except (xmlio.ParseError, IOError), e:
+            self.log.error('Error parsing build log: %s', e, exc_info=True)
+            self._send_error(req, HTTP_BAD_REQUEST, 'XML parser error')
+        stepname = elem.attr['step']
+
+        # make sure it's the right slave.
+        if build.status != Build.IN_PROGRESS:
+            self._send_error(req, HTTP_CONFLICT,
+                        'Build %s has been invalidated for host %s.' \
+                                        % (build.id, req.remote_addr))
+
+        if stepname not in [step.id for step
+                            in Recipe(xmlio.parse(config.recipe))]:
+            self._send_error(req, HTTP_FORBIDDEN,
+                             'No such build step: %s' % stepname)
+        if BuildStep.fetch(self.env, build=build.id, name=stepname):
+            self._send_error(req, HTTP_CONFLICT, 'Build step already exists')
+
+        db = self.env.get_db_cnx()
+        build_log = BuildLog(self.env, build=build.id, step=stepname,
+                             generator=elem.attr.get('generator'),
+                             orderno=self._next_log_index(build, stepname, db))
+        build_log.messages = list(_iter_log_messages(elem.children()))
+        build_log.insert(db=db)
+        build.touch(db=db)
+        db.commit()
+
+        body = 'Build log stored'
+        self._send_response(req, 201, body, {
+                            'Content-Type': 'text/plain',
+                            'Content-Length': str(len(body))})
+
+    def _next_log_index(self, build, stepname, db):
+        """Return the position of the next log of a build step, following
+        the logs that have already been streamed while the step was running.
+        """
+        ordernos = [log.orderno for log in BuildLog.select(self.env,
+                    build=build.id, step=stepname, db=db, lazy=True)]
+        if ordernos:
+            return max(ordernos) + 1
+        return 0
+
+    def _process_step_contents(self, req, build, step, stream, db):
+        """Store the errors, logs, reports and attachments of a build step
+        result while reading them from the pulldom event `stream`."""
+        log_index = self._next_log_index(build, step.name, db)
+        for child_elem in _iter_child_elements(stream, lazy=('log', 'report')):
+            if child_elem.name == 'error':
+                step.errors.append(child_elem.gettext())
+
+            elif child_elem.name == 'log':
+                # Collect log messages from the request body
+                build_log = BuildLog(self.env, build=build.id, step=step.name,
+                                     generator=child_elem.attr.get('generator'),
+                                     orderno=log_index)
+                messages = _iter_child_elements(stream)
+                build_log.messages = _iter_log_messages(messages)
+                build_log.insert(db=db)
+                for message_elem in messages:
+                    pass
+                log_index += 1
+
+            elif child_elem.name == 'report':
+                # Collect report data from the request body
+                report = Report(self.env, build=build.id, step=step.name,
+                                category=child_elem.attr.get('category'),
+                                generator=child_elem.attr.get('generator'))
+                items = _iter_child_elements(stream)
+                report.items = _iter_report_items(items)
+                report.insert(db=db)
+                for item_elem in items:
+                    pass
+
+            elif child_elem.name == Recipe.ATTACH:
+                # Collect attachments from the request body
+                attach_elem = list(child_elem.children('file'))[0] # One file only
+                filename = attach_elem.attr.get('filename')
+                resource_id = attach_elem.attr.get('resource') == 'config' \
+                                        and build.config or build.resource.id
+                try: # Delete attachment if it already exists
+                    old_attach = Attachment(self.env, 'build',
+                                        parent_id=resource_id, filename=filename)
+                    old_attach.delete()
+                except ResourceNotFound:
+                    pass
+                attachment = Attachment(self.env, 'build', parent_id=resource_id)
+                attachment.description = attach_elem.attr.get('description')
+                attachment.author = req.authname
+                fileobj = StringIO(attach_elem.gettext().decode('base64'))
+                attachment.insert(filename, fileobj, fileobj.len, db=db)
+
+    def _process_attachment(self, req, config, build):
+        # make sure it's the right slave.
+        if build.status != Build.IN_PROGRESS:
+            self._send_error(req, HTTP_CONFLICT,
+                        'Build %s has been invalidated for host %s.' \
+                                        % (build.id, req.remote_addr))
+
+        # The attachment properties are passed in the query string, which Trac
+        # does not parse for POST requests
+        args = dict([(name, unicode(values[0], 'utf-8')) for name, values
+                     in cgi.parse_qs(req.query_string or '').items()])
+        filename = args.get('filename')
+        if not filename:
+            self._send_error(req, HTTP_BAD_REQUEST, 'No file name given')
+        filename = os.path.basename(filename.replace('\\', '/'))
+        try:
+            size = int(req.get_header('Content-Length'))
+        except (TypeError, ValueError):
+            self._send_error(req, HTTP_BAD_REQUEST, 'Content-Length required')
+
+        resource_id = args.get('resource') == 'config' \
+                                and build.config or build.resource.id
+        db = self.env.get_db_cnx()
+        try: # Delete attachment if it already exists
+            old_attach = Attachment(self.env, 'build',
+                                parent_id=resource_id, filename=filename,
+                                db=db)
+            old_attach.delete(db=db)
+        except ResourceNotFound:
+            pass
+        # The file is copied from the request body to the attachment storage
+        # in blocks, without buffering it as a whole, and without reading
+        # past the end of the body
+        attachment = Attachment(self.env, 'build', parent_id=resource_id)
+        attachment.description = args.get('description')
+        attachment.author = req.authname
+        attachment.insert(filename, _LimitedReader(req, size), size, db=db)
+        build.touch(db=db)
+        db.commit()
+
+        self.log.info('Slave %s attached %s to build %d', build.slave,
+                      filename, build.id)
+
+        body = 'Attachment stored'
+        self._send_response(req, 201, body, {
+                            'Content-Type': 'text/plain',
+                            'Content-Length': str(len(body))})
+
+    def _process_heartbeat(self, req, build):
+        if build.status != Build.IN_PROGRESS:
+            self._send_error(req, HTTP_CONFLICT,
+                        'Build %s has been invalidated for host %s.' \
+                                        % (build.id, req.remote_addr))
+        build.touch()
+        self._send_response(req, 204, '', {})
+
+
+class BuildQueueScheduler(Component):
+    """Populates the build queue outside of the requests of the build slaves.
+
+    If the ``populate_interval`` option is set, a background thread adds the
+    builds for new changesets to the queue at that interval, so that slaves
+    only allocate builds from the already populated queue. If that option or
+    the ``long_poll_timeout`` option is set, the queue is also populated when
+    Trac is notified of new changesets (``trac-admin changeset added`` in Trac
+    0.12 and later), so that slaves waiting for a build get it right away. It
+    can always be populated on demand using the ``trac-admin bitten
+    populate`` command.
+    """
+
+    if IAdminCommandProvider:
+        implements(IAdminCommandProvider)
+    if IRepositoryChangeListener:
+        implements(IRepositoryChangeListener)
+
+    def __init__(self):
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def start(self):
+        """Start the background thread, unless it is already running."""
+        self._lock.acquire()
+        try:
+            if self._thread is not None and self._thread.isAlive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='bitten-queue-scheduler')
+            self._thread.setDaemon(True)
+            self._thread.start()
+            self.log.info('Started populating the build queue every %d '
+                          'seconds', BuildMaster(self.env).populate_interval)
+        finally:
+            self._lock.release()
+
+    def wakeup(self):
+        """Make the background thread populate the queue right away."""
+        self._wakeup.set()
+
+    def populate(self):
+        """Add the builds for new changesets to the build queue."""
+        master = BuildMaster(self.env)
+        queue = BuildQueue(self.env, build_all=master.build_all,
+                           stabilize_wait=master.stabilize_wait,
+                           timeout=master.slave_timeout)
+        queue.populate()
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('bitten populate', '',
+               'Add the builds for new changesets to the build queue',
+               None, self.populate)
+
+    # IRepositoryChangeListener methods
+
+    def changeset_added(self, repos, changeset):
+        master = BuildMaster(self.env)
+        if not master.populate_interval and not master.long_poll_timeout:
+            # The queue is populated when the next slave asks for a build, so
+            # adding the changeset does not have to wait for it. Slaves
+            # waiting for a build in a long poll only notice builds that are
+            # already queued though.
+            return
+        if self._thread is not None and self._thread.isAlive():
+            self.wakeup()
+        else:
+            self.populate()
+
+    def changeset_modified(self, repos, changeset, old_changeset):
+        pass
+
+    # Internal methods
+
+    def _run(self):
+        while True:
+            interval = BuildMaster(self.env).populate_interval
+            if not interval:
+                break
+            try:
+                self.populate()
+            except Exception, e:
+                self.log.error('Error populating the build queue: %s', e,
+                               exc_info=True)
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+        self.log.info('Stopped populating the build queue')
+
+
+class _LimitedReader(object):
+    """File-like object that reads no more than the given number of bytes from
+    another file-like object, such as the body of a request.
+    """
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def _read_root_element(stream):
+    """Read the pulldom event `stream` up to the start of the document element,
+    and return that element without its content."""
+    for event, node in stream:
+        if event == pulldom.START_ELEMENT:
+            return xmlio.ParsedElement(node)
+    raise SAXException('No document element found')
+
+def _iter_child_elements(stream, lazy=()):
+    """Iterate over the child elements of the element whose start has just
+    been read from the pulldom event `stream`, stopping at its end.
+
+    The content of each child is loaded before it is yielded, except for
+    elements with a name listed in `lazy`: for those, the caller is
+    responsible for consuming the events of the content (for example with a
+    nested call of this function) before advancing the iterator.
+    """
+    for event, node in stream:
+        if event == pulldom.START_ELEMENT:
+            if node.tagName not in lazy:
+                stream.expandNode(node)
+            yield xmlio.ParsedElement(node)
+        elif event == pulldom.END_ELEMENT:
+            return
+
+def _iter_log_messages(elems):
+    """Convert ``message`` elements to the ``(level, message)`` tuples of a
+    `BuildLog`."""
+    for message_elem in elems:
+        if message_elem.name == 'message':
+            yield message_elem.attr['level'], message_elem.gettext()
+
+def _iter_report_items(elems):
+    """Convert report item elements to the dictionaries of a `Report`."""
+    for item_elem in elems:
+        item = {'type': item_elem.name}
+        item.update(item_elem.attr)
+        for child_elem in item_elem.children():
+            item[child_elem.name] = child_elem.gettext()
+        yield item
 
 def _parse_iso_datetime(string):
     """Minimal parser for ISO date-time strings.
@@ -16,9 +16,18 @@ from trac.resource import Resource
 from trac.util.text import to_unicode
 import codecs
 import os
+import time
 
 __docformat__ = 'restructuredtext en'
 
+# Maximum number of values passed in a single ``IN (...)`` clause, so that
+# statements stay within the parameter limits of the database backends
+_IN_CHUNK_SIZE = 500
+
+# Number of report items that are buffered before being inserted, so that
+# reports of any size can be stored with bounded memory
+_INSERT_BATCH_SIZE = 1000
+
 
 class BuildConfig(object):
     """Representation of a build configuration."""
@@ -77,10 +86,13 @@ class BuildConfig(object):
         Attachment.delete_all(self.env, 'build', self.resource.id, db)
 
         cursor = db.cursor()
+        cursor.execute("DELETE FROM bitten_queue_mark WHERE config=%s",
+                       (self.name,))
         cursor.execute("DELETE FROM bitten_config WHERE name=%s", (self.name,))
 
         if handle_ta:
             db.commit()
+            TargetPlatform.generation += 1
         self._old_name = None
 
     def insert(self, db=None):
@@ -103,6 +115,7 @@ class BuildConfig(object):
 
         if handle_ta:
             db.commit()
+            TargetPlatform.generation += 1
         self._old_name = self.name
 
     def update(self, db=None):
@@ -127,9 +140,12 @@ class BuildConfig(object):
                            "WHERE config=%s", (self.name, self._old_name))
             cursor.execute("UPDATE bitten_build SET config=%s "
                            "WHERE config=%s", (self.name, self._old_name))
+            cursor.execute("UPDATE bitten_queue_mark SET config=%s "
+                           "WHERE config=%s", (self.name, self._old_name))
 
         if handle_ta:
             db.commit()
+            TargetPlatform.generation += 1
         self._old_name = self.name
 
     def fetch(cls, env, name, db=None):
@@ -200,6 +216,13 @@ class TargetPlatform(object):
         ]
     ]
 
+    # Incremented whenever build configurations or target platforms are
+    # changed in this process, so that data cached from them can be refreshed.
+    # As this must not happen before the change has been committed, callers
+    # passing their own connection to `insert()`, `update()` or `delete()`
+    # need to call `PlatformIndex.invalidate()` after committing instead.
+    generation = 0
+
     def __init__(self, env, config=None, name=None):
         """Initialize a new target platform with the specified attributes.
 
@@ -234,6 +257,7 @@ class TargetPlatform(object):
         cursor.execute("DELETE FROM bitten_platform WHERE id=%s", (self.id,))
         if handle_ta:
             db.commit()
+            TargetPlatform.generation += 1
 
     def insert(self, db=None):
         """Insert a new target platform into the database."""
@@ -260,6 +284,7 @@ class TargetPlatform(object):
 
         if handle_ta:
             db.commit()
+            TargetPlatform.generation += 1
 
     def update(self, db=None):
         """Save changes to an existing target platform."""
@@ -285,6 +310,7 @@ class TargetPlatform(object):
 
         if handle_ta:
             db.commit()
+            TargetPlatform.generation += 1
 
     def fetch(cls, env, id, db=None):
         """Retrieve an existing target platform from the database by ID."""
@@ -317,17 +343,29 @@ class TargetPlatform(object):
 
         where_clauses = []
         if config is not None:
-            where_clauses.append(("config=%s", config))
+            where_clauses.append(("p.config=%s", config))
         if where_clauses:
             where = "WHERE " + " AND ".join([wc[0] for wc in where_clauses])
         else:
             where = ""
 
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM bitten_platform %s ORDER BY name"
+        cursor.execute("SELECT p.id,p.config,p.name,r.propname,r.pattern "
+                       "FROM bitten_platform AS p "
+                       "LEFT OUTER JOIN bitten_rule AS r ON (r.id=p.id) "
+                       "%s ORDER BY p.name,p.id,r.orderno"
                        % where, [wc[1] for wc in where_clauses])
-        for (id,) in cursor:
-            yield TargetPlatform.fetch(env, id)
+        platform = None
+        for id, config, name, propname, pattern in cursor:
+            if platform is None or platform.id != id:
+                if platform is not None:
+                    yield platform
+                platform = TargetPlatform(env, config=config, name=name)
+                platform.id = id
+            if propname is not None:
+                platform.rules.append((propname, pattern))
+        if platform is not None:
+            yield platform
 
     select = classmethod(select)
 
@@ -341,7 +379,9 @@ class Build(object):
             Column('rev_time', type='int'), Column('platform', type='int'),
             Column('slave'), Column('started', type='int'),
             Column('stopped', type='int'), Column('status', size=1),
-            Index(['config', 'rev', 'platform'], unique=True)
+            Column('last_activity', type='int'),
+            Index(['config', 'rev', 'platform'], unique=True),
+            Index(['status', 'last_activity'])
         ],
         Table('bitten_slave', key=('build', 'propname'))[
             Column('build', type='int'), Column('propname'), Column('propvalue')
@@ -365,7 +405,8 @@ class Build(object):
     TOKEN = 'token'
 
     def __init__(self, env, config=None, rev=None, platform=None, slave=None,
-                 started=0, stopped=0, rev_time=0, status=PENDING):
+                 started=0, stopped=0, rev_time=0, status=PENDING,
+                 last_activity=0):
         """Initialize a new build with the specified attributes.
 
         To actually create this build in the database, the `insert` method needs
@@ -381,6 +422,7 @@ class Build(object):
         self.stopped = stopped or 0
         self.rev_time = rev_time
         self.status = status
+        self.last_activity = last_activity or 0
         self.slave_info = {}
 
     def __repr__(self):
@@ -406,6 +448,10 @@ class Build(object):
 
         for step in list(BuildStep.select(self.env, build=self.id)):
             step.delete(db=db)
+        # Logs streamed by the slave for a step that has not been completed
+        for log in list(BuildLog.select(self.env, build=self.id, db=db,
+                                        lazy=True)):
+            log.delete(db=db)
 
         # Delete attachments
         Attachment.delete_all(self.env, 'build', self.resource.id, db)
@@ -417,6 +463,59 @@ class Build(object):
         if handle_ta:
             db.commit()
 
+    def delete_many(cls, env, builds, db=None):
+        """Remove several builds from the database.
+
+        Builds that have neither steps nor attachments (which is usually the
+        case for pending builds) are removed with a constant number of
+        statements; any other build is deleted individually, so that its logs,
+        reports and attachment files are removed as well.
+        """
+        builds = list(builds)
+        if not builds:
+            return
+        if not db:
+            db = env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        cursor = db.cursor()
+        individually = set()
+        for offset in range(0, len(builds), _IN_CHUNK_SIZE):
+            chunk = builds[offset:offset + _IN_CHUNK_SIZE]
+            in_clause = ','.join(['%s'] * len(chunk))
+            cursor.execute("SELECT DISTINCT build FROM bitten_step "
+                           "WHERE build IN (%s)" % in_clause,
+                           [build.id for build in chunk])
+            individually.update([int(row[0]) for row in cursor])
+            resource_ids = dict([(build.resource.id, build.id)
+                                 for build in chunk])
+            cursor.execute("SELECT DISTINCT id FROM attachment "
+                           "WHERE type='build' AND id IN (%s)" % in_clause,
+                           resource_ids.keys())
+            individually.update([resource_ids[row[0]] for row in cursor])
+
+        remaining = []
+        for build in builds:
+            if build.id in individually:
+                build.delete(db=db)
+            else:
+                remaining.append(build.id)
+
+        for offset in range(0, len(remaining), _IN_CHUNK_SIZE):
+            chunk = remaining[offset:offset + _IN_CHUNK_SIZE]
+            in_clause = ','.join(['%s'] * len(chunk))
+            cursor.execute("DELETE FROM bitten_slave WHERE build IN (%s)"
+                           % in_clause, chunk)
+            cursor.execute("DELETE FROM bitten_build WHERE id IN (%s)"
+                           % in_clause, chunk)
+
+        if handle_ta:
+            db.commit()
+
+    delete_many = classmethod(delete_many)
+
     def insert(self, db=None):
         """Insert a new build into the database."""
         assert not self.exists, 'Cannot insert an existing build'
@@ -434,11 +533,12 @@ class Build(object):
 
         cursor = db.cursor()
         cursor.execute("INSERT INTO bitten_build (config,rev,rev_time,platform,"
-                       "slave,started,stopped,status) "
-                       "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
+                       "slave,started,stopped,status,last_activity) "
+                       "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)",
                        (self.config, self.rev, int(self.rev_time),
                         self.platform, self.slave or '', self.started or 0,
-                        self.stopped or 0, self.status))
+                        self.stopped or 0, self.status,
+                        self.last_activity or 0))
         self.id = db.get_last_id(cursor, 'bitten_build')
         if self.slave_info:
             cursor.executemany("INSERT INTO bitten_slave VALUES (%s,%s,%s)",
@@ -448,8 +548,72 @@ class Build(object):
         if handle_ta:
             db.commit()
 
+    def claim(self, slave, slave_info=None, db=None):
+        """Assign this pending build to a build slave.
+
+        The build is only updated if it is still pending in the database, so
+        that a build is never handed out to more than one slave when several
+        slaves ask for builds at the same time.
+
+        :param slave: the name of the slave
+        :param slave_info: the slave properties to record with the build
+        :return: whether the build was claimed; `False` if it is no longer
+                 pending
+        """
+        assert self.exists, 'Cannot claim a non-existing build'
+        assert slave, 'A build must be claimed by a slave'
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        now = int(time.time())
+        cursor = db.cursor()
+        cursor.execute("UPDATE bitten_build SET slave=%s,status=%s,"
+                       "last_activity=%s WHERE id=%s AND status=%s",
+                       (slave, self.IN_PROGRESS, now, self.id, self.PENDING))
+        if cursor.rowcount != 1:
+            if handle_ta:
+                db.rollback()
+            return False
+
+        self.slave = slave
+        self.status = self.IN_PROGRESS
+        self.last_activity = now
+        if slave_info:
+            self.slave_info.update(slave_info)
+        cursor.execute("DELETE FROM bitten_slave WHERE build=%s", (self.id,))
+        if self.slave_info:
+            cursor.executemany("INSERT INTO bitten_slave VALUES (%s,%s,%s)",
+                               [(self.id, name, value) for name, value
+                                in self.slave_info.items()])
+        if handle_ta:
+            db.commit()
+        return True
+
+    def touch(self, db=None):
+        """Record that the slave executing this build is still active."""
+        assert self.exists, 'Cannot touch a non-existing build'
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        self.last_activity = int(time.time())
+        cursor = db.cursor()
+        cursor.execute("UPDATE bitten_build SET last_activity=%s WHERE id=%s",
+                       (self.last_activity, self.id))
+        if handle_ta:
+            db.commit()
+
     def update(self, db=None):
-        """Save changes to an existing build."""
+        """Save changes to an existing build.
+
+        The time of the last activity is not saved, as the build may have been
+        touched since this instance was loaded; see `touch()`.
+        """
         assert self.exists, 'Cannot update a non-existing build'
         if not db:
             db = self.env.get_db_cnx()
@@ -482,17 +646,14 @@ class Build(object):
             db = env.get_db_cnx()
 
         cursor = db.cursor()
-        cursor.execute("SELECT config,rev,rev_time,platform,slave,started,"
-                       "stopped,status FROM bitten_build WHERE id=%s", (id,))
+        cursor.execute("SELECT id,config,rev,rev_time,platform,slave,started,"
+                       "stopped,status,last_activity FROM bitten_build "
+                       "WHERE id=%s", (id,))
         row = cursor.fetchone()
         if not row:
             return None
 
-        build = Build(env, config=row[0], rev=row[1], rev_time=int(row[2]),
-                      platform=int(row[3]), slave=row[4],
-                      started=row[5] and int(row[5]) or 0,
-                      stopped=row[6] and int(row[6]) or 0, status=row[7])
-        build.id = int(id)
+        build = Build._from_row(env, row)
         cursor.execute("SELECT propname,propvalue FROM bitten_slave "
                        "WHERE build=%s", (id,))
         for propname, propvalue in cursor:
@@ -511,32 +672,63 @@ class Build(object):
 
         where_clauses = []
         if config is not None:
-            where_clauses.append(("config=%s", config))
+            where_clauses.append(("b.config=%s", config))
         if rev is not None:
-            where_clauses.append(("rev=%s", str(rev)))
+            where_clauses.append(("b.rev=%s", str(rev)))
         if platform is not None:
-            where_clauses.append(("platform=%s", platform))
+            where_clauses.append(("b.platform=%s", platform))
         if slave is not None:
-            where_clauses.append(("slave=%s", slave))
+            where_clauses.append(("b.slave=%s", slave))
         if status is not None:
-            where_clauses.append(("status=%s", status))
+            where_clauses.append(("b.status=%s", status))
         if min_rev_time is not None:
-            where_clauses.append(("rev_time>=%s", min_rev_time))
+            where_clauses.append(("b.rev_time>=%s", min_rev_time))
         if max_rev_time is not None:
-            where_clauses.append(("rev_time<=%s", max_rev_time))
+            where_clauses.append(("b.rev_time<=%s", max_rev_time))
         if where_clauses:
             where = "WHERE " + " AND ".join([wc[0] for wc in where_clauses])
         else:
             where = ""
 
+        # Load the builds together with their slave properties in a single
+        # query; the rows of one build are adjacent thanks to the trailing
+        # ORDER BY on the build ID, so builds can be yielded as they complete
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM bitten_build %s "
-                       "ORDER BY rev_time DESC,config,slave"
+        cursor.execute("SELECT b.id,b.config,b.rev,b.rev_time,b.platform,"
+                       "b.slave,b.started,b.stopped,b.status,b.last_activity,"
+                       "s.propname,s.propvalue FROM bitten_build AS b "
+                       "LEFT OUTER JOIN bitten_slave AS s ON (s.build=b.id) "
+                       "%s ORDER BY b.rev_time DESC,b.config,b.slave,b.id"
                        % where, [wc[1] for wc in where_clauses])
-        for (id,) in cursor:
-            yield Build.fetch(env, id)
+        build = None
+        for row in cursor:
+            if build is None or build.id != int(row[0]):
+                if build is not None:
+                    yield build
+                build = Build._from_row(env, row[:10])
+            if row[10] is not None:
+                build.slave_info[row[10]] = row[11]
+        if build is not None:
+            yield build
+
     select = classmethod(select)
 
+    def _from_row(cls, env, row):
+        """Create a `Build` object from a ``(id, config, rev, rev_time,
+        platform, slave, started, stopped, status, last_activity)`` database
+        row."""
+        id, config, rev, rev_time, platform, slave, started, stopped, \
+                status, last_activity = row
+        build = Build(env, config=config, rev=rev, rev_time=int(rev_time),
+                      platform=int(platform), slave=slave,
+                      started=started and int(started) or 0,
+                      stopped=stopped and int(stopped) or 0, status=status,
+                      last_activity=last_activity and int(last_activity) or 0)
+        build.id = int(id)
+        return build
+
+    _from_row = classmethod(_from_row)
+
 
 class BuildStep(object):
     """Represents an individual step of an executed build."""
@@ -545,7 +737,7 @@ class BuildStep(object):
         Table('bitten_step', key=('build', 'name'))[
             Column('build', type='int'), Column('name'), Column('description'),
             Column('status', size=1), Column('started', type='int'),
-            Column('stopped', type='int')
+            Column('stopped', type='int'), Column('orderno', type='int')
         ],
         Table('bitten_error', key=('build', 'step', 'orderno'))[
             Column('build', type='int'), Column('step'), Column('message'),
@@ -558,7 +750,7 @@ class BuildStep(object):
     FAILURE = 'F'
 
     def __init__(self, env, build=None, name=None, description=None,
-                 status=None, started=None, stopped=None):
+                 status=None, started=None, stopped=None, orderno=None):
         """Initialize a new build step with the specified attributes.
 
         To actually create this build step in the database, the `insert` method
@@ -571,6 +763,7 @@ class BuildStep(object):
         self.status = status
         self.started = started
         self.stopped = stopped
+        self.orderno = orderno
         self.errors = []
         self._exists = False
 
@@ -588,10 +781,10 @@ class BuildStep(object):
             handle_ta = False
 
         for log in list(BuildLog.select(self.env, build=self.build,
-                                        step=self.name, db=db)):
+                                        step=self.name, db=db, lazy=True)):
             log.delete(db=db)
         for report in list(Report.select(self.env, build=self.build,
-                                         step=self.name, db=db)):
+                                         step=self.name, db=db, lazy=True)):
             report.delete(db=db)
 
         cursor = db.cursor()
@@ -617,9 +810,10 @@ class BuildStep(object):
 
         cursor = db.cursor()
         cursor.execute("INSERT INTO bitten_step (build,name,description,status,"
-                       "started,stopped) VALUES (%s,%s,%s,%s,%s,%s)",
+                       "started,stopped,orderno) VALUES (%s,%s,%s,%s,%s,%s,%s)",
                        (self.build, self.name, self.description or '',
-                        self.status, self.started or 0, self.stopped or 0))
+                        self.status, self.started or 0, self.stopped or 0,
+                        self.orderno or 0))
         if self.errors:
             cursor.executemany("INSERT INTO bitten_error (build,step,message,"
                                "orderno) VALUES (%s,%s,%s,%s)",
@@ -637,14 +831,15 @@ class BuildStep(object):
             db = env.get_db_cnx()
 
         cursor = db.cursor()
-        cursor.execute("SELECT description,status,started,stopped "
+        cursor.execute("SELECT description,status,started,stopped,orderno "
                        "FROM bitten_step WHERE build=%s AND name=%s",
                        (build, name))
         row = cursor.fetchone()
         if not row:
             return None
         step = BuildStep(env, build, name, row[0] or '', row[1],
-                         row[2] and int(row[2]), row[3] and int(row[3]))
+                         row[2] and int(row[2]), row[3] and int(row[3]),
+                         int(row[4] or 0))
         step._exists = True
 
         cursor.execute("SELECT message FROM bitten_error WHERE build=%s "
@@ -657,7 +852,7 @@ class BuildStep(object):
 
     def select(cls, env, build=None, name=None, status=None, db=None):
         """Retrieve existing build steps from the database that match the
-        specified criteria.
+        specified criteria, in the order of the steps in the recipe.
         """
         if not db:
             db = env.get_db_cnx()
@@ -666,24 +861,104 @@ class BuildStep(object):
 
         where_clauses = []
         if build is not None:
-            where_clauses.append(("build=%s", build))
+            where_clauses.append(("s.build=%s", build))
         if name is not None:
-            where_clauses.append(("name=%s", name))
+            where_clauses.append(("s.name=%s", name))
         if status is not None:
-            where_clauses.append(("status=%s", status))
+            where_clauses.append(("s.status=%s", status))
         if where_clauses:
             where = "WHERE " + " AND ".join([wc[0] for wc in where_clauses])
         else:
             where = ""
 
         cursor = db.cursor()
-        cursor.execute("SELECT build,name FROM bitten_step %s ORDER BY stopped"
+        cursor.execute("SELECT s.build,s.name,s.description,s.status,"
+                       "s.started,s.stopped,s.orderno FROM bitten_step AS s "
+                       "%s ORDER BY s.orderno,s.stopped"
                        % where, [wc[1] for wc in where_clauses])
-        for build, name in cursor:
-            yield BuildStep.fetch(env, build, name, db=db)
+        steps = [BuildStep._from_row(env, row) for row in cursor]
+        if not steps:
+            return
+
+        # Load the error messages of all selected steps in one go
+        errors = {}
+        cursor.execute("SELECT e.build,e.step,e.message FROM bitten_error AS e "
+                       "INNER JOIN bitten_step AS s "
+                       "ON (s.build=e.build AND s.name=e.step) %s "
+                       "ORDER BY e.orderno"
+                       % where, [wc[1] for wc in where_clauses])
+        for build, name, message in cursor:
+            errors.setdefault((int(build), name), []).append(message or '')
+
+        for step in steps:
+            step.errors = errors.get((step.build, step.name), [])
+            yield step
 
     select = classmethod(select)
 
+    def select_for_builds(cls, env, builds, status=None, db=None):
+        """Retrieve the steps of several builds, including their error
+        messages, using a constant number of queries.
+
+        :param builds: an iterable of build IDs
+        :param status: only return steps with this status (optional)
+        :return: a dictionary mapping every given build ID to the list of its
+                 `BuildStep` objects, ordered as by `select`
+        """
+        if not db:
+            db = env.get_db_cnx()
+
+        assert status in (None, BuildStep.SUCCESS, BuildStep.FAILURE)
+
+        build_ids = [int(build) for build in builds]
+        steps = dict([(build, []) for build in build_ids])
+        if not build_ids:
+            return steps
+
+        cursor = db.cursor()
+        by_key = {}
+        for offset in range(0, len(build_ids), _IN_CHUNK_SIZE):
+            chunk = build_ids[offset:offset + _IN_CHUNK_SIZE]
+            in_clause = "s.build IN (%s)" % ','.join(['%s'] * len(chunk))
+            args = list(chunk)
+            if status is not None:
+                in_clause += " AND s.status=%s"
+                args.append(status)
+
+            cursor.execute("SELECT s.build,s.name,s.description,s.status,"
+                           "s.started,s.stopped,s.orderno FROM bitten_step "
+                           "AS s WHERE %s ORDER BY s.orderno,s.stopped"
+                           % in_clause, args)
+            for row in cursor:
+                step = BuildStep._from_row(env, row)
+                steps[step.build].append(step)
+                by_key[(step.build, step.name)] = step
+
+            cursor.execute("SELECT e.build,e.step,e.message "
+                           "FROM bitten_error AS e INNER JOIN bitten_step AS s "
+                           "ON (s.build=e.build AND s.name=e.step) "
+                           "WHERE %s ORDER BY e.orderno" % in_clause, args)
+            for build, name, message in cursor:
+                step = by_key.get((int(build), name))
+                if step is not None:
+                    step.errors.append(message or '')
+
+        return steps
+
+    select_for_builds = classmethod(select_for_builds)
+
+    def _from_row(cls, env, row):
+        """Create a `BuildStep` object from a ``(build, name, description,
+        status, started, stopped, orderno)`` database row."""
+        build, name, description, status, started, stopped, orderno = row
+        step = BuildStep(env, int(build), name, description or '', status,
+                         started and int(started), stopped and int(stopped),
+                         int(orderno or 0))
+        step._exists = True
+        return step
+
+    _from_row = classmethod(_from_row)
+
 
 class BuildLog(object):
     """Represents a build log."""
@@ -769,7 +1044,11 @@ class BuildLog(object):
         self.id = None
 
     def insert(self, db=None):
-        """Insert a new build log into the database."""
+        """Insert a new build log into the database.
+
+        The ``messages`` may be any iterable of ``(level, message)`` tuples;
+        they are written to the log file one at a time.
+        """
         if not db:
             db = self.env.get_db_cnx()
             handle_ta = True
@@ -788,8 +1067,15 @@ class BuildLog(object):
         if self.messages:
             log_file_name = self.get_log_file(log_file)
             level_file_name = log_file_name + self.LEVELS_SUFFIX
-            codecs.open(log_file_name, "wb", "UTF-8").writelines([to_unicode(msg[1]+"\n") for msg in self.messages])
-            codecs.open(level_file_name, "wb", "UTF-8").writelines([to_unicode(msg[0]+"\n") for msg in self.messages])
+            log_fileobj = codecs.open(log_file_name, "wb", "UTF-8")
+            level_fileobj = codecs.open(level_file_name, "wb", "UTF-8")
+            try:
+                for level, message in self.messages:
+                    log_fileobj.write(to_unicode(message + "\n"))
+                    level_fileobj.write(to_unicode(level + "\n"))
+            finally:
+                log_fileobj.close()
+                level_fileobj.close()
 
         if handle_ta:
             db.commit()
@@ -827,9 +1113,12 @@ class BuildLog(object):
 
     fetch = classmethod(fetch)
 
-    def select(cls, env, build=None, step=None, generator=None, db=None):
+    def select(cls, env, build=None, step=None, generator=None, db=None,
+               lazy=False):
         """Retrieve existing build logs from the database that match the
         specified criteria.
+
+        If `lazy` is true, the messages of the logs are not read.
         """
         if not db:
             db = env.get_db_cnx()
@@ -847,10 +1136,17 @@ class BuildLog(object):
             where = ""
 
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM bitten_log %s ORDER BY orderno"
+        cursor.execute("SELECT id,build,step,generator,orderno,filename "
+                       "FROM bitten_log %s ORDER BY orderno"
                        % where, [wc[1] for wc in where_clauses])
-        for (id, ) in cursor:
-            yield BuildLog.fetch(env, id, db=db)
+        for id, build, step, generator, orderno, filename in cursor.fetchall():
+            if lazy:
+                log = BuildLog(env, int(build), step, generator, orderno,
+                               filename)
+                log.id = id
+                yield log
+            else:
+                yield BuildLog.fetch(env, id, db=db)
 
     select = classmethod(select)
 
@@ -907,7 +1203,11 @@ class Report(object):
         self.id = None
 
     def insert(self, db=None):
-        """Insert a new build log into the database."""
+        """Insert a new report into the database.
+
+        The ``items`` may be any iterable of dictionaries; they are inserted
+        in batches as they are read.
+        """
         if not db:
             db = self.env.get_db_cnx()
             handle_ta = True
@@ -921,18 +1221,30 @@ class Report(object):
         # currently don't support UNIQUE() constraints
         assert not list(Report.select(self.env, build=self.build,
                                       step=self.step, category=self.category,
-                                      db=db)), 'Report already exists'
+                                      db=db, lazy=True)), \
+               'Report already exists'
 
         cursor = db.cursor()
         cursor.execute("INSERT INTO bitten_report "
                        "(build,step,category,generator) VALUES (%s,%s,%s,%s)",
                        (self.build, self.step, self.category, self.generator))
         id = db.get_last_id(cursor, 'bitten_report')
-        for idx, item in enumerate([item for item in self.items if item]):
+        rows = []
+        idx = 0
+        for item in self.items:
+            if not item:
+                continue
+            rows += [(id, idx, key, value) for key, value in item.items()]
+            idx += 1
+            if len(rows) >= _INSERT_BATCH_SIZE:
+                cursor.executemany("INSERT INTO bitten_report_item "
+                                   "(report,item,name,value) "
+                                   "VALUES (%s,%s,%s,%s)", rows)
+                rows = []
+        if rows:
             cursor.executemany("INSERT INTO bitten_report_item "
                                "(report,item,name,value) VALUES (%s,%s,%s,%s)",
-                               [(id, idx, key, value) for key, value
-                                in item.items()])
+                               rows)
 
         if handle_ta:
             db.commit()
@@ -964,21 +1276,27 @@ class Report(object):
     fetch = classmethod(fetch)
 
     def select(cls, env, config=None, build=None, step=None, category=None,
-               db=None):
+               db=None, lazy=False):
         """Retrieve existing reports from the database that match the specified
         criteria.
+
+        By default, the reports and all their items are loaded with a single
+        ordered query, and every report is yielded as soon as its items have
+        been read. If `lazy` is true, the ``items`` of the returned reports are
+        instead iterables that only query the items (one `dict` at a time) when
+        iterated over, which keeps memory usage low for very large reports.
         """
         where_clauses = []
         joins = []
         if config is not None:
-            where_clauses.append(("config=%s", config))
-            joins.append("INNER JOIN bitten_build ON (bitten_build.id=build)")
+            where_clauses.append(("b.config=%s", config))
+            joins.append("INNER JOIN bitten_build AS b ON (b.id=r.build)")
         if build is not None:
-            where_clauses.append(("build=%s", build))
+            where_clauses.append(("r.build=%s", build))
         if step is not None:
-            where_clauses.append(("step=%s", step))
+            where_clauses.append(("r.step=%s", step))
         if category is not None:
-            where_clauses.append(("category=%s", category))
+            where_clauses.append(("r.category=%s", category))
 
         if where_clauses:
             where = "WHERE " + " AND ".join([wc[0] for wc in where_clauses])
@@ -988,15 +1306,182 @@ class Report(object):
         if not db:
             db = env.get_db_cnx()
         cursor = db.cursor()
-        cursor.execute("SELECT bitten_report.id FROM bitten_report %s %s "
-                       "ORDER BY category" % (' '.join(joins), where),
+
+        if lazy:
+            cursor.execute("SELECT r.id,r.build,r.step,r.category,r.generator "
+                           "FROM bitten_report AS r %s %s ORDER BY r.category"
+                           % (' '.join(joins), where),
+                           [wc[1] for wc in where_clauses])
+            for id, build, step, category, generator in cursor:
+                report = Report(env, int(build), step, category or '',
+                                generator or '')
+                report.id = id
+                report.items = _ReportItems(env, id, db=db)
+                yield report
+            return
+
+        cursor.execute("SELECT r.id,r.build,r.step,r.category,r.generator,"
+                       "i.item,i.name,i.value FROM bitten_report AS r %s "
+                       "LEFT OUTER JOIN bitten_report_item AS i "
+                       "ON (i.report=r.id) %s "
+                       "ORDER BY r.category,r.id,i.item"
+                       % (' '.join(joins), where),
                        [wc[1] for wc in where_clauses])
-        for (id, ) in cursor:
-            yield Report.fetch(env, id, db=db)
+        report = None
+        for id, build, step, category, generator, item, name, value in cursor:
+            if report is None or report.id != id:
+                if report is not None:
+                    yield report
+                report = Report(env, int(build), step, category or '',
+                                generator or '')
+                report.id = id
+                current_item = None
+            if item is None:
+                continue
+            if item != current_item:
+                report.items.append({})
+                current_item = item
+            report.items[-1][name] = value
+        if report is not None:
+            yield report
 
     select = classmethod(select)
 
 
+class _ReportItems(object):
+    """Iterable over the items of a stored report that only reads the items
+    from the database while being iterated, yielding one `dict` per item.
+    """
+
+    def __init__(self, env, report, db=None):
+        self.env = env
+        self.report = report
+        self.db = db
+
+    def __iter__(self):
+        db = self.db or self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT item,name,value FROM bitten_report_item "
+                       "WHERE report=%s ORDER BY item", (self.report,))
+        current_item, item = None, None
+        for idx, name, value in cursor:
+            if idx != current_item:
+                if item is not None:
+                    yield item
+                item = {}
+                current_item = idx
+            item[name] = value
+        if item is not None:
+            yield item
+
+
+class QueueMark(object):
+    """Records the youngest revision of a build configuration that has already
+    been examined when populating the build queue (the "high-water mark").
+
+    The `signature` captures the settings the examination was based on (such
+    as the revision range and the target platforms); a mark with a different
+    signature is obsolete and the history has to be examined again.
+    """
+
+    _schema = [
+        Table('bitten_queue_mark', key='config')[
+            Column('config'), Column('rev'), Column('signature')
+        ]
+    ]
+
+    def __init__(self, env, config=None, rev=None, signature=None):
+        """Initialize a new high-water mark with the specified attributes.
+
+        To actually create this mark in the database, the `insert` method needs
+        to be called.
+        """
+        self.env = env
+        self._exists = False
+        self.config = config
+        self.rev = rev and str(rev) or None
+        self.signature = signature or ''
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.config)
+
+    exists = property(fget=lambda self: self._exists,
+                      doc='Whether this mark exists in the database')
+
+    def delete(self, db=None):
+        """Remove the mark from the database."""
+        assert self.exists, 'Cannot delete a non-existing mark'
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM bitten_queue_mark WHERE config=%s",
+                       (self.config,))
+
+        if handle_ta:
+            db.commit()
+        self._exists = False
+
+    def insert(self, db=None):
+        """Insert a new mark into the database."""
+        assert not self.exists, 'Cannot insert an existing mark'
+        assert self.config and self.rev
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        cursor = db.cursor()
+        cursor.execute("INSERT INTO bitten_queue_mark (config,rev,signature) "
+                       "VALUES (%s,%s,%s)",
+                       (self.config, self.rev, self.signature))
+
+        if handle_ta:
+            db.commit()
+        self._exists = True
+
+    def update(self, db=None):
+        """Save changes to an existing mark."""
+        assert self.exists, 'Cannot update a non-existing mark'
+        assert self.config and self.rev
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        cursor = db.cursor()
+        cursor.execute("UPDATE bitten_queue_mark SET rev=%s,signature=%s "
+                       "WHERE config=%s",
+                       (self.rev, self.signature, self.config))
+
+        if handle_ta:
+            db.commit()
+
+    def fetch(cls, env, config, db=None):
+        """Retrieve the mark of a build configuration from the database."""
+        if not db:
+            db = env.get_db_cnx()
+
+        cursor = db.cursor()
+        cursor.execute("SELECT rev,signature FROM bitten_queue_mark "
+                       "WHERE config=%s", (config,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+
+        mark = QueueMark(env, config=config, rev=row[0], signature=row[1])
+        mark._exists = True
+        return mark
+
+    fetch = classmethod(fetch)
+
+
 schema = BuildConfig._schema + TargetPlatform._schema + Build._schema + \
-         BuildStep._schema + BuildLog._schema + Report._schema
-schema_version = 10
+         BuildStep._schema + BuildLog._schema + Report._schema + \
+         QueueMark._schema
+schema_version = 13
@@ -19,18 +19,20 @@ the next pending build, and to match build slaves against configured target
 platforms.
 """
 
-from itertools import ifilter
 import re
+import threading
 import time
+from weakref import WeakKeyDictionary
 
 from trac.util.datefmt import to_timestamp
 
-from bitten.model import BuildConfig, TargetPlatform, Build, BuildStep
+from bitten.model import BuildConfig, TargetPlatform, Build, BuildStep, \
+                         BuildLog, QueueMark
 
 __docformat__ = 'restructuredtext en'
 
 
-def collect_changes(repos, config, db=None):
+def collect_changes(repos, config, db=None, stop_rev=None):
     """Collect all changes for a build configuration that either have already
     been built, or still need to be built.
     
@@ -41,6 +43,8 @@ def collect_changes(repos, config, db=None):
     :param repos: the version control repository
     :param config: the build configuration
     :param db: a database connection (optional)
+    :param stop_rev: a revision that has already been examined; if given, only
+                     the changes younger than that revision are collected
     """
     env = config.env
     if not db:
@@ -52,12 +56,19 @@ def collect_changes(repos, config, db=None):
                     config.path, config.name, exc_info=True)
         return
 
+    platforms = list(TargetPlatform.select(env, config.name, db=db))
+
     for path, rev, chg in node.get_history():
 
         # Don't follow moves/copies
         if path != repos.normalize_path(config.path):
             break
 
+        # Don't go beyond the changes that have already been examined
+        if stop_rev is not None and (str(rev) == str(stop_rev) or
+                                     repos.rev_older_than(rev, stop_rev)):
+            break
+
         # Stay within the limits of the build config
         if config.min_rev and repos.rev_older_than(rev, config.min_rev):
             break
@@ -76,7 +87,7 @@ def collect_changes(repos, config, db=None):
 
         # For every target platform, check whether there's a build
         # of this revision
-        for platform in TargetPlatform.select(env, config.name, db=db):
+        for platform in platforms:
             builds = list(Build.select(env, config.name, rev, platform.id,
                                        db=db))
             if builds:
@@ -87,6 +98,104 @@ def collect_changes(repos, config, db=None):
             yield platform, rev, build
 
 
+class PlatformIndex(object):
+    """Index of the target platforms of all active build configurations, with
+    the platform rules precompiled to regular expressions.
+
+    The index is loaded with a single query and cached per environment. It is
+    rebuilt when build configurations or target platforms have been changed
+    in the current process (see `TargetPlatform.generation`) or `invalidate()`
+    has been called, and at the latest after `max_age` seconds to pick up
+    changes made by other processes.
+    """
+
+    max_age = 60
+
+    _indexes = WeakKeyDictionary()
+    _lock = threading.Lock()
+
+    def __init__(self, env, db=None):
+        """Load the index from the database.
+
+        :param env: the Trac environment
+        :param db: a database connection (optional)
+        """
+        self.env = env
+        self.generation = TargetPlatform.generation
+        self.created = time.time()
+        self.platforms = []
+        if not db:
+            db = env.get_db_cnx()
+
+        cursor = db.cursor()
+        cursor.execute("SELECT p.id,p.config,p.name,r.propname,r.pattern "
+                       "FROM bitten_platform AS p "
+                       "INNER JOIN bitten_config AS c ON (c.name=p.config) "
+                       "LEFT OUTER JOIN bitten_rule AS r ON (r.id=p.id) "
+                       "WHERE c.active=1 "
+                       "ORDER BY c.name,p.name,p.id,r.orderno")
+        platform = rules = None
+        for id, config, name, propname, pattern in cursor:
+            if platform is None or platform.id != id:
+                platform = TargetPlatform(env, config=config, name=name)
+                platform.id = id
+                rules = []
+                self.platforms.append((platform, rules))
+            if propname is None:
+                continue
+            platform.rules.append((propname, pattern))
+            try:
+                rules.append((propname, re.compile(pattern)))
+            except re.error:
+                env.log.error('Invalid platform matching pattern "%s"',
+                              pattern, exc_info=True)
+                rules.append((propname, None))
+
+    def get(cls, env):
+        """Return the index of the given environment, loading it if there is
+        none yet or it is out of date."""
+        cls._lock.acquire()
+        try:
+            index = cls._indexes.get(env)
+            if index is None or index.generation != TargetPlatform.generation \
+                    or time.time() - index.created > cls.max_age:
+                index = cls._indexes[env] = cls(env)
+            return index
+        finally:
+            cls._lock.release()
+
+    get = classmethod(get)
+
+    def invalidate(cls, env):
+        """Discard the cached index of the given environment."""
+        cls._lock.acquire()
+        try:
+            cls._indexes.pop(env, None)
+        finally:
+            cls._lock.release()
+
+    invalidate = classmethod(invalidate)
+
+    def match(self, properties):
+        """Return the list of target platforms whose rules all match the given
+        slave properties.
+
+        :param properties: the slave configuration
+        :type properties: `dict`
+        """
+        platforms = []
+        for platform, rules in self.platforms:
+            for propname, regexp in rules:
+                if regexp is None:
+                    break
+                propvalue = properties.get(propname)
+                if not propvalue or not regexp.match(propvalue):
+                    break
+            else:
+                platforms.append(platform)
+        return platforms
+
+
 class BuildQueue(object):
     """Enapsulates the build queue of an environment.
     
@@ -94,6 +203,14 @@ class BuildQueue(object):
     repository revisions that need to be built.
     """
 
+    orphan_check_interval = 60
+    # Time in seconds between checks for new pending builds while a slave is
+    # waiting for one
+    pending_check_interval = 1
+
+    _orphan_checks = WeakKeyDictionary()
+    _orphan_checks_lock = threading.Lock()
+
     def __init__(self, env, build_all=False, stabilize_wait=0, timeout=0):
         """Create the build queue.
         
@@ -101,9 +218,9 @@ class BuildQueue(object):
         :param build_all: whether older revisions should be built
         :param stabilize_wait: The time in seconds to wait before considering
                         the repository stable to create a build in the queue.
-        :param timeout: the time in seconds after which an in-progress build
-                        should be considered orphaned, and reset to pending
-                        state
+        :param timeout: the time in seconds without activity from the slave
+                        after which an in-progress build should be considered
+                        orphaned, and reset to pending state
         """
         self.env = env
         self.log = env.log
@@ -129,39 +246,72 @@ class BuildQueue(object):
         db = self.env.get_db_cnx()
         repos = self.env.get_repository()
 
-        self.reset_orphaned_builds()
+        if self._orphan_check_due():
+            self.reset_orphaned_builds()
 
         # Iterate through pending builds by descending revision timestamp, to
         # avoid the first configuration/platform getting all the builds
         platforms = [p.id for p in self.match_slave(name, properties)]
-        builds_to_delete = []
-        build_found = False
-        for build in Build.select(self.env, status=Build.PENDING, db=db):
-            if self.should_delete_build(build, repos):
-                self.log.info('Scheduling build %d for deletion', build.id)
-                builds_to_delete.append(build)
-            elif build.platform in platforms:
-                build_found = True
-                break
-        if not build_found:
-            self.log.debug('No pending builds.')
-            build = None
+        pending = list(Build.select(self.env, status=Build.PENDING, db=db))
+        builds_to_delete = self.select_obsolete_builds(pending, repos, db=db)
+        obsolete_ids = set([b.id for b in builds_to_delete])
 
         # delete any obsolete builds
         for build_to_delete in builds_to_delete:
-            build_to_delete.delete(db=db)
-
-        if build:
-            build.slave = name
-            build.slave_info.update(properties)
-            build.status = Build.IN_PROGRESS
-            build.update(db=db)
+            self.log.info('Scheduling build %d for deletion',
+                          build_to_delete.id)
+        Build.delete_many(self.env, builds_to_delete, db=db)
+
+        # Claim the first matching build that no other slave has taken in the
+        # meantime, moving on to the next candidate otherwise
+        build = None
+        for candidate in pending:
+            if candidate.id in obsolete_ids \
+                    or candidate.platform not in platforms:
+                continue
+            if candidate.claim(name, properties, db=db):
+                build = candidate
+                break
+            self.log.debug('Build %d has already been claimed by another '
+                           'slave', candidate.id)
+        if build is None:
+            self.log.debug('No pending builds.')
 
         if build or builds_to_delete:
             db.commit()
 
         return build
 
+    def wait_for_build(self, name, properties, timeout):
+        """Wait until a build that the build slave can execute is pending, and
+        allocate it to the slave.
+
+        The pending builds are checked for changes about once a second, so
+        builds queued by other processes are noticed as well.
+
+        :param name: the name of the slave
+        :type name: `basestring`
+        :param properties: the slave configuration
+        :type properties: `dict`
+        :param timeout: the maximum time in seconds to wait
+        :return: the allocated build, or `None` if no build was found in time
+        :rtype: `Build`
+        """
+        deadline = time.time() + timeout
+        signature = self._get_pending_signature()
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(self.pending_check_interval, remaining))
+            current = self._get_pending_signature()
+            if current == signature:
+                continue
+            signature = current
+            build = self.get_build_for_slave(name, properties)
+            if build:
+                return build
+
     def match_slave(self, name, properties):
         """Match a build slave against available target platforms.
         
@@ -171,27 +321,12 @@ class BuildQueue(object):
         :type properties: `dict`
         :return: the list of platforms the slave matched
         """
-        platforms = []
+        platforms = PlatformIndex.get(self.env).match(properties)
 
-        for config in BuildConfig.select(self.env):
-            for platform in TargetPlatform.select(self.env, config=config.name):
-                match = True
-                for propname, pattern in ifilter(None, platform.rules):
-                    try:
-                        propvalue = properties.get(propname)
-                        if not propvalue or not re.match(pattern, propvalue):
-                            match = False
-                            break
-                    except re.error:
-                        self.log.error('Invalid platform matching pattern "%s"',
-                                       pattern, exc_info=True)
-                        match = False
-                        break
-                if match:
-                    self.log.debug('Slave %r matched target platform %r of '
-                                   'build configuration %r', name,
-                                   platform.name, config.name)
-                    platforms.append(platform)
+        for platform in platforms:
+            self.log.debug('Slave %r matched target platform %r of '
+                           'build configuration %r', name,
+                           platform.name, platform.config)
 
         if not platforms:
             self.log.warning('Slave %r matched none of the target platforms',
@@ -207,15 +342,33 @@ class BuildQueue(object):
         a corresponding build on each target platform. Repeatedly calling this
         method will eventually result in the entire change history of the build
         configuration being in the build queue.
+
+        The youngest revision examined for each configuration is recorded as a
+        `QueueMark`, so that subsequent calls only need to look at the changes
+        that have been made since. The history is examined again in full when
+        the revision range, the target platforms or the ``build_all`` setting
+        change.
         """
         repos = self.env.get_repository()
 
         db = self.env.get_db_cnx()
         builds = []
+        marks = []
 
         for config in BuildConfig.select(self.env, db=db):
+            signature = self._get_mark_signature(config, db)
+            mark = QueueMark.fetch(self.env, config.name, db=db)
+            stop_rev = None
+            if mark and mark.signature == signature:
+                stop_rev = mark.rev
+
             platforms = []
-            for platform, rev, build in collect_changes(repos, config, db):
+            youngest_rev = None
+            delayed = False
+            for platform, rev, build in collect_changes(repos, config, db,
+                                                        stop_rev=stop_rev):
+                if youngest_rev is None:
+                    youngest_rev = rev
 
                 if not self.build_all and platform.id in platforms:
                     # We've seen this platform already, so these are older
@@ -238,6 +391,7 @@ class BuildQueue(object):
                                       'seconds pass. Current age is: %s '
                                       'seconds' % (rev, self.stabilize_wait,
                                       age))
+                        delayed = True
                         continue
 
                     build = Build(self.env, config=config.name,
@@ -245,6 +399,15 @@ class BuildQueue(object):
                                   rev_time=rev_time)
                     builds.append(build)
 
+            # Only advance the mark if none of the changes have been delayed,
+            # so that they are examined again on the next run
+            if youngest_rev is not None and not delayed:
+                if not mark:
+                    mark = QueueMark(self.env, config=config.name)
+                mark.rev = str(youngest_rev)
+                mark.signature = signature
+                marks.append(mark)
+
         for build in builds:
             try:
                 build.insert(db=db)
@@ -258,9 +421,33 @@ class BuildQueue(object):
                     build.config, build.rev, build.platform, e)
                 db.rollback()
 
+        for mark in marks:
+            try:
+                if mark.exists:
+                    mark.update(db=db)
+                else:
+                    mark.insert(db=db)
+                db.commit()
+            except Exception, e:
+                # another process has recorded the mark concurrently
+                self.log.info('Failed to record examined revision [%s] of '
+                    'configuration "%s": %s', mark.rev, mark.config, e)
+                db.rollback()
+
+    def _get_mark_signature(self, config, db):
+        """Return a string identifying the settings that determine which
+        changes of a build configuration need to be examined."""
+        platform_ids = [str(platform.id) for platform
+                        in TargetPlatform.select(self.env, config.name, db=db)]
+        platform_ids.sort()
+        return '|'.join([config.path or '', str(config.min_rev or ''),
+                         str(config.max_rev or ''),
+                         self.build_all and '1' or '0', ','.join(platform_ids)])
+
     def reset_orphaned_builds(self):
-        """Reset all in-progress builds to ``PENDING`` state if they've been
-        running so long that the configured timeout has been reached.
+        """Reset all in-progress builds to ``PENDING`` state if the slave has
+        not reported any activity on them for longer than the configured
+        timeout.
         
         This is used to cleanup after slaves that have unexpectedly cancelled
         a build without notifying the master, or are for some other reason not
@@ -272,36 +459,120 @@ class BuildQueue(object):
             return
 
         db = self.env.get_db_cnx()
-        now = int(time.time())
-        for build in Build.select(self.env, status=Build.IN_PROGRESS, db=db):
-            if now - build.started < self.timeout:
-                # This build has not reached the timeout yet, assume it's still
-                # being executed
-                # FIXME: ideally, we'd base this check on the last activity on
-                #        the build, not the start time
-                continue
+        cursor = db.cursor()
+        cursor.execute("SELECT id FROM bitten_build "
+                       "WHERE status=%s AND last_activity<%s",
+                       (Build.IN_PROGRESS, int(time.time()) - self.timeout))
+        for build_id in [row[0] for row in cursor.fetchall()]:
+            build = Build.fetch(self.env, build_id, db=db)
+            self.log.info('Resetting orphaned build %d of slave %s',
+                          build.id, build.slave)
             build.status = Build.PENDING
             build.slave = None
             build.slave_info = {}
             build.started = 0
             for step in list(BuildStep.select(self.env, build=build.id, db=db)):
                 step.delete(db=db)
+            for log in list(BuildLog.select(self.env, build=build.id, db=db,
+                                            lazy=True)):
+                log.delete(db=db)
             build.update(db=db)
         db.commit()
 
+    def _get_pending_signature(self):
+        """Return a value that changes whenever builds are added to or taken
+        from the pending builds."""
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*),MAX(id) FROM bitten_build "
+                       "WHERE status=%s", (Build.PENDING,))
+        return tuple(cursor.fetchone())
+
+    def _orphan_check_due(self):
+        """Return whether the orphaned builds of the environment should be
+        checked for again, which happens at most every
+        `orphan_check_interval` seconds."""
+        if not self.timeout:
+            return False
+        now = time.time()
+        self._orphan_checks_lock.acquire()
+        try:
+            last_check = self._orphan_checks.get(self.env)
+            if last_check is not None \
+                    and now - last_check < self.orphan_check_interval:
+                return False
+            self._orphan_checks[self.env] = now
+            return True
+        finally:
+            self._orphan_checks_lock.release()
+
+    def select_obsolete_builds(self, builds, repos, db=None):
+        """Determine which of the given pending builds should be dropped.
+
+        The build configurations, the target platforms and the most recent
+        revision timestamp of each configuration/platform combination are
+        loaded up front, so the cost of the check does not grow with the
+        number of database queries per build.
+
+        :param builds: the pending builds to check
+        :param repos: the version control repository
+        :return: the list of builds that should be deleted
+        """
+        if not builds:
+            return []
+        if not db:
+            db = self.env.get_db_cnx()
+
+        configs = dict([(config.name, config) for config
+                        in BuildConfig.select(self.env, include_inactive=True,
+                                              db=db)])
+        platforms = dict([(platform.id, platform.name) for platform
+                          in TargetPlatform.select(self.env, db=db)])
+        newest = {}
+        if not self.build_all:
+            cursor = db.cursor()
+            cursor.execute("SELECT config,platform,MAX(rev_time) "
+                           "FROM bitten_build GROUP BY config,platform")
+            for config, platform, rev_time in cursor:
+                newest[(config, platform)] = int(rev_time)
+
+        return [build for build in builds
+                if self._is_obsolete(build, configs.get(build.config),
+                                     platforms.get(build.platform),
+                                     newest.get((build.config,
+                                                 build.platform)), repos)]
+
     def should_delete_build(self, build, repos):
         config = BuildConfig.fetch(self.env, build.config)
-
         platform = TargetPlatform.fetch(self.env, build.platform)
-        # Platform may or may not exist anymore - get safe name for logging
-        platform_name = platform and platform.name \
-                        or 'unknown platform "%s"' % build.platform
-
+        newest_rev_time = None
+        if not self.build_all:
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute("SELECT MAX(rev_time) FROM bitten_build "
+                           "WHERE config=%s AND platform=%s",
+                           (build.config, build.platform))
+            row = cursor.fetchone()
+            if row and row[0] is not None:
+                newest_rev_time = int(row[0])
+        return self._is_obsolete(build, config, platform and platform.name,
+                                 newest_rev_time, repos)
+
+    def _is_obsolete(self, build, config, platform_name, newest_rev_time,
+                     repos):
         # Drop build if platform no longer exists
-        if not platform:
+        if platform_name is None:
             self.log.info('Dropping build of configuration "%s" at '
                      'revision [%s] on %s because the platform no longer '
-                     'exists', config.name, build.rev, platform_name)
+                     'exists', build.config, build.rev,
+                     'unknown platform "%s"' % build.platform)
+            return True
+
+        # Drop build if the configuration no longer exists
+        if not config:
+            self.log.info('Dropping build of configuration "%s" at '
+                     'revision [%s] on %s because the configuration no '
+                     'longer exists', build.config, build.rev, platform_name)
             return True
 
         # Ignore pending builds for deactived build configs
@@ -322,9 +593,8 @@ class BuildQueue(object):
             return True
 
         # If not 'build_all', drop if a more recent revision is available
-        if not self.build_all and \
-                len(list(Build.select(self.env, config=build.config,
-                min_rev_time=build.rev_time, platform=build.platform))) > 1:
+        if not self.build_all and newest_rev_time is not None \
+                and newest_rev_time > build.rev_time:
             self.log.info('Dropping build of configuration "%s" at revision [%s] '
                      'on "%s" because a more recent build exists',
                          config.name, build.rev, platform_name)
@@ -14,11 +14,12 @@ This module provides various classes that can be used to process build recipes,
 most importantly the `Recipe` class.
 """
 
+from copy import copy
 import inspect
 import keyword
 import logging
 import os
-import time
+import threading
 try:
     set
 except NameError:
@@ -29,7 +30,8 @@ from bitten.build import BuildError
 from bitten.build.config import Configuration
 from bitten.util import xmlio
 
-__all__ = ['Context', 'Recipe', 'Step', 'InvalidRecipeError']
+__all__ = ['CommandRegistry', 'Context', 'Recipe', 'Step',
+           'InvalidRecipeError', 'command_registry']
 __docformat__ = 'restructuredtext en'
 
 log = logging.getLogger('bitten.recipe')
@@ -39,11 +41,78 @@ class InvalidRecipeError(Exception):
     """Exception raised when a recipe is not valid."""
 
 
+class CommandRegistry(object):
+    """Registry of the functions implementing recipe commands.
+
+    The ``bitten.recipe_commands`` entry points are scanned when the first
+    command is looked up, and both the loaded functions and the arguments they
+    accept are cached from then on. The registry needs to be invalidated for
+    commands of packages installed later to be found.
+    """
+
+    group = 'bitten.recipe_commands'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entry_points = None
+        self._functions = {}
+        self._arguments = {}
+
+    def get_function(self, qname):
+        """Return the function implementing a recipe command, or `None` if
+        there is no such command.
+
+        :param qname: the qualified name of the command (namespace#name)
+        """
+        self._lock.acquire()
+        try:
+            if qname not in self._functions:
+                if self._entry_points is None:
+                    self._entry_points = {}
+                    for entry_point in WorkingSet().iter_entry_points(
+                            self.group):
+                        self._entry_points.setdefault(entry_point.name,
+                                                      entry_point)
+                entry_point = self._entry_points.get(qname)
+                self._functions[qname] = entry_point and entry_point.load()
+            return self._functions[qname]
+        finally:
+            self._lock.release()
+
+    def get_arguments(self, function):
+        """Return the names of the arguments accepted by a command function,
+        and whether it accepts arbitrary keyword arguments.
+        """
+        self._lock.acquire()
+        try:
+            if function not in self._arguments:
+                args, _, kwargs = inspect.getargspec(function)[:3]
+                self._arguments[function] = args, kwargs is not None
+            return self._arguments[function]
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """Forget the commands resolved so far, so that the entry points are
+        scanned again on the next lookup.
+        """
+        self._lock.acquire()
+        try:
+            self._entry_points = None
+            self._functions.clear()
+            self._arguments.clear()
+        finally:
+            self._lock.release()
+
+command_registry = CommandRegistry()
+
+
 class Context(object):
     """The context in which a build is executed."""
 
     step = None # The current step
     generator = None # The current generator (namespace#name)
+    log_listener = None # Callable that log output is passed to as recorded
 
     def __init__(self, basedir, config=None, vars=None):
         """Initialize the context.
@@ -60,6 +129,15 @@ class Context(object):
                                                                 **self.vars))
         self.vars['basedir'] = self.basedir.replace('\\', '\\\\')
 
+    def copy(self):
+        """Return a context for executing a step concurrently with other
+        steps, sharing the configuration, variables and base directory of
+        this context but collecting output separately.
+        """
+        ctxt = copy(self)
+        ctxt.output = []
+        return ctxt
+
     def run(self, step, namespace, name, attr):
         """Run the specified recipe command.
         
@@ -75,10 +153,7 @@ class Context(object):
             function = None
             qname = '#'.join(filter(None, [namespace, name]))
             if namespace:
-                group = 'bitten.recipe_commands'
-                for entry_point in WorkingSet().iter_entry_points(group, qname):
-                    function = entry_point.load()
-                    break
+                function = command_registry.get_function(qname)
             elif name == 'report':
                 function = Context.report_file
             elif name == 'attach':
@@ -94,7 +169,8 @@ class Context(object):
             args = dict([(escape(name),
                           self.config.interpolate(attr[name], **self.vars))
                          for name in attr])
-            function_args, has_kwargs = inspect.getargspec(function)[0:3:2]
+            function_args, has_kwargs = \
+                    command_registry.get_arguments(function)
             for arg in args:
                 if not (arg in function_args or has_kwargs):
                     raise InvalidRecipeError(
@@ -118,9 +194,15 @@ class Context(object):
 
     def log(self, xml):
         """Record log output.
+
+        If a `log_listener` is set, it is called with the generator and the
+        XML fragment first; when it returns a true value, the log output has
+        been delivered and is not included in the output of the step.
         
         :param xml: an XML fragment containing the log messages
         """
+        if self.log_listener and self.log_listener(self.generator, xml):
+            return
         self.output.append((Recipe.LOG, None, self.generator, xml))
 
     def report(self, category, xml):
@@ -133,6 +215,9 @@ class Context(object):
 
     def report_file(self, category=None, file_=None):
         """Read report data from a file and record it.
+
+        The file is parsed incrementally, but the report data is recorded as a
+        whole, as it is sent to the build master as part of the step result.
         
         :param category: the name of the category of the report
         :param file\_: the path to the file containing the report data, relative
@@ -143,7 +228,7 @@ class Context(object):
             fileobj = file(filename, 'r')
             try:
                 xml_elem = xmlio.Fragment()
-                for child in xmlio.parse(fileobj).children():
+                for child in xmlio.iterparse(fileobj):
                     child_elem = xmlio.Element(child.name, **dict([
                         (name, value) for name, value in child.attr.items()
                         if value is not None
@@ -171,18 +256,31 @@ class Context(object):
         :param resource: which resource to attach the file to,
                    either 'build' (default) or 'config'
         """
+        self._attach(file_, description, resource)
+
+    def attach_temporary(self, file_, description=None):
+        """Attach a file to the build that the build slave removes once it has
+        sent the file to the build master.
+
+        :param file\_: the path to the file to attach
+        :param description: description saved with attachment
+        """
+        self._attach(file_, description, None, temporary=True)
+
+    def _attach(self, file_, description, resource, temporary=False):
         filename = self.resolve(file_)
         try:
-            fileobj = open(filename, 'rb')
-            try:
-                xml_elem = xmlio.Element('file',
-                                filename=os.path.basename(filename),
-                                description=description,
-                                resource=resource or 'build')
-                xml_elem.append(fileobj.read().encode('base64'))
-                self.output.append((Recipe.ATTACH, None, None, xml_elem))
-            finally:
-                fileobj.close()
+            # Only check that the file can be read: the content is sent to the
+            # build master straight from disk by the slave
+            open(filename, 'rb').close()
+            xml_elem = xmlio.Element('file',
+                            filename=os.path.basename(filename),
+                            description=description,
+                            resource=resource or 'build',
+                            path=filename)
+            if temporary:
+                xml_elem.attr['temporary'] = 'true'
+            self.output.append((Recipe.ATTACH, None, None, xml_elem))
         except IOError, e:
             self.error('Failed to read file %s as attachment' % file_)
 
@@ -202,16 +300,24 @@ class Step(object):
     their keyword arguments.
     """
 
-    def __init__(self, elem):
+    def __init__(self, elem, previous=None):
         """Create the step.
         
         :param elem: the XML element representing the step
         :type elem: `ParsedElement`
+        :param previous: the ID of the step preceding this step in the recipe,
+                         which the step depends on unless its dependencies
+                         are declared explicitly
         """
         self._elem = elem
         self.id = elem.attr['id']
         self.description = elem.attr.get('description')
         self.onerror = elem.attr.get('onerror', 'fail')
+        depends = elem.attr.get('depends')
+        if depends is None:
+            self.depends = filter(None, [previous])
+        else:
+            self.depends = _split_step_ids(depends)
 
     def __repr__(self):
         return '<%s %r>' % (type(self).__name__, self.id)
@@ -222,15 +328,11 @@ class Step(object):
         :param ctxt: the build context
         :type ctxt: `Context`
         """
-        last_finish = time.time()
         for child in self._elem:
             try:
                 ctxt.run(self, child.namespace, child.name, child.attr)
             except (BuildError, InvalidRecipeError), e:
                 ctxt.error(e)
-        if time.time() < last_finish + 1:
-            # Add a delay to make sure steps appear in correct order
-            time.sleep(1)
 
         errors = []
         while ctxt.output:
@@ -275,8 +377,11 @@ class Recipe(object):
 
     def __iter__(self):
         """Iterate over the individual steps of the recipe."""
+        previous = None
         for child in self._root.children('step'):
-            yield Step(child)
+            step = Step(child, previous)
+            previous = step.id
+            yield step
 
     def validate(self):
         """Validate the recipe.
@@ -287,6 +392,7 @@ class Recipe(object):
            "step"
          - the recipe must contain at least one step
          - step elements must have a unique "id" attribute
+         - steps may only depend on steps defined before them
          - a step must contain at least one nested command
          - commands must not have nested content
 
@@ -310,6 +416,11 @@ class Recipe(object):
             if step.attr['id'] in step_ids:
                 raise InvalidRecipeError('Duplicate step ID "%s"' %
                                          step.attr['id'])
+            for step_id in _split_step_ids(step.attr.get('depends', '')):
+                if step_id not in step_ids:
+                    raise InvalidRecipeError('Step "%s" depends on step "%s", '
+                                             'which is not defined before it'
+                                             % (step.attr['id'], step_id))
             step_ids.add(step.attr['id'])
 
             cmds = list(step.children())
@@ -320,3 +431,7 @@ class Recipe(object):
                 if len(list(cmd.children())):
                     raise InvalidRecipeError('Recipe command <%s> has nested '
                                              'content' % cmd.name)
+
+
+def _split_step_ids(value):
+    return value.replace(',', ' ').split()
@@ -208,7 +208,7 @@ class TestCoverageAnnotator(Component):
             if not resource.id.startswith('/' + config.path.lstrip('/')):
                 continue
             reports = Report.select(self.env, build=build.id,
-                                    category='coverage')
+                                    category='coverage', lazy=True)
             path_in_config = resource.id[len(config.path)+1:].lstrip('/')
             for report in reports:
                 for item in report.items:
@@ -12,6 +12,7 @@
 
 from datetime import datetime
 import errno
+import httplib
 import urllib
 import urllib2
 import logging
@@ -21,6 +22,7 @@ import shutil
 import socket
 import sys
 import tempfile
+import threading
 import time
 import re
 import cookielib
@@ -31,6 +33,7 @@ from bitten.build import BuildError
 from bitten.build.config import Configuration, ConfigFileNotFound
 from bitten.recipe import Recipe
 from bitten.util import xmlio
+from bitten.util.compress import GzipReader, gzip
 
 EX_OK = getattr(os, "EX_OK", 0)
 EX_UNAVAILABLE = getattr(os, "EX_UNAVAILABLE", 69)
@@ -72,6 +75,214 @@ class SaneHTTPRequest(urllib2.Request):
         return self.method
 
 
+class _ConnectionPool(object):
+    """Idle persistent HTTP connections, kept per scheme and host so that
+    they can be reused for subsequent requests to the same build master.
+    """
+
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Take an idle connection for the given key out of the pool, or
+        return `None` if there is none."""
+        self._lock.acquire()
+        try:
+            idle = self._connections.get(key)
+            if idle:
+                return idle.pop()
+        finally:
+            self._lock.release()
+
+    def put(self, key, conn):
+        """Return a connection to the pool after its response has been read
+        completely."""
+        self._lock.acquire()
+        try:
+            idle = self._connections.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            connections, self._connections = self._connections, {}
+        finally:
+            self._lock.release()
+        for idle in connections.values():
+            for conn in idle:
+                conn.close()
+
+
+class _PooledResponse(object):
+    """Adapter around an `httplib.HTTPResponse` that returns the connection
+    to the pool once the response has been read, for use with
+    ``socket._fileobject`` like ``urllib2`` does (see `_ResponseFile`).
+    """
+
+    # Unread response bodies up to this size are skipped when the response is
+    # closed, so that the connection can still be reused
+    max_drain = 65536
+
+    def __init__(self, pool, key, conn, resp):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        if resp.length == 0:
+            resp.read()
+            self._release()
+
+    def recv(self, amt):
+        data = self.resp.read(amt)
+        if self.resp.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        length = self.resp.length
+        if not self.resp.isclosed() and length is not None \
+                and length <= self.max_drain:
+            self.resp.read()
+        if self.resp.isclosed():
+            self._release()
+        else:
+            self.resp.close()
+            self.conn.close()
+            self.conn = None
+
+    def _release(self):
+        if self.conn is None:
+            return
+        if self.resp.will_close:
+            self.conn.close()
+        else:
+            self.pool.put(self.key, self.conn)
+        self.conn = None
+
+
+class _ResponseFile(socket._fileobject):
+    """File object for reading a `_PooledResponse`, which is closed along with
+    the file.
+
+    ``socket._fileobject`` only supports closing the underlying object as of
+    Python 2.5.
+    """
+
+    def close(self):
+        sock = self._sock
+        socket._fileobject.close(self)
+        if sock is not None:
+            sock.close()
+
+
+class _KeepAliveMixin(object):
+    """Mixin for ``urllib2`` HTTP handlers that sends requests over
+    persistent connections taken from a `_ConnectionPool`.
+    """
+
+    def _open(self, conn_class, req):
+        if getattr(req, '_tunnel_host', None):
+            # Connections tunneled through a proxy are not pooled
+            return self.do_open(conn_class, req)
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (conn_class, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict([(k, v) for k, v in req.headers.items()
+                             if k not in headers]))
+        headers = dict([(name.title(), val) for name, val in headers.items()])
+
+        position = None
+        if hasattr(req.data, 'seek'):
+            position = req.data.tell()
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if conn is None:
+                timeout = getattr(req, 'timeout', None)
+                if timeout is None:
+                    conn = conn_class(host)
+                else:
+                    conn = conn_class(host, timeout=timeout)
+            # A request is only sent again if the build master may have
+            # closed the idle connection in the meantime, and certainly has
+            # not processed it: the request could not be sent, or the
+            # connection was closed before any of the response was received
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+            except (socket.error, httplib.HTTPException), e:
+                retry = reused
+            else:
+                try:
+                    try:
+                        resp = conn.getresponse(buffering=True)
+                    except TypeError: # Python before 2.7
+                        resp = conn.getresponse()
+                    break
+                except httplib.BadStatusLine, e:
+                    retry = reused and _is_empty_status_line(e)
+                except (socket.error, httplib.HTTPException), e:
+                    retry = False
+            conn.close()
+            if not retry:
+                raise urllib2.URLError(e)
+            log.debug('Persistent connection to %s lost, reconnecting', host)
+            if position is not None:
+                req.data.seek(position)
+
+        fp = _ResponseFile(_PooledResponse(self.pool, key, conn, resp))
+        result = urllib2.addinfourl(fp, resp.msg, req.get_full_url())
+        result.code = resp.status
+        result.msg = resp.reason
+        return result
+
+
+def _is_empty_status_line(e):
+    """Return whether a `httplib.BadStatusLine` error was raised because the
+    connection was closed without any response being sent.
+    """
+    line = getattr(e, 'line', '')
+    # Depending on the version, httplib reports the missing status line as an
+    # empty string, as its representation, or with an explanation
+    return line in ('', "''") or line.startswith('No status line received')
+
+
+class _KeepAliveHTTPHandler(_KeepAliveMixin, urllib2.HTTPHandler):
+
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._open(httplib.HTTPConnection, req)
+
+
+if hasattr(httplib, 'HTTPSConnection'):
+    class _KeepAliveHTTPSHandler(_KeepAliveMixin, urllib2.HTTPSHandler):
+
+        def __init__(self, pool):
+            urllib2.HTTPSHandler.__init__(self)
+            self.pool = pool
+
+        def https_open(self, req):
+            return self._open(httplib.HTTPSConnection, req)
+else:
+    _KeepAliveHTTPSHandler = None
+
+
 class BuildSlave(object):
     """HTTP client implementation for the build slave."""
 
@@ -79,7 +290,10 @@ class BuildSlave(object):
                  work_dir=None, build_dir="build_${build}",
                  keep_files=False, single_build=False,
                  poll_interval=300, username=None, password=None,
-                 dump_reports=False, no_loop=False, form_auth=False):
+                 dump_reports=False, no_loop=False, form_auth=False,
+                 heartbeat_interval=60, long_poll=60,
+                 max_concurrent_builds=1, max_parallel_steps=1,
+                 stream_logs=True):
         """Create the build slave instance.
         
         :param urls: a list of URLs of the build masters to connect to, or a
@@ -108,6 +322,22 @@ class BuildSlave(object):
                         of whether a build is done or not
         :param form_auth: login using AccountManager HTML form instead of
                                 HTTP authentication for all urls
+        :param heartbeat_interval: the time in seconds between notifying the
+                                   build master that a build is still being
+                                   executed (0 to disable)
+        :param long_poll: the maximum time in seconds for which the build
+                          master should hold a request for a build open until
+                          a build is queued, if it supports doing so (0 to
+                          disable)
+        :param max_concurrent_builds: the maximum number of builds to execute
+                                      at the same time, each in a separate
+                                      thread and build directory
+        :param max_parallel_steps: the maximum number of steps of a build to
+                                   execute at the same time, if the recipe
+                                   declares them as independent of each other
+        :param stream_logs: whether the log output of a build step should be
+                            sent to the build master while the step is being
+                            executed, if it supports receiving it
         """
         self.urls = urls
         self.local = len(urls) == 1 and not urls[0].startswith('http://') \
@@ -128,7 +358,27 @@ class BuildSlave(object):
         self.no_loop = no_loop
         self.poll_interval = poll_interval
         self.dump_reports = dump_reports
+        self.heartbeat_interval = heartbeat_interval
+        self.long_poll = long_poll
+        self._long_polled = False
+        if self.local or single_build:
+            max_concurrent_builds = 1
+        elif max_concurrent_builds > 1 and '${build}' not in build_dir:
+            # Concurrent builds of the same configuration would otherwise
+            # share a directory
+            log.warning('Adding the build number to the build dir pattern '
+                        '%r', build_dir)
+            self.build_dir = build_dir + '_${build}'
+        self.max_concurrent_builds = max(1, max_concurrent_builds)
+        self.max_parallel_steps = max(1, max_parallel_steps)
+        self.stream_logs = stream_logs
+        self._workers = []
+        self._workers_changed = threading.Condition()
+        self._worker_exit_code = None
         self.cookiejar = cookielib.CookieJar()
+        # Every build may have a request and a heartbeat in flight
+        self.connections = _ConnectionPool(2 * self.max_concurrent_builds)
+        self._opener = None
         self.username = username \
                         or self.config['authentication.username'] or ''
 
@@ -147,11 +397,20 @@ class BuildSlave(object):
                 self.auth_map = dict(map(lambda x: (x, False), urls))
 
     def _get_opener(self):
-        opener = urllib2.build_opener(urllib2.HTTPErrorProcessor())
-        opener.add_handler(urllib2.HTTPBasicAuthHandler(self.password_mgr))
-        opener.add_handler(urllib2.HTTPDigestAuthHandler(self.password_mgr))
-        opener.add_handler(urllib2.HTTPCookieProcessor(self.cookiejar))
-        return opener
+        # The opener is created once, so that the connections to the build
+        # masters are kept open and reused for all requests
+        if self._opener is None:
+            handlers = [urllib2.HTTPErrorProcessor(),
+                        _KeepAliveHTTPHandler(self.connections)]
+            if _KeepAliveHTTPSHandler is not None:
+                handlers.append(_KeepAliveHTTPSHandler(self.connections))
+            opener = urllib2.build_opener(*handlers)
+            opener.add_handler(urllib2.HTTPBasicAuthHandler(self.password_mgr))
+            opener.add_handler(urllib2.HTTPDigestAuthHandler(
+                                                        self.password_mgr))
+            opener.add_handler(urllib2.HTTPCookieProcessor(self.cookiejar))
+            self._opener = opener
+        return self._opener
     opener = property(_get_opener)
 
     def request(self, method, url, body=None, headers=None):
@@ -219,6 +478,7 @@ class BuildSlave(object):
                     else:
                         log.debug('Authentication not provided. Attempting to '
                                   'execute build anonymously.')
+                    self._wait_for_worker_slot()
                     job_done = self._create_build(url)
                     if job_done:
                         continue
@@ -236,17 +496,25 @@ class BuildSlave(object):
                         log.error(e)
                         raise ExitSlave(EX_UNAVAILABLE)
             except ExitSlave, e:
+                self._join_workers()
+                self.connections.close()
                 return e.exit_code
             if self.no_loop:
                 break
-            time.sleep(self.poll_interval)
+            if not self._long_polled:
+                time.sleep(self.poll_interval)
+        self._join_workers()
+        self.connections.close()
+        if self._worker_exit_code is not None:
+            return self._worker_exit_code
 
     def quit(self):
         log.info('Shutting down')
         raise ExitSlave(EX_OK)
 
     def _create_build(self, url):
-        xml = xmlio.Element('slave', name=self.name, version=PROTOCOL_VERSION)[
+        xml = xmlio.Element('slave', name=self.name, version=PROTOCOL_VERSION,
+                            wait=self.long_poll or None)[
             xmlio.Element('platform', processor=self.config['processor'])[
                 self.config['machine']
             ],
@@ -267,8 +535,11 @@ class BuildSlave(object):
             'Content-Type': 'application/x-bitten+xml'
         })
 
+        # The master only sends this header if it held the request open for a
+        # while, in which case it can be asked again right away
+        self._long_polled = 'x-bitten-wait' in resp.info()
         if resp.code == 201:
-            self._initiate_build(resp.info().get('location'))
+            self._start_build(resp.info().get('location'))
             return True
         elif resp.code == 204:
             log.info('No pending builds')
@@ -277,11 +548,55 @@ class BuildSlave(object):
             log.error('Unexpected response (%d %s)', resp.code, resp.msg)
             raise ExitSlave(EX_PROTOCOL)
 
+    def _start_build(self, build_url):
+        if self.max_concurrent_builds == 1:
+            self._initiate_build(build_url)
+            return
+        worker = _BuildWorker(self, build_url)
+        self._workers_changed.acquire()
+        try:
+            self._workers.append(worker)
+        finally:
+            self._workers_changed.release()
+        worker.start()
+
+    def _worker_done(self, worker, exit_code=None):
+        self._workers_changed.acquire()
+        try:
+            self._workers.remove(worker)
+            if exit_code is not None and self._worker_exit_code is None:
+                self._worker_exit_code = exit_code
+            self._workers_changed.notifyAll()
+        finally:
+            self._workers_changed.release()
+
+    def _wait_for_worker_slot(self):
+        """Block until fewer than the maximum number of builds are being
+        executed, and stop the slave if one of them asked for that."""
+        self._workers_changed.acquire()
+        try:
+            while len(self._workers) >= self.max_concurrent_builds \
+                    and self._worker_exit_code is None:
+                # A timeout keeps the main thread responsive to interrupts
+                self._workers_changed.wait(1)
+            if self._worker_exit_code is not None:
+                raise ExitSlave(self._worker_exit_code)
+        finally:
+            self._workers_changed.release()
+
+    def _join_workers(self):
+        for worker in self._workers[:]:
+            worker.join()
+
     def _initiate_build(self, build_url):
         log.info('Build pending at %s', build_url)
         try:
-            resp = self.request('GET', build_url)
+            resp = self.request('GET', build_url, None, {
+                'Accept-Encoding': 'gzip'
+            })
             if resp.code == 200:
+                if resp.info().get('Content-Encoding') == 'gzip':
+                    resp = GzipReader(resp)
                 self._execute_build(build_url, resp)
             else:
                 log.error('Unexpected response (%d): %s', resp.code, resp.msg)
@@ -294,6 +609,10 @@ class BuildSlave(object):
         build_id = build_url and int(build_url.split('/')[-1]) or 0
         xml = xmlio.parse(fileobj)
         basedir = ''
+        heartbeat = None
+        if build_url and not self.local and self.heartbeat_interval:
+            heartbeat = _Heartbeat(self, build_url, self.heartbeat_interval)
+            heartbeat.start()
         try:
             recipe = Recipe(xml, os.path.join(self.work_dir, self.build_dir), 
                             self.config)
@@ -302,16 +621,15 @@ class BuildSlave(object):
             if not os.path.exists(basedir):
                 os.mkdir(basedir)
 
-            for step in recipe:
-                log.info('Executing build step %r', step.id)
-                if not self._execute_step(build_url, recipe, step):
-                    log.warning('Stopping build due to failure')
-                    break
-            else:
+            if self._execute_steps(build_url, recipe):
                 log.info('Build completed')
+            else:
+                log.warning('Build stopped due to failure')
             if self.dry_run:
                 self._cancel_build(build_url)
         finally:
+            if heartbeat:
+                heartbeat.stop()
             if not self.keep_files and os.path.isdir(basedir):
                 log.debug('Removing build directory %s' % basedir)
                 _rmtree(basedir)
@@ -319,17 +637,101 @@ class BuildSlave(object):
                 log.info('Exiting after single build completed.')
                 raise ExitSlave(EX_OK)
 
-    def _execute_step(self, build_url, recipe, step):
+    def _execute_steps(self, build_url, recipe):
+        """Execute the steps of a recipe once the steps they depend on have
+        been executed, running up to `max_parallel_steps` of them at the same
+        time.
+
+        Steps depending on a step that failed with ``onerror="fail"`` are not
+        executed. Returns whether all steps were executed.
+        """
+        pending = list(recipe)
+        executed = set()
+        stopped = set()
+        running = []
+        finished = []
+        finished_changed = threading.Condition()
+        errors = []
+
+        def execute(step, ctxt):
+            try:
+                try:
+                    result = self._execute_step(build_url, recipe, step, ctxt)
+                except Exception, e:
+                    errors.append(sys.exc_info())
+                    result = False
+            finally:
+                finished_changed.acquire()
+                try:
+                    finished.append((step, result))
+                    finished_changed.notify()
+                finally:
+                    finished_changed.release()
+
+        while pending or running:
+            for step in pending[:]:
+                if errors or len(running) >= self.max_parallel_steps:
+                    break
+                if [dep for dep in step.depends if dep in stopped]:
+                    log.warning('Skipping build step %r due to failure',
+                                step.id)
+                    stopped.add(step.id)
+                    pending.remove(step)
+                    continue
+                if [dep for dep in step.depends if dep not in executed]:
+                    continue
+                pending.remove(step)
+                log.info('Executing build step %r', step.id)
+                if self.max_parallel_steps == 1:
+                    # Steps are executed one at a time in the current thread
+                    finished.append((step, self._execute_step(build_url,
+                                                              recipe, step)))
+                    break
+                running.append(step)
+                thread = threading.Thread(target=execute,
+                                          args=(step, recipe.ctxt.copy()),
+                                          name='bitten-step-%s' % step.id)
+                thread.setDaemon(True)
+                thread.start()
+
+            finished_changed.acquire()
+            try:
+                while running and not finished:
+                    finished_changed.wait(1)
+                done, finished[:] = finished[:], []
+            finally:
+                finished_changed.release()
+            for step, result in done:
+                if step in running:
+                    running.remove(step)
+                executed.add(step.id)
+                if not result:
+                    stopped.add(step.id)
+            if errors and not running:
+                raise errors[0][0], errors[0][1], errors[0][2]
+            if not done and not running:
+                break
+
+        return not stopped and not pending
+
+    def _execute_step(self, build_url, recipe, step, ctxt=None):
         failed = False
         started = datetime.utcnow()
         xml = xmlio.Element('result', step=step.id, time=started.isoformat())
+        attachments = []
+        ctxt = ctxt or recipe.ctxt
+        if self.stream_logs and not self.local and not self.dry_run:
+            ctxt.log_listener = lambda generator, output: \
+                    self._send_log(build_url, step, generator, output)
         try:
-            for type, category, generator, output in \
-                    step.execute(recipe.ctxt):
+            for type, category, generator, output in step.execute(ctxt):
                 if type == Recipe.ERROR:
                     failed = True
                 if type == Recipe.REPORT and self.dump_reports:
                     print output
+                if type == Recipe.ATTACH:
+                    attachments.append(output)
+                    continue
                 xml.append(xmlio.Element(type, category=category,
                                          generator=generator)[
                     output
@@ -343,26 +745,126 @@ class BuildSlave(object):
         except Exception, e:
             log.error('Internal error in build step %r', step.id, exc_info=True)
             failed = True
-        xml.attr['duration'] = (datetime.utcnow() - started).seconds
+        ctxt.log_listener = None
+        duration = datetime.utcnow() - started
+        xml.attr['duration'] = '%.3f' % (duration.days * 86400 +
+                                         duration.seconds +
+                                         duration.microseconds / 1e6)
         if failed:
             xml.attr['status'] = 'failure'
         else:
             xml.attr['status'] = 'success'
             log.info('Build step %s completed successfully', step.id)
 
-        if not self.local and not self.dry_run:
+        # Files that were only written to be attached, such as the complete
+        # output of commands, are removed once they have been sent
+        temporary = [file_elem.attr['path'] for file_elem in attachments
+                     if file_elem.attr.pop('temporary', None)]
+        try:
+            if not self.local and not self.dry_run:
+                try:
+                    # Attachments are uploaded before the step result, as the
+                    # build may be completed by the latter
+                    for file_elem in attachments:
+                        if not self._upload_attachment(build_url, file_elem):
+                            xml.append(xmlio.Element(Recipe.ATTACH)[file_elem])
+                    # Build masters speaking this protocol version accept gzip
+                    # encoded step results, which are mostly log output
+                    resp = self.request('POST', build_url + '/steps/',
+                                        gzip(str(xml)), {
+                        'Content-Type': 'application/x-bitten+xml',
+                        'Content-Encoding': 'gzip'
+                    })
+                    if resp.code != 201:
+                        log.error('Unexpected response (%d): %s', resp.code,
+                                  resp.msg)
+                except KeyboardInterrupt:
+                    log.warning('Build interrupted')
+                    self._cancel_build(build_url)
+        finally:
+            for path in temporary:
+                try:
+                    os.remove(path)
+                except OSError, e:
+                    log.warning('Could not remove %s: %s', path, e)
+
+        return not failed or step.onerror != 'fail'
+
+    def _send_log(self, build_url, step, generator, output):
+        """Send log output of a build step that is still being executed to
+        the build master.
+
+        Returns `False` if the log output could not be delivered, in which
+        case it is to be included in the step result. If the build master
+        does not support receiving logs separately, no further attempts are
+        made.
+        """
+        if not self.stream_logs or not output.children:
+            return False
+        xml = xmlio.Element('log', step=step.id, generator=generator)[output]
+        try:
+            resp = self.request('POST', build_url + '/logs/', gzip(str(xml)), {
+                'Content-Type': 'application/x-bitten+xml',
+                'Content-Encoding': 'gzip'
+            })
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                log.debug('Build master does not accept build logs, sending '
+                          'them with the step results')
+                self.stream_logs = False
+            else:
+                log.warning('Failed to send the log of build step %r: %s',
+                            step.id, e)
+            return False
+        except urllib2.URLError, e:
+            log.warning('Failed to send the log of build step %r: %s',
+                        step.id, e)
+            return False
+        if resp.code != 201:
+            log.error('Unexpected response (%d): %s', resp.code, resp.msg)
+            return False
+        return True
+
+    def _upload_attachment(self, build_url, file_elem):
+        """Send an attached file to the build master, reading it from disk
+        while it is transmitted.
+
+        Returns `False` if the file could not be uploaded, for example because
+        the build master does not support attachment uploads, in which case
+        the content of the file has been included in `file_elem` instead.
+        """
+        path = file_elem.attr.pop('path')
+        query = urllib.urlencode(dict([(name, value.encode('utf-8'))
+                                       for name, value
+                                       in file_elem.attr.items()]))
+        fileobj = open(path, 'rb')
+        try:
             try:
-                resp = self.request('POST', build_url + '/steps/', str(xml), {
-                    'Content-Type': 'application/x-bitten+xml'
+                resp = self.request('POST',
+                                    build_url + '/attachments/?' + query,
+                                    fileobj, {
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Length': str(os.fstat(fileobj.fileno()).st_size)
                 })
                 if resp.code != 201:
                     log.error('Unexpected response (%d): %s', resp.code,
                               resp.msg)
-            except KeyboardInterrupt:
-                log.warning('Build interrupted')
-                self._cancel_build(build_url)
-
-        return not failed or step.onerror != 'fail'
+                return True
+            except urllib2.HTTPError, e:
+                if e.code == 404:
+                    log.debug('Build master does not accept attachment '
+                              'uploads, sending %s with the step result', path)
+                else:
+                    log.warning('Failed to upload %s (%s), sending it with the '
+                                'step result', path, e)
+            except urllib2.URLError, e:
+                log.warning('Failed to upload %s (%s), sending it with the '
+                            'step result', path, e)
+            fileobj.seek(0)
+            file_elem.append(fileobj.read().encode('base64'))
+            return False
+        finally:
+            fileobj.close()
 
     def _cancel_build(self, build_url, exit_code=EX_OK):
         log.info('Cancelling build at %s', build_url)
@@ -373,6 +875,69 @@ class BuildSlave(object):
         raise ExitSlave(exit_code)
 
 
+class _Heartbeat(threading.Thread):
+    """Thread that periodically notifies the build master that the slave is
+    still executing a build, so that long-running steps are not mistaken for
+    an orphaned build.
+    """
+
+    def __init__(self, slave, build_url, interval):
+        threading.Thread.__init__(self, name='bitten-heartbeat')
+        self.setDaemon(True)
+        self.slave = slave
+        self.url = build_url + '/heartbeat/'
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                break
+            try:
+                self.slave.request('POST', self.url, '', {
+                    'Content-Length': '0'
+                })
+            except urllib2.HTTPError, e:
+                # The build has been invalidated, or the master does not
+                # support heartbeats
+                log.warning('Stopping heartbeat: %s', e)
+                break
+            except (urllib2.URLError, socket.error), e:
+                log.warning('Heartbeat failed: %s', e)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class _BuildWorker(threading.Thread):
+    """Thread that executes one of several concurrent builds of a slave.
+
+    The build commands themselves run in child processes, so the workers
+    mostly wait for those, and share the HTTP connections of the slave.
+    """
+
+    def __init__(self, slave, build_url):
+        threading.Thread.__init__(self, name='bitten-build-%s'
+                                             % build_url.split('/')[-1])
+        self.setDaemon(True)
+        self.slave = slave
+        self.build_url = build_url
+
+    def run(self):
+        exit_code = None
+        try:
+            try:
+                self.slave._initiate_build(self.build_url)
+            except ExitSlave, e:
+                exit_code = e.exit_code
+            except Exception, e:
+                log.error('Internal error in build %s', self.build_url,
+                          exc_info=True)
+        finally:
+            self.slave._worker_done(self, exit_code)
+
+
 class ExitSlave(Exception):
     """Exception used internally by the slave to signal that the slave process
     should be stopped.
@@ -428,6 +993,27 @@ def main():
                      help='don\'t report results back to master')
     group.add_option('-i', '--interval', dest='interval', metavar='SECONDS',
                      type='int', help='time to wait between requesting builds')
+    group.add_option('--heartbeat', dest='heartbeat', metavar='SECONDS',
+                     type='int', help='time between notifying the master that '
+                                      'a build is still running (0 to '
+                                      'disable) [%default]')
+    group.add_option('--long-poll', dest='long_poll', metavar='SECONDS',
+                     type='int', help='time for which the master may wait '
+                                      'for a build to be queued before '
+                                      'answering a request for a build (0 '
+                                      'to disable) [%default]')
+    group.add_option('-j', '--max-concurrent-builds', dest='max_builds',
+                     metavar='N', type='int',
+                     help='number of builds to execute at the same time, '
+                          'each in its own build dir [%default]')
+    group.add_option('--parallel-steps', dest='parallel_steps', metavar='N',
+                     type='int',
+                     help='number of independent build steps to execute at '
+                          'the same time [%default]')
+    group.add_option('--no-stream-logs', action='store_false',
+                     dest='stream_logs',
+                     help='send the log of a build step only along with its '
+                          'result, not while the step is executed')
     group = parser.add_option_group('logging')
     group.add_option('-l', '--log', dest='logfile', metavar='FILENAME',
                      help='write log messages to FILENAME')
@@ -440,7 +1026,9 @@ def main():
 
     parser.set_defaults(dry_run=False, keep_files=False,
                         loglevel=logging.INFO, single_build=False, no_loop=False,
-                        dump_reports=False, interval=300, form_auth=False)
+                        dump_reports=False, interval=300, form_auth=False,
+                        heartbeat=60, long_poll=60, max_builds=1,
+                        parallel_steps=4, stream_logs=True)
     options, args = parser.parse_args()
 
     if len(args) < 1:
@@ -476,7 +1064,12 @@ def main():
                        poll_interval=options.interval,
                        username=options.username, password=options.password,
                        dump_reports=options.dump_reports,
-                       form_auth=options.form_auth)
+                       form_auth=options.form_auth,
+                       heartbeat_interval=options.heartbeat,
+                       long_poll=options.long_poll,
+                       max_concurrent_builds=options.max_builds,
+                       max_parallel_steps=options.parallel_steps,
+                       stream_logs=options.stream_logs)
         try:
             exit_code = slave.run()
         except KeyboardInterrupt:
@@ -14,19 +14,35 @@ import shutil
 from StringIO import StringIO
 import tempfile
 import unittest
+import urllib
 from Cookie import SimpleCookie as Cookie
 
 from trac.db import DatabaseManager
 from trac.perm import PermissionCache, PermissionSystem
 from trac.test import EnvironmentStub, Mock
 from trac.util.datefmt import to_datetime, utc
-from trac.web.api import RequestDone
+from trac.web.api import Request, RequestDone
 from trac.web.href import Href
 
-from bitten.master import BuildMaster
+from bitten.master import BuildMaster, BuildQueueScheduler
+from bitten.queue import BuildQueue
 from bitten.model import BuildConfig, TargetPlatform, Build, BuildStep, \
                          BuildLog, Report, schema
 from bitten import PROTOCOL_VERSION
+from bitten.util.compress import GzipReader, gzip
+
+
+def _request_body(body):
+    """Return a `read` function for the body of a request that fails when
+    asked for data beyond the end of the body, like the input stream of a
+    server would block waiting for it."""
+    fileobj = StringIO(body)
+    def read(size=-1):
+        if size < 0 or size > len(body) - fileobj.tell():
+            raise AssertionError('Read beyond the end of the request body')
+        return fileobj.read(size)
+    return read
+
 
 class BuildMasterTestCase(unittest.TestCase):
 
@@ -106,6 +122,73 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEqual(Build.IN_PROGRESS, build.status)
         self.assertEqual('hal', build.slave)
 
+    def test_create_build_populated_in_background(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name="Unix")
+        platform.rules.append(('family', 'posix'))
+        platform.insert()
+
+        self.repos = Mock(
+            get_node=lambda path, rev=None: Mock(
+                get_entries=lambda: [Mock(), Mock()],
+                get_history=lambda: [('somepath', 123, 'edit')]
+            ),
+            get_changeset=lambda rev: Mock(date=to_datetime(42, utc)),
+            normalize_path=lambda path: path,
+            rev_older_than=lambda rev1, rev2: rev1 < rev2
+        )
+        self.env.config.set('bitten', 'populate_interval', '60')
+        scheduler = BuildQueueScheduler(self.env)
+        started = []
+        scheduler.start = lambda: started.append(True)
+
+        def _create_build():
+            inbody = StringIO("""<slave name="hal" version="%d">
+  <os family="posix" version="8.1.0">Darwin</os>
+</slave>""" % PROTOCOL_VERSION)
+            outheaders = {}
+            req = Mock(method='POST', base_path='', path_info='/builds',
+                       href=Href('/trac'),
+                       abs_href=Href('http://example.org/trac'),
+                       remote_addr='127.0.0.1', args={},
+                       perm=PermissionCache(self.env, 'hal'),
+                       get_header=lambda x: None, read=inbody.read,
+                       send_response=lambda x: outheaders.setdefault('Status',
+                                                                     x),
+                       send_header=lambda x, y: outheaders.setdefault(x, y),
+                       write=StringIO().write,
+                       incookie=Cookie('trac_auth='))
+            module = BuildMaster(self.env)
+            assert module.match_request(req)
+            self.assertRaises(RequestDone, module.process_request, req)
+            return outheaders['Status']
+
+        # The slave request itself does not populate the queue
+        self.assertEqual(204, _create_build())
+        self.assertEqual([True], started)
+
+        scheduler.populate()
+        self.assertEqual(201, _create_build())
+
+    def test_changeset_added(self):
+        scheduler = BuildQueueScheduler(self.env)
+        populated = []
+        scheduler.populate = lambda: populated.append(True)
+
+        # Without background population, slave requests populate the queue
+        scheduler.changeset_added(self.repos, Mock(rev=123))
+        self.assertEqual([], populated)
+
+        # Slaves waiting in a long poll only see builds in the queue
+        self.env.config.set('bitten', 'long_poll_timeout', '60')
+        scheduler.changeset_added(self.repos, Mock(rev=123))
+        self.assertEqual([True], populated)
+
+        self.env.config.set('bitten', 'long_poll_timeout', '0')
+        self.env.config.set('bitten', 'populate_interval', '60')
+        scheduler.changeset_added(self.repos, Mock(rev=123))
+        self.assertEqual([True, True], populated)
+
     def test_create_build_invalid_xml(self):
         inheaders = {'Content-Type': 'application/x-bitten+xml'}
         inbody = StringIO('<slave></salve>')
@@ -173,6 +256,42 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEqual(204, outheaders['Status'])
         self.assertEqual('', outbody.getvalue())
 
+    def test_create_build_long_poll(self):
+        self.env.config.set('bitten', 'long_poll_timeout', '30')
+        inheaders = {'Content-Type': 'application/x-bitten+xml'}
+        inbody = StringIO("""<slave name="hal" version="%d" wait="120">
+  <platform>Power Macintosh</platform>
+  <os family="posix" version="8.1.0">Darwin</os>
+</slave>""" % PROTOCOL_VERSION)
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='', path_info='/builds',
+                   href=Href('/trac'), remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x), read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth='))
+
+        waits = []
+        def wait_for_build(self, name, properties, timeout):
+            waits.append((name, timeout))
+        original = BuildQueue.__dict__['wait_for_build']
+        BuildQueue.wait_for_build = wait_for_build
+        try:
+            module = BuildMaster(self.env)
+            assert module.match_request(req)
+
+            self.assertRaises(RequestDone, module.process_request, req)
+        finally:
+            BuildQueue.wait_for_build = original
+
+        self.assertEqual([('hal', 30)], waits)
+        self.assertEqual(204, outheaders['Status'])
+        self.assertEqual('30', outheaders['X-Bitten-Wait'])
+        self.assertEqual('', outbody.getvalue())
+
     def test_create_build_protocol_wrong_version(self):
         inheaders = {'Content-Type': 'application/x-bitten+xml'}
         inbody = StringIO("""<slave name="hal" version="%d">
@@ -277,6 +396,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    path_info='/builds/%d' % build.id,
                    href=Href('/trac'), remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: None,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -302,6 +422,44 @@ class BuildMasterTestCase(unittest.TestCase):
         build = Build.fetch(self.env, build.id)
         assert build.started
 
+    def test_initiate_build_gzip(self):
+        config = BuildConfig(self.env, 'test', path='somepath', active=True,
+                             recipe='<build></build>')
+        config.insert()
+        platform = TargetPlatform(self.env, config='test', name="Unix")
+        platform.rules.append(('family', 'posix'))
+        platform.insert()
+        build = Build(self.env, 'test', '123', platform.id, slave='hal',
+                      rev_time=42)
+        build.insert()
+
+        inheaders = {'Accept-Encoding': 'gzip, deflate'}
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='GET', base_path='',
+                   path_info='/builds/%d' % build.id,
+                   href=Href('/trac'), remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x),
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth='))
+
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(200, outheaders['Status'])
+        self.assertEqual('gzip', outheaders['Content-Encoding'])
+        self.assertEqual(str(len(outbody.getvalue())),
+                         outheaders['Content-Length'])
+        self.assertEqual('<build build="1" config="test" name="hal"'
+                         ' path="somepath" platform="Unix"'
+                         ' revision="123"/>',
+                         GzipReader(StringIO(outbody.getvalue())).read())
+
     def test_initiate_build_no_such_build(self):
         outheaders = {}
         outbody = StringIO()
@@ -347,6 +505,59 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEqual(404, outheaders['Status'])
         self.assertEqual("No such collection 'files'", outbody.getvalue())
 
+    def test_process_heartbeat(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.insert()
+
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/heartbeat/' % build.id,
+                   href=Href('/trac'), remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth='))
+
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(204, outheaders['Status'])
+        build = Build.fetch(self.env, build.id)
+        assert build.last_activity > 42
+
+    def test_process_heartbeat_invalidated_build(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      status=Build.PENDING)
+        build.insert()
+
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/heartbeat' % build.id,
+                   href=Href('/trac'), remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth='))
+
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(409, outheaders['Status'])
+        self.assertEqual(0, Build.fetch(self.env, build.id).last_activity)
+
     def test_process_build_step_success(self):
         recipe = """<build>
   <step id="foo">
@@ -370,7 +581,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -395,6 +606,12 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEqual('foo', steps[0].name)
         self.assertEqual(BuildStep.SUCCESS, steps[0].status)
 
+        # The duration is rounded to whole seconds
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT started,stopped FROM bitten_step")
+        started, stopped = cursor.fetchone()
+        self.assertEqual((int, 3), (type(stopped), stopped - started))
+
     def test_process_build_step_success_with_log(self):
         recipe = """<build>
   <step id="foo">
@@ -422,7 +639,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -455,6 +672,123 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEqual((u'info', u'Doing stuff'), logs[0].messages[0])
         self.assertEqual((u'error', u'Ouch that hurt'), logs[0].messages[1])
 
+    def test_process_build_step_gzip(self):
+        recipe = """<build>
+  <step id="foo">
+  </step>
+</build>"""
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe=recipe).insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        inbody = StringIO(gzip("""<result step="foo" status="success"
+                                          time="2007-04-01T15:30:00.0000"
+                                          duration="3.45">
+    <log generator="http://bitten.edgewall.org/tools/python#unittest">
+        %s
+    </log>
+</result>""" % ''.join(['<message level="info">Line %d</message>' % idx
+                        for idx in range(1000)])))
+        inheaders = {'Content-Encoding': 'gzip',
+                     'Content-Length': str(len(inbody.getvalue()))}
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x), read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(201, outheaders['Status'])
+        self.assertEqual('Build step processed', outbody.getvalue())
+
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual(1, len(logs))
+        self.assertEqual(1000, len(logs[0].messages))
+        self.assertEqual((u'info', u'Line 999'), logs[0].messages[999])
+
+    def test_process_build_step_content_length(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build><step id="foo"/></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        inbody = """<result step="foo" status="success"
+                            time="2007-04-01T15:30:00.0000" duration="3.45">
+    <log generator="http://bitten.edgewall.org/tools/python#unittest">
+        %s
+    </log>
+</result>""" % ''.join(['<message level="info">Line %d</message>' % idx
+                        for idx in range(1000)])
+        inheaders = {'Content-Length': str(len(inbody))}
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x),
+                   read=_request_body(inbody),
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(201, outheaders['Status'])
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual(1000, len(logs[0].messages))
+
+    def test_process_build_step_unsupported_encoding(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build><step id="foo"></step></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        inbody = StringIO('<result step="foo" status="success"/>')
+        inheaders = {'Content-Encoding': 'compress'}
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x), read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(415, outheaders['Status'])
+        self.assertEqual('Unsupported content encoding compress',
+                         outbody.getvalue())
+        self.assertEqual([], list(BuildStep.select(self.env, build.id)))
+
     def test_process_build_step_success_with_report(self):
         recipe = """<build>
   <step id="foo">
@@ -484,7 +818,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -522,6 +856,104 @@ class BuildMasterTestCase(unittest.TestCase):
             'type': 'test',
         }, reports[0].items[0])
 
+    def test_process_build_step_success_with_large_report(self):
+        recipe = """<build>
+  <step id="foo">
+  </step>
+</build>"""
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe=recipe).insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        tests = ''.join(['<test name="test%d" status="success"/>' % idx
+                         for idx in range(2500)])
+        inbody = StringIO("""<result step="foo" status="success"
+                                     time="2007-04-01T15:30:00.0000"
+                                     duration="3.45">
+    <log generator="http://bitten.edgewall.org/tools/python#unittest">
+        <message level="info">Ran 2500 tests</message>
+    </log>
+    <report category="test"
+            generator="http://bitten.edgewall.org/tools/python#unittest">
+        %s
+    </report>
+    <log generator="http://bitten.edgewall.org/tools/sh#exec">
+        <message level="info">Done</message>
+    </log>
+</result>""" % tests)
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: None, read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(201, outheaders['Status'])
+
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual(2, len(logs))
+        self.assertEqual([('info', 'Ran 2500 tests')], logs[0].messages)
+        self.assertEqual([('info', 'Done')], logs[1].messages)
+
+        reports = list(Report.select(self.env, build=build.id, step='foo'))
+        self.assertEqual(1, len(reports))
+        self.assertEqual(2500, len(reports[0].items))
+        self.assertEqual({'type': 'test', 'name': 'test2499',
+                          'status': 'success'}, reports[0].items[-1])
+
+    def test_process_build_step_truncated_xml(self):
+        recipe = """<build>
+  <step id="foo">
+  </step>
+</build>"""
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe=recipe).insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        tests = ''.join(['<test name="test%d" status="success"/>' % idx
+                         for idx in range(2500)])
+        inbody = StringIO("""<result step="foo" status="success"
+                                     time="2007-04-01T15:30:00.0000"
+                                     duration="3.45">
+    <report category="test" generator="unittest">%s""" % tests)
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: None, read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEquals(400, outheaders['Status'])
+        self.assertEquals('XML parser error', outbody.getvalue())
+        self.assertEqual([], list(BuildStep.select(self.env, build.id)))
+        self.assertEqual([], list(Report.select(self.env, build=build.id)))
+
     def test_process_build_step_success_with_attach(self):
         # Parse input and create attachments for config + build
         recipe = """<build>
@@ -557,7 +989,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    remote_addr='127.0.0.1', args={},
                    authname='hal',
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -600,6 +1032,278 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEquals('hello baz',
                         config_attachments[0].open().read())
 
+    def test_process_attachment(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        from trac.attachment import Attachment
+        for resource, parent_id in [(None, 'test/1'), ('config', 'test')]:
+            inbody = StringIO('hello bar')
+            outheaders = {}
+            outbody = StringIO()
+            req = Mock(method='POST', base_path='',
+                       path_info='/builds/%d/attachments/' % build.id,
+                       href=Href('/trac'),
+                       abs_href=Href('http://example.org/trac'),
+                       remote_addr='127.0.0.1', args={},
+                       query_string=urllib.urlencode([
+                           ('filename', 'bar.txt'),
+                           ('description', 'bar bar'),
+                           ('resource', resource or '')]),
+                       authname='hal',
+                       perm=PermissionCache(self.env, 'hal'),
+                       get_header=lambda x: {'Content-Length': '9'}.get(x),
+                       read=inbody.read,
+                       send_response=lambda x: outheaders.setdefault('Status',
+                                                                     x),
+                       send_header=lambda x, y: outheaders.setdefault(x, y),
+                       write=outbody.write,
+                       incookie=Cookie('trac_auth=123'))
+            module = BuildMaster(self.env)
+            assert module.match_request(req)
+
+            self.assertRaises(RequestDone, module.process_request, req)
+
+            self.assertEqual(201, outheaders['Status'])
+            self.assertEqual('Attachment stored', outbody.getvalue())
+
+            attachments = list(Attachment.select(self.env, 'build', parent_id))
+            self.assertEquals(1, len(attachments))
+            self.assertEquals('hal', attachments[0].author)
+            self.assertEquals('bar bar', attachments[0].description)
+            self.assertEquals('bar.txt', attachments[0].filename)
+            self.assertEquals('hello bar', attachments[0].open().read())
+
+        self.assertEqual(Build.IN_PROGRESS,
+                         Build.fetch(self.env, build.id).status)
+
+    def test_process_attachment_query_string(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        # Trac itself ignores the query string of POST requests
+        status = []
+        environ = {'REQUEST_METHOD': 'POST', 'SCRIPT_NAME': '/trac',
+                   'PATH_INFO': '/builds/%d/attachments/' % build.id,
+                   'QUERY_STRING': 'filename=bar.txt&description=bar+bar',
+                   'CONTENT_TYPE': 'application/octet-stream',
+                   'CONTENT_LENGTH': '9', 'HTTP_COOKIE': 'trac_auth=123',
+                   'SERVER_NAME': 'example.org', 'SERVER_PORT': '80',
+                   'REMOTE_ADDR': '127.0.0.1', 'wsgi.url_scheme': 'http',
+                   'wsgi.input': StringIO('hello bar')}
+        req = Request(environ, lambda code, headers: status.append(code) or
+                                                     StringIO().write)
+        req.perm = PermissionCache(self.env, 'hal')
+        req.authname = 'hal'
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(['201 Created'], status)
+        from trac.attachment import Attachment
+        attachment = Attachment(self.env, 'build', 'test/%d' % build.id,
+                                'bar.txt')
+        self.assertEqual('bar bar', attachment.description)
+        self.assertEqual('hello bar', attachment.open().read())
+
+    def test_process_attachment_content_length(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        content = 'hello bar ' * 5000
+        outheaders = {}
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/attachments/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   query_string='filename=bar.txt',
+                   authname='hal', perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: {'Content-Length':
+                                         str(len(content))}.get(x),
+                   read=_request_body(content),
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=StringIO().write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(201, outheaders['Status'])
+        from trac.attachment import Attachment
+        attachment = Attachment(self.env, 'build', 'test/%d' % build.id,
+                                'bar.txt')
+        self.assertEqual(content, attachment.open().read())
+
+    def test_process_attachment_invalidated_build(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      status=Build.PENDING)
+        build.insert()
+
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/attachments/' % build.id,
+                   href=Href('/trac'), remote_addr='127.0.0.1',
+                   args={}, query_string='filename=bar.txt', authname='hal',
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: {'Content-Length': '9'}.get(x),
+                   read=StringIO('hello bar').read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth='))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(409, outheaders['Status'])
+        from trac.attachment import Attachment
+        self.assertEqual([], list(Attachment.select(self.env, 'build',
+                                                    'test/%d' % build.id)))
+
+    def _post_build_log(self, build, stepname, messages):
+        inbody = StringIO("""<log step="%s" generator="http://bitten.edgewall.org/tools/sh#exec">
+%s
+</log>""" % (stepname, ''.join(['<message level="info">%s</message>' % message
+                                for message in messages])))
+        outheaders = {}
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/logs/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: None, read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=StringIO().write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+        self.assertRaises(RequestDone, module.process_request, req)
+        return outheaders['Status']
+
+    def test_process_build_log(self):
+        recipe = """<build>
+  <step id="foo">
+  </step>
+</build>"""
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe=recipe).insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        self.assertEqual(201, self._post_build_log(build, 'foo', ['1', '2']))
+        self.assertEqual(201, self._post_build_log(build, 'foo', ['3']))
+        self.assertEqual(Build.IN_PROGRESS,
+                         Build.fetch(self.env, build.id).status)
+        self.assertEqual([], list(BuildStep.select(self.env, build.id)))
+
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual([0, 1], [log.orderno for log in logs])
+        self.assertEqual([(u'info', u'1'), (u'info', u'2')], logs[0].messages)
+        self.assertEqual([(u'info', u'3')], logs[1].messages)
+
+        # The logs of the step result follow the ones sent before
+        inbody = StringIO("""<result step="foo" status="success"
+                                     time="2007-04-01T15:30:00.0000"
+                                     duration="3.45">
+    <log generator="http://bitten.edgewall.org/tools/sh#exec">
+        <message level="info">4</message>
+    </log>
+</result>""")
+        outheaders = {}
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: None, read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=StringIO().write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(201, outheaders['Status'])
+
+        self.assertEqual(Build.SUCCESS, Build.fetch(self.env, build.id).status)
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual([0, 1, 2], [log.orderno for log in logs])
+        self.assertEqual([(u'info', u'4')], logs[2].messages)
+
+        # No more log output is accepted once the step is completed
+        build.status = Build.IN_PROGRESS
+        build.update()
+        self.assertEqual(409, self._post_build_log(build, 'foo', ['5']))
+
+    def test_process_build_log_unknown_step(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build><step id="foo"/></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        self.assertEqual(403, self._post_build_log(build, 'bar', ['1']))
+        self.assertEqual([], list(BuildLog.select(self.env, build=build.id)))
+
+    def test_process_build_log_invalidated_build(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build><step id="foo"/></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      status=Build.PENDING)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        self.assertEqual(409, self._post_build_log(build, 'foo', ['1']))
+        self.assertEqual([], list(BuildLog.select(self.env, build=build.id)))
+
+    def test_cancel_build_with_log(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build><step id="foo"/></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+        self.assertEqual(201, self._post_build_log(build, 'foo', ['1']))
+
+        outheaders = {}
+        req = Mock(method='DELETE', base_path='',
+                   path_info='/builds/%d' % build.id,
+                   href=Href('/trac'), remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=StringIO().write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(204, outheaders['Status'])
+        self.assertEqual([], list(BuildLog.select(self.env, build=build.id)))
+
     def test_process_build_step_wrong_slave(self):
         recipe = """<build>
   <step id="foo">
@@ -627,7 +1331,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -677,7 +1381,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -716,7 +1420,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -756,7 +1460,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -805,7 +1509,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -830,6 +1534,80 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEqual('foo', steps[0].name)
         self.assertEqual(BuildStep.FAILURE, steps[0].status)
 
+    def _post_build_step(self, build, stepname, status):
+        inbody = StringIO("""<result step="%s" status="%s"
+                                     time="2007-04-01T15:30:00.0000"
+                                     duration="3.45">
+</result>""" % (stepname, status))
+        outheaders = {}
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: None, read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=StringIO().write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(201, outheaders['Status'])
+        return Build.fetch(self.env, build.id)
+
+    def test_process_build_step_out_of_order(self):
+        recipe = """<build>
+  <step id="foo">
+  </step>
+  <step id="bar" depends="">
+  </step>
+</build>"""
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe=recipe).insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        build = self._post_build_step(build, 'bar', 'success')
+        self.assertEqual(Build.IN_PROGRESS, build.status)
+        self.assertEqual(0, build.stopped)
+
+        build = self._post_build_step(build, 'foo', 'success')
+        self.assertEqual(Build.SUCCESS, build.status)
+        assert build.stopped > build.started
+
+        # Steps are listed in the order of the recipe
+        steps = list(BuildStep.select(self.env, build.id))
+        self.assertEqual(['foo', 'bar'], [step.name for step in steps])
+        self.assertEqual([0, 1], [step.orderno for step in steps])
+
+    def test_process_build_step_failure_out_of_order(self):
+        recipe = """<build>
+  <step id="foo">
+  </step>
+  <step id="bar">
+  </step>
+  <step id="baz" depends="">
+  </step>
+</build>"""
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe=recipe).insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        build = self._post_build_step(build, 'foo', 'failure')
+        self.assertEqual(Build.IN_PROGRESS, build.status)
+
+        # The build is completed without a result for "bar", which depends on
+        # the failed step
+        build = self._post_build_step(build, 'baz', 'success')
+        self.assertEqual(Build.FAILURE, build.status)
+        assert build.stopped > build.started
+
     def test_process_build_step_invalid_xml(self):
         recipe = """<build>
   <step id="foo">
@@ -848,7 +1626,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    path_info='/builds/%d/steps/' % build.id,
                    href=Href('/trac'), remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -884,7 +1662,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    path_info='/builds/%d/steps/' % build.id,
                    href=Href('/trac'), remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
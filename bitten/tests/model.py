@@ -315,6 +315,79 @@ class BuildTestCase(BaseModelTestCase):
         build.status = Build.FAILURE
         build.update()
 
+    def test_claim(self):
+        build = Build(self.env, config='test', rev='42', rev_time=12039,
+                      platform=1)
+        build.insert()
+
+        self.assertEqual(True, build.claim('tehbox',
+                                           {Build.IP_ADDRESS: '127.0.0.1'}))
+        self.assertEqual(Build.IN_PROGRESS, build.status)
+
+        build = Build.fetch(self.env, build.id)
+        self.assertEqual('tehbox', build.slave)
+        self.assertEqual(Build.IN_PROGRESS, build.status)
+        self.assertEqual({Build.IP_ADDRESS: '127.0.0.1'}, build.slave_info)
+
+    def test_claim_already_claimed(self):
+        build = Build(self.env, config='test', rev='42', rev_time=12039,
+                      platform=1)
+        build.insert()
+        stale = Build.fetch(self.env, build.id)
+
+        self.assertEqual(True, build.claim('tehbox'))
+        self.assertEqual(False, stale.claim('otherbox'))
+        self.assertEqual(Build.PENDING, stale.status)
+        self.assertEqual('tehbox', Build.fetch(self.env, build.id).slave)
+
+    def test_update_keeps_last_activity(self):
+        build = Build(self.env, config='test', rev='42', rev_time=12039,
+                      platform=1)
+        build.insert()
+        self.assertEqual(True, build.claim('tehbox'))
+        stale = Build.fetch(self.env, build.id)
+
+        build.touch()
+        stale.last_activity = 0 # Loaded before the last heartbeat
+        stale.started = 12345
+        stale.update()
+
+        build = Build.fetch(self.env, build.id)
+        self.assertEqual(12345, build.started)
+        assert build.last_activity > 0
+
+    def test_select(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        ids = []
+        for rev, rev_time, status in [('42', 12039, Build.SUCCESS),
+                                      ('43', 12040, Build.PENDING),
+                                      ('44', 12041, Build.SUCCESS)]:
+            cursor.execute("INSERT INTO bitten_build (config,rev,rev_time,"
+                           "platform,slave,started,stopped,status) "
+                           "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
+                           ('test', rev, rev_time, 1, 'tehbox', 15006, 16007,
+                            status))
+            ids.append(db.get_last_id(cursor, 'bitten_build'))
+        cursor.executemany("INSERT INTO bitten_slave VALUES (%s,%s,%s)",
+                           [(ids[0], Build.IP_ADDRESS, '127.0.0.1'),
+                            (ids[0], Build.MAINTAINER, 'joe@example.org'),
+                            (ids[2], Build.IP_ADDRESS, '127.0.0.2')])
+
+        builds = list(Build.select(self.env, config='test'))
+        self.assertEqual([ids[2], ids[1], ids[0]], [b.id for b in builds])
+        self.assertEqual({Build.IP_ADDRESS: '127.0.0.2'}, builds[0].slave_info)
+        self.assertEqual({}, builds[1].slave_info)
+        self.assertEqual({Build.IP_ADDRESS: '127.0.0.1',
+                          Build.MAINTAINER: 'joe@example.org'},
+                         builds[2].slave_info)
+        self.assertEqual('43', builds[1].rev)
+        self.assertEqual(12040, builds[1].rev_time)
+        self.assertEqual(15006, builds[1].started)
+
+        builds = list(Build.select(self.env, status=Build.SUCCESS))
+        self.assertEqual([ids[2], ids[0]], [b.id for b in builds])
+
 
 class BuildStepTestCase(BaseModelTestCase):
 
@@ -334,11 +407,19 @@ class BuildStepTestCase(BaseModelTestCase):
 
         db = self.env.get_db_cnx()
         cursor = db.cursor()
-        cursor.execute("SELECT build,name,description,status,started,stopped "
-                       "FROM bitten_step")
-        self.assertEqual((1, 'test', 'Foo bar', BuildStep.SUCCESS, 0, 0),
+        cursor.execute("SELECT build,name,description,status,started,stopped,"
+                       "orderno FROM bitten_step")
+        self.assertEqual((1, 'test', 'Foo bar', BuildStep.SUCCESS, 0, 0, 0),
                          cursor.fetchone())
 
+    def test_insert_with_orderno(self):
+        step = BuildStep(self.env, build=1, name='test', description='Foo bar',
+                         status=BuildStep.SUCCESS, orderno=3)
+        step.insert()
+
+        step = BuildStep.fetch(self.env, build=1, name='test')
+        self.assertEqual(3, step.orderno)
+
     def test_insert_with_errors(self):
         step = BuildStep(self.env, build=1, name='test', description='Foo bar',
                          status=BuildStep.SUCCESS)
@@ -348,9 +429,9 @@ class BuildStepTestCase(BaseModelTestCase):
 
         db = self.env.get_db_cnx()
         cursor = db.cursor()
-        cursor.execute("SELECT build,name,description,status,started,stopped "
-                       "FROM bitten_step")
-        self.assertEqual((1, 'test', 'Foo bar', BuildStep.SUCCESS, 0, 0),
+        cursor.execute("SELECT build,name,description,status,started,stopped,"
+                       "orderno FROM bitten_step")
+        self.assertEqual((1, 'test', 'Foo bar', BuildStep.SUCCESS, 0, 0, 0),
                          cursor.fetchone())
         cursor.execute("SELECT message FROM bitten_error ORDER BY orderno")
         self.assertEqual(('Foo',), cursor.fetchone())
@@ -366,8 +447,8 @@ class BuildStepTestCase(BaseModelTestCase):
     def test_fetch(self):
         db = self.env.get_db_cnx()
         cursor = db.cursor()
-        cursor.execute("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s)",
-                       (1, 'test', 'Foo bar', BuildStep.SUCCESS, 0, 0))
+        cursor.execute("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                       (1, 'test', 'Foo bar', BuildStep.SUCCESS, 0, 0, 0))
 
         step = BuildStep.fetch(self.env, build=1, name='test')
         self.assertEqual(1, step.build)
@@ -378,8 +459,8 @@ class BuildStepTestCase(BaseModelTestCase):
     def test_fetch_with_errors(self):
         db = self.env.get_db_cnx()
         cursor = db.cursor()
-        cursor.execute("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s)",
-                       (1, 'test', 'Foo bar', BuildStep.SUCCESS, 0, 0))
+        cursor.execute("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                       (1, 'test', 'Foo bar', BuildStep.SUCCESS, 0, 0, 0))
         cursor.executemany("INSERT INTO bitten_error VALUES (%s,%s,%s,%s)",
                            [(1, 'test', 'Foo', 0), (1, 'test', 'Bar', 1)])
 
@@ -393,9 +474,9 @@ class BuildStepTestCase(BaseModelTestCase):
     def test_select(self):
         db = self.env.get_db_cnx()
         cursor = db.cursor()
-        cursor.executemany("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s)",
-                           [(1, 'test', 'Foo bar', BuildStep.SUCCESS, 1, 2),
-                            (1, 'dist', 'Foo baz', BuildStep.FAILURE, 2, 3)])
+        cursor.executemany("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                           [(1, 'test', 'Foo bar', BuildStep.SUCCESS, 1, 2, 0),
+                            (1, 'dist', 'Foo baz', BuildStep.FAILURE, 2, 3, 1)])
 
         steps = list(BuildStep.select(self.env, build=1))
         self.assertEqual(1, steps[0].build)
@@ -407,6 +488,61 @@ class BuildStepTestCase(BaseModelTestCase):
         self.assertEqual('Foo baz', steps[1].description)
         self.assertEqual(BuildStep.FAILURE, steps[1].status)
 
+    def test_select_ordered_by_orderno(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                           [(1, 'test', 'Foo bar', BuildStep.SUCCESS, 1, 3, 1),
+                            (1, 'lint', 'Foo baz', BuildStep.SUCCESS, 1, 3, 0),
+                            (1, 'dist', 'Foo baz', BuildStep.SUCCESS, 1, 2, 2)])
+
+        steps = list(BuildStep.select(self.env, build=1))
+        self.assertEqual(['lint', 'test', 'dist'],
+                         [step.name for step in steps])
+        self.assertEqual([0, 1, 2], [step.orderno for step in steps])
+
+    def test_select_with_errors(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                           [(1, 'test', 'Foo bar', BuildStep.FAILURE, 1, 2, 0),
+                            (1, 'dist', 'Foo baz', BuildStep.FAILURE, 2, 3, 1),
+                            (2, 'test', 'Foo bar', BuildStep.FAILURE, 1, 2, 0)])
+        cursor.executemany("INSERT INTO bitten_error VALUES (%s,%s,%s,%s)",
+                           [(1, 'test', 'Foo', 0), (1, 'test', 'Bar', 1),
+                            (2, 'test', 'Baz', 0)])
+
+        steps = list(BuildStep.select(self.env, build=1))
+        self.assertEqual(['test', 'dist'], [step.name for step in steps])
+        self.assertEqual(['Foo', 'Bar'], steps[0].errors)
+        self.assertEqual([], steps[1].errors)
+
+    def test_select_for_builds(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                           [(1, 'test', 'Foo bar', BuildStep.SUCCESS, 1, 2, 0),
+                            (1, 'dist', 'Foo baz', BuildStep.FAILURE, 2, 3, 1),
+                            (2, 'test', 'Foo bar', BuildStep.FAILURE, 1, 2, 0),
+                            (3, 'test', 'Foo bar', BuildStep.FAILURE, 1, 2, 0)])
+        cursor.executemany("INSERT INTO bitten_error VALUES (%s,%s,%s,%s)",
+                           [(1, 'dist', 'Foo', 0), (1, 'dist', 'Bar', 1),
+                            (2, 'test', 'Baz', 0)])
+
+        steps = BuildStep.select_for_builds(self.env, [1, 2, 4])
+        self.assertEqual([1, 2, 4], sorted(steps.keys()))
+        self.assertEqual(['test', 'dist'], [step.name for step in steps[1]])
+        self.assertEqual([], steps[1][0].errors)
+        self.assertEqual(['Foo', 'Bar'], steps[1][1].errors)
+        self.assertEqual(['test'], [step.name for step in steps[2]])
+        self.assertEqual(['Baz'], steps[2][0].errors)
+        self.assertEqual([], steps[4])
+
+        steps = BuildStep.select_for_builds(self.env, [1, 2],
+                                            status=BuildStep.FAILURE)
+        self.assertEqual(['dist'], [step.name for step in steps[1]])
+        self.assertEqual(['test'], [step.name for step in steps[2]])
+
 
 class BuildLogTestCase(BaseModelTestCase):
 
@@ -729,11 +865,57 @@ class ReportTestCase(BaseModelTestCase):
                        in report.items
         self.assertEqual(1, idx)
 
+    def _insert_reports(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("INSERT INTO bitten_report "
+                       "(build,step,category,generator) VALUES (%s,%s,%s,%s)",
+                       (1, 'test', 'test', 'unittest'))
+        report1_id = db.get_last_id(cursor, 'bitten_report')
+        cursor.execute("INSERT INTO bitten_report "
+                       "(build,step,category,generator) VALUES (%s,%s,%s,%s)",
+                       (1, 'test', 'coverage', 'trace'))
+        report2_id = db.get_last_id(cursor, 'bitten_report')
+        cursor.executemany("INSERT INTO bitten_report_item "
+                           "(report,item,name,value) VALUES (%s,%s,%s,%s)",
+                           [(report1_id, 0, 'file', 'tests/foo.c'),
+                            (report1_id, 0, 'result', 'failure'),
+                            (report1_id, 1, 'file', 'tests/bar.c'),
+                            (report1_id, 1, 'result', 'success')])
+        db.commit()
+        return report1_id, report2_id
+
+    def test_select_ordered_items(self):
+        report1_id, report2_id = self._insert_reports()
+
+        reports = list(Report.select(self.env, build=1))
+        self.assertEqual([report2_id, report1_id], [r.id for r in reports])
+        self.assertEqual([], reports[0].items)
+        self.assertEqual([{'file': 'tests/foo.c', 'result': 'failure'},
+                          {'file': 'tests/bar.c', 'result': 'success'}],
+                         reports[1].items)
+
+    def test_select_lazy(self):
+        report1_id, report2_id = self._insert_reports()
+
+        reports = list(Report.select(self.env, build=1, lazy=True))
+        self.assertEqual([report2_id, report1_id], [r.id for r in reports])
+        self.assertEqual('coverage', reports[0].category)
+        self.assertEqual('trace', reports[0].generator)
+        self.assertEqual([], list(reports[0].items))
+        items = iter(reports[1].items)
+        self.assertEqual({'file': 'tests/foo.c', 'result': 'failure'},
+                         items.next())
+        self.assertEqual({'file': 'tests/bar.c', 'result': 'success'},
+                         items.next())
+        self.assertRaises(StopIteration, items.next)
+
 
 class PlatformBuildTestCase(BaseModelTestCase):
-    """Tests that involve Builds, TargetPlatforms and BuildSteps"""
+    """Tests that involve Builds, TargetPlatforms, BuildSteps and BuildLogs"""
 
-    schemas = [Build._schema, TargetPlatform._schema, BuildStep._schema]
+    schemas = [Build._schema, TargetPlatform._schema, BuildStep._schema,
+               BuildLog._schema]
 
     def test_delete_platform_with_pending_builds(self):
         """Check that deleting a platform with pending builds removes those pending builds"""
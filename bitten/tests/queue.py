@@ -18,8 +18,9 @@ import unittest
 from trac.db import DatabaseManager
 from trac.test import EnvironmentStub, Mock
 from trac.util.datefmt import to_datetime, utc
-from bitten.model import BuildConfig, TargetPlatform, Build, schema
-from bitten.queue import BuildQueue, collect_changes
+from bitten.model import BuildConfig, TargetPlatform, Build, QueueMark, \
+                         schema
+from bitten.queue import BuildQueue, PlatformIndex, collect_changes
 
 
 class CollectChangesTestCase(unittest.TestCase):
@@ -192,6 +193,69 @@ class BuildQueueTestCase(unittest.TestCase):
         build = queue.get_build_for_slave('foobar', {})
         self.assertEqual(None, build)
 
+    def test_next_pending_build_deletes_obsolete(self):
+        """
+        Make sure that all obsolete pending builds are removed, not only those
+        ahead of the build that gets scheduled.
+        """
+        BuildConfig(self.env, 'test', active=True).insert()
+        BuildConfig(self.env, 'other').insert()
+        platform = TargetPlatform(self.env, config='test', name='Foo')
+        platform.insert()
+        other = TargetPlatform(self.env, config='other', name='Bar')
+        other.insert()
+        newest = Build(self.env, config='test', platform=platform.id, rev=124,
+                       rev_time=43, status=Build.PENDING)
+        newest.insert()
+        older = Build(self.env, config='test', platform=platform.id, rev=123,
+                      rev_time=42, status=Build.PENDING)
+        older.insert()
+        inactive = Build(self.env, config='other', platform=other.id, rev=122,
+                         rev_time=41, status=Build.PENDING)
+        inactive.insert()
+
+        queue = BuildQueue(self.env)
+        build = queue.get_build_for_slave('foobar', {})
+        self.assertEqual(newest.id, build.id)
+        self.assertEqual(None, Build.fetch(self.env, older.id))
+        self.assertEqual(None, Build.fetch(self.env, inactive.id))
+
+    def test_wait_for_build(self):
+        BuildConfig(self.env, 'test', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name='Foo')
+        platform.insert()
+
+        queue = BuildQueue(self.env)
+        queue.pending_check_interval = 0.01
+        checks = []
+        get_pending_signature = queue._get_pending_signature
+        def _get_pending_signature():
+            checks.append(True)
+            if len(checks) == 3:
+                # Another process queues a build while the slave is waiting
+                Build(self.env, config='test', platform=platform.id, rev=123,
+                      rev_time=42, status=Build.PENDING).insert()
+            return get_pending_signature()
+        queue._get_pending_signature = _get_pending_signature
+
+        build = queue.wait_for_build('foobar', {}, 10)
+        self.assertEqual(3, len(checks))
+        self.assertEqual('123', build.rev)
+        self.assertEqual(Build.IN_PROGRESS, build.status)
+        self.assertEqual('foobar', build.slave)
+
+    def test_wait_for_build_timeout(self):
+        BuildConfig(self.env, 'test', active=True).insert()
+        build = Build(self.env, config='test', platform=1, rev=123, rev_time=42,
+                      status=Build.PENDING)
+        build.insert()
+
+        queue = BuildQueue(self.env)
+        queue.pending_check_interval = 0.01
+        started = time.time()
+        self.assertEqual(None, queue.wait_for_build('foobar', {}, 0.05))
+        self.assert_(time.time() - started >= 0.05)
+
     def test_populate_not_build_all(self):
         self.env.get_repository = lambda authname=None: Mock(
             get_changeset=lambda rev: Mock(date=to_datetime(rev * 1000, utc)),
@@ -262,6 +326,63 @@ class BuildQueueTestCase(unittest.TestCase):
         self.assertEqual(platform2.id, builds[5].platform)
         self.assertEqual('120', builds[5].rev)
 
+    def test_populate_incremental(self):
+        history = [('somepath', 123, 'edit'), ('somepath', 121, 'edit'),
+                   ('somepath', 120, 'edit')]
+        self.env.get_repository = lambda authname=None: Mock(
+            get_changeset=lambda rev: Mock(date=to_datetime(rev * 1000, utc)),
+            get_node=lambda path, rev=None: Mock(
+                get_entries=lambda: [Mock(), Mock()],
+                get_history=lambda: iter(history)
+            ),
+            normalize_path=lambda path: path,
+            rev_older_than=lambda rev1, rev2: int(rev1) < int(rev2)
+        )
+        config = BuildConfig(self.env, 'test', path='somepath', active=True)
+        config.insert()
+        platform = TargetPlatform(self.env, config='test', name='P1')
+        platform.insert()
+
+        queue = BuildQueue(self.env, build_all=True)
+        queue.populate()
+        self.assertEqual(['123', '121', '120'],
+                         [b.rev for b in Build.select(self.env)])
+        self.assertEqual('123', QueueMark.fetch(self.env, 'test').rev)
+
+        # Already examined revisions are not looked at again
+        list(Build.select(self.env, rev=121))[0].delete()
+        history.insert(0, ('somepath', 124, 'edit'))
+        queue.populate()
+        self.assertEqual(['124', '123', '120'],
+                         [b.rev for b in Build.select(self.env)])
+        self.assertEqual('124', QueueMark.fetch(self.env, 'test').rev)
+
+        # Changing the revision range requires examining the whole history
+        config.min_rev = 120
+        config.update()
+        queue.populate()
+        self.assertEqual(['124', '123', '121', '120'],
+                         [b.rev for b in Build.select(self.env)])
+
+    def test_populate_incremental_stabilize_wait(self):
+        self.env.get_repository = lambda authname=None: Mock(
+            get_changeset=lambda rev: Mock(date=to_datetime(time.time(), utc)),
+            get_node=lambda path, rev=None: Mock(
+                get_entries=lambda: [Mock(), Mock()],
+                get_history=lambda: [('somepath', 123, 'edit')]
+            ),
+            normalize_path=lambda path: path,
+            rev_older_than=lambda rev1, rev2: int(rev1) < int(rev2)
+        )
+        BuildConfig(self.env, 'test', path='somepath', active=True).insert()
+        TargetPlatform(self.env, config='test', name='P1').insert()
+
+        queue = BuildQueue(self.env, stabilize_wait=3600)
+        queue.populate()
+        self.assertEqual([], list(Build.select(self.env)))
+        # Delayed revisions must be examined again
+        self.assertEqual(None, QueueMark.fetch(self.env, 'test'))
+
     def test_populate_thread_race_condition(self):
         messages = []
         self.env.log = Mock(info=lambda msg, *args: messages.append(msg))
@@ -392,12 +513,14 @@ class BuildQueueTestCase(unittest.TestCase):
         platform.insert()
         build1 = Build(self.env, config='test', platform=platform.id, rev=123,
                       rev_time=42, status=Build.IN_PROGRESS, slave='heinz',
-                      started=time.time() - 600) # Started ten minutes ago
+                      started=time.time() - 600, # Started ten minutes ago
+                      last_activity=time.time() - 600)
         build1.insert()
 
         build2 = Build(self.env, config='test', platform=platform.id, rev=124,
                        rev_time=42, status=Build.IN_PROGRESS, slave='heinz',
-                       started=time.time() - 60) # Started a minute ago
+                       started=time.time() - 600, # Started ten minutes ago
+                       last_activity=time.time() - 60) # Active a minute ago
         build2.insert()
 
         queue = BuildQueue(self.env, timeout=300) # 5 minutes timeout
@@ -406,6 +529,24 @@ class BuildQueueTestCase(unittest.TestCase):
         self.assertEqual(Build.IN_PROGRESS,
                          Build.fetch(self.env, build2.id).status)
 
+    def test_reset_orphaned_builds_periodically(self):
+        BuildConfig(self.env, 'test').insert()
+        platform = TargetPlatform(self.env, config='test', name='Foo')
+        platform.insert()
+
+        queue = BuildQueue(self.env, timeout=300)
+        self.assertEqual(True, queue._orphan_check_due())
+
+        build = Build(self.env, config='test', platform=platform.id, rev=123,
+                      rev_time=42, status=Build.IN_PROGRESS, slave='heinz',
+                      last_activity=time.time() - 600)
+        build.insert()
+
+        # The check has just been done, so slave polls don't repeat it
+        queue.get_build_for_slave('foobar', {})
+        self.assertEqual(Build.IN_PROGRESS,
+                         Build.fetch(self.env, build.id).status)
+
     def test_match_slave_match(self):
         BuildConfig(self.env, 'test', active=True).insert()
         platform = TargetPlatform(self.env, config='test', name="Unix")
@@ -473,6 +614,52 @@ class BuildQueueTestCase(unittest.TestCase):
         platforms = queue.match_slave('foo', {'version': '7.8.1'})
         self.assertEqual([], platforms)
 
+    def test_platform_index_cached(self):
+        BuildConfig(self.env, 'test', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name="Unix")
+        platform.rules.append(('family', 'posix'))
+        platform.insert()
+
+        index = PlatformIndex.get(self.env)
+        self.assert_(index is PlatformIndex.get(self.env))
+        self.assertEqual([platform.id], [p.id for p in
+                                         index.match({'family': 'posix'})])
+        self.assertEqual([('family', 'posix')], index.match(
+                                            {'family': 'posix'})[0].rules)
+
+        # Changing a platform invalidates the index
+        platform.rules = [('family', 'nt')]
+        platform.update()
+        index = PlatformIndex.get(self.env)
+        self.assertEqual([], index.match({'family': 'posix'}))
+        self.assertEqual([platform.id], [p.id for p in
+                                         index.match({'family': 'nt'})])
+
+    def test_platform_index_uncommitted_change(self):
+        BuildConfig(self.env, 'test', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name="Unix")
+        platform.rules.append(('family', 'posix'))
+        platform.insert()
+        index = PlatformIndex.get(self.env)
+
+        # The index is only refreshed once the change has been committed
+        db = self.env.get_db_cnx()
+        platform.rules = [('family', 'nt')]
+        platform.update(db=db)
+        self.assert_(index is PlatformIndex.get(self.env))
+        db.commit()
+        PlatformIndex.invalidate(self.env)
+        index = PlatformIndex.get(self.env)
+        self.assertEqual([platform.id], [p.id for p in
+                                         index.match({'family': 'nt'})])
+
+    def test_platform_index_inactive_config(self):
+        BuildConfig(self.env, 'test', active=False).insert()
+        TargetPlatform(self.env, config='test', name="Unix").insert()
+
+        queue = BuildQueue(self.env)
+        self.assertEqual([], queue.match_slave('foo', {}))
+
 
 def suite():
     suite = unittest.TestSuite()
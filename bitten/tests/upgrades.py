@@ -152,10 +152,13 @@ class UpgradeScriptsTestCase(BaseUpgradeTestCase):
         'bitten_report',
         'bitten_report_item',
         'bitten_error',
+        'bitten_queue_mark',
         'old_step',
         'old_config',
         'old_log_v5',
         'old_log_v8',
+        'old_build_v11',
+        'old_step_v12',
         'old_rule',
     ]
 
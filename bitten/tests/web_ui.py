@@ -20,7 +20,8 @@ from trac.util.html import Markup
 from trac.web.api import HTTPNotFound
 from trac.web.href import Href
 from bitten.main import BuildSystem
-from bitten.model import Build, BuildConfig, BuildStep, TargetPlatform, schema
+from bitten.model import Build, BuildConfig, BuildLog, BuildStep, \
+                         TargetPlatform, schema
 from bitten.web_ui import BuildConfigController, BuildController, \
                           SourceFileLinkFormatter
 
@@ -188,6 +189,44 @@ class BuildControllerTestCase(AbstractWebUITestCase):
         self.assertEquals('/trac/attachment/build/test/1/',
                                 data['build']['attachments']['attach_href'])
 
+    def test_view_build_in_progress(self):
+        config = BuildConfig(self.env, name='test', path='trunk',
+                             recipe='<build><step id="foo" description="Foo"/>'
+                                    '<step id="bar"/><step id="baz"/>'
+                                    '</build>')
+        config.insert()
+        platform = TargetPlatform(self.env, config='test', name='any')
+        platform.insert()
+        build = Build(self.env, config='test', platform=1, rev=123, rev_time=42,
+                      status=Build.IN_PROGRESS, slave='hal')
+        build.insert()
+        BuildStep(self.env, build=build.id, name='bar', started=42,
+                  stopped=43, status=BuildStep.SUCCESS).insert()
+        # Log output the slave sent while executing the step
+        log = BuildLog(self.env, build=build.id, step='foo')
+        log.messages = [('info', 'doing stuff')]
+        log.insert()
+
+        PermissionSystem(self.env).grant_permission('joe', 'BUILD_VIEW')
+        req = Mock(method='GET', base_path='', cgi_location='',
+                   path_info='/build/test/1', href=Href('/trac'), args={},
+                   chrome={}, authname='joe',
+                   perm=PermissionCache(self.env, 'joe'))
+        self.repos = Mock(get_changeset=lambda rev: Mock(author='joe'))
+        self.repos.authz = Mock(assert_permission=lambda path: None)
+
+        module = BuildController(self.env)
+        assert module.match_request(req)
+        _, data, _ = module.process_request(req)
+
+        steps = data['build']['steps']
+        self.assertEqual(['bar', 'foo'], [step['name'] for step in steps])
+        self.assertEqual(False, steps[0]['running'])
+        self.assertEqual(True, steps[1]['running'])
+        self.assertEqual('Foo', steps[1]['description'])
+        self.assertEqual([{'level': 'info', 'message': 'doing stuff'}],
+                         steps[1]['log'])
+
     def test_raise_404(self):
         PermissionSystem(self.env).grant_permission('joe', 'BUILD_VIEW')
         module = BuildController(self.env)
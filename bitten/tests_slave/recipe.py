@@ -14,7 +14,9 @@ import tempfile
 import unittest
 
 from bitten.build.config import Configuration
-from bitten.recipe import Context, Recipe, InvalidRecipeError
+from bitten import recipe
+from bitten.build import shtools
+from bitten.recipe import CommandRegistry, Context, Recipe, InvalidRecipeError
 from bitten.util import xmlio
 
 
@@ -45,6 +47,18 @@ class ContextTestCase(unittest.TestCase):
         except InvalidRecipeError, e:
             self.failUnless("Unsupported argument 'foo'" in str(e))
 
+    def test_log_listener(self):
+        ctxt = Context(self.basedir)
+        logged = []
+        def listener(generator, xml):
+            logged.append(xml)
+            return len(logged) == 1
+        ctxt.log_listener = listener
+        ctxt.log(xmlio.Element('message', level='info')['foo'])
+        ctxt.log(xmlio.Element('message', level='info')['bar'])
+        self.assertEqual(2, len(logged))
+        self.assertEqual([(Recipe.LOG, None, None, logged[1])], ctxt.output)
+
     def test_attach_file_non_existing(self):
         # Verify that it raises error and that it gets logged
         ctxt = Context(self.basedir, Configuration())
@@ -68,11 +82,13 @@ class ContextTestCase(unittest.TestCase):
         self.assertEquals(1, len(ctxt.output))
         self.assertEquals(Recipe.ATTACH, ctxt.output[0][0])
         attach_xml = ctxt.output[0][3]
-        self.assertEquals('<file resource="config" '
-                          'description="config config" '
-                          'filename="config.txt">'
-                          'aGVsbG8gY29uZmln\n'
-                          '</file>', str(attach_xml))
+        self.assertEquals('file', attach_xml.name)
+        self.assertEquals({'resource': 'config',
+                           'description': 'config config',
+                           'filename': 'config.txt',
+                           'path': os.path.join(self.basedir, 'config.txt')},
+                          attach_xml.attr)
+        self.assertEquals([], attach_xml.children)
 
     def test_attach_file_build(self):
         # Verify output from attaching a file to a build
@@ -85,11 +101,61 @@ class ContextTestCase(unittest.TestCase):
         self.assertEquals(1, len(ctxt.output))
         self.assertEquals(Recipe.ATTACH, ctxt.output[0][0])
         attach_xml = ctxt.output[0][3]
-        self.assertEquals('<file resource="build" '
-                          'description="build build" '
-                          'filename="build.txt">'
-                          'aGVsbG8gYnVpbGQ=\n'
-                          '</file>', str(attach_xml))
+        self.assertEquals('file', attach_xml.name)
+        self.assertEquals({'resource': 'build',
+                           'description': 'build build',
+                           'filename': 'build.txt',
+                           'path': os.path.join(self.basedir, 'build.txt')},
+                          attach_xml.attr)
+        self.assertEquals([], attach_xml.children)
+
+class CommandRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scans = 0
+        working_set = recipe.WorkingSet
+        def WorkingSet():
+            self.scans += 1
+            return working_set()
+        recipe.WorkingSet = WorkingSet
+        self.working_set = working_set
+        self.registry = CommandRegistry()
+
+    def tearDown(self):
+        recipe.WorkingSet = self.working_set
+
+    def test_get_function(self):
+        qname = 'http://bitten.edgewall.org/tools/sh#exec'
+        self.assertEqual(shtools.exec_, self.registry.get_function(qname))
+        self.assertEqual(shtools.exec_, self.registry.get_function(qname))
+        self.assertEqual(shtools.pipe, self.registry.get_function(
+                         'http://bitten.edgewall.org/tools/sh#pipe'))
+        self.assertEqual(1, self.scans)
+
+    def test_get_function_unknown(self):
+        self.assertEqual(None, self.registry.get_function(
+                         'http://bitten.edgewall.org/tools/sh#foo'))
+        self.assertEqual(None, self.registry.get_function(
+                         'http://bitten.edgewall.org/tools/sh#foo'))
+        self.assertEqual(1, self.scans)
+
+    def test_get_arguments(self):
+        args, has_kwargs = self.registry.get_arguments(shtools.exec_)
+        self.assertEqual(['ctxt', 'executable', 'file_', 'output', 'args',
+                          'dir_', 'log_head', 'log_tail'], args)
+        self.assertEqual(False, has_kwargs)
+        def command(ctxt, **kwargs):
+            pass
+        self.assertEqual((['ctxt'], True),
+                         self.registry.get_arguments(command))
+
+    def test_invalidate(self):
+        qname = 'http://bitten.edgewall.org/tools/sh#exec'
+        self.registry.get_function(qname)
+        self.registry.invalidate()
+        self.assertEqual(shtools.exec_, self.registry.get_function(qname))
+        self.assertEqual(2, self.scans)
+
 
 class RecipeTestCase(unittest.TestCase):
 
@@ -117,6 +183,18 @@ class RecipeTestCase(unittest.TestCase):
         self.assertEqual('Bar', steps[0].description)
         self.assertEqual('fail', steps[0].onerror)
 
+    def test_step_depends(self):
+        xml = xmlio.parse('<build>'
+                          ' <step id="checkout"><cmd/></step>'
+                          ' <step id="lint"><cmd/></step>'
+                          ' <step id="test" depends="checkout"><cmd/></step>'
+                          ' <step id="docs" depends=""><cmd/></step>'
+                          ' <step id="dist" depends="lint, test"><cmd/></step>'
+                          '</build>')
+        recipe = Recipe(xml, basedir=self.basedir)
+        self.assertEqual([[], ['checkout'], ['checkout'], [], ['lint', 'test']],
+                         [step.depends for step in recipe])
+
     def test_validate_bad_root(self):
         xml = xmlio.parse('<foo></foo>')
         recipe = Recipe(xml, basedir=self.basedir)
@@ -167,6 +245,21 @@ class RecipeTestCase(unittest.TestCase):
         recipe = Recipe(xml, basedir=self.basedir)
         self.assertRaises(InvalidRecipeError, recipe.validate)
 
+    def test_validate_step_with_unknown_dependency(self):
+        xml = xmlio.parse('<build>'
+                          '<step id="foo" depends="bar"><somecmd/></step>'
+                          '<step id="bar"><othercmd/></step>'
+                          '</build>')
+        recipe = Recipe(xml, basedir=self.basedir)
+        self.assertRaises(InvalidRecipeError, recipe.validate)
+
+    def test_validate_step_depending_on_itself(self):
+        xml = xmlio.parse('<build>'
+                          '<step id="foo" depends="foo"><somecmd/></step>'
+                          '</build>')
+        recipe = Recipe(xml, basedir=self.basedir)
+        self.assertRaises(InvalidRecipeError, recipe.validate)
+
     def test_validate_successful(self):
         xml = xmlio.parse('<build>'
                           '<step id="foo"><somecmd></somecmd></step>'
@@ -175,9 +268,19 @@ class RecipeTestCase(unittest.TestCase):
         recipe = Recipe(xml, basedir=self.basedir)
         recipe.validate()
 
+    def test_validate_successful_with_dependencies(self):
+        xml = xmlio.parse('<build>'
+                          '<step id="foo"><somecmd></somecmd></step>'
+                          '<step id="bar" depends=""><othercmd/></step>'
+                          '<step id="baz" depends="foo bar"><othercmd/></step>'
+                          '</build>')
+        recipe = Recipe(xml, basedir=self.basedir)
+        recipe.validate()
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ContextTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CommandRegistryTestCase, 'test'))
     suite.addTest(unittest.makeSuite(RecipeTestCase, 'test'))
     return suite
 
@@ -8,12 +8,22 @@
 # you should have received as part of this distribution. The terms
 # are also available at http://bitten.edgewall.org/wiki/License.
 
+import BaseHTTPServer
+import httplib
+import mimetools
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
+import urllib2
+from StringIO import StringIO
 
+from bitten.recipe import Recipe
 from bitten.slave import BuildSlave, ExitSlave
+from bitten.util import xmlio
+from bitten.util.compress import GzipReader
 
 class BuildSlaveTestCase(unittest.TestCase):
 
@@ -33,9 +43,388 @@ class BuildSlaveTestCase(unittest.TestCase):
     def test_quit_raises(self):
         self.assertRaises(ExitSlave, self.slave.quit)
 
+    def _create_build(self, headers):
+        requests = []
+        def request(method, url, body=None, headers=None):
+            requests.append(xmlio.parse(body))
+            resp = urllib2.addinfourl(StringIO(''),
+                                      mimetools.Message(StringIO(response)),
+                                      url)
+            resp.code = 204
+            return resp
+        response = ''.join(['%s: %s\r\n' % item for item in headers]) + '\r\n'
+        self.slave.request = request
+        self.assertEqual(False,
+                         self.slave._create_build('http://example.org/builds'))
+        return requests[0]
+
+    def test_create_build_long_poll(self):
+        xml = self._create_build([('X-Bitten-Wait', '60')])
+        self.assertEqual('60', xml.attr['wait'])
+        self.assertEqual(True, self.slave._long_polled)
+
+    def test_create_build_long_poll_not_supported(self):
+        self.slave.long_poll = 0
+        xml = self._create_build([])
+        self.assertEqual(None, xml.attr.get('wait'))
+        self.assertEqual(False, self.slave._long_polled)
+
+    def _attach_file(self, content):
+        filename = self._create_file('bar.txt')
+        fd = file(filename, 'wb')
+        fd.write(content)
+        fd.close()
+        return xmlio.Element('file', filename='bar.txt',
+                             description='bar bar', resource='build',
+                             path=filename)
+
+    def test_upload_attachment(self):
+        requests = []
+        def request(method, url, body=None, headers=None):
+            requests.append((method, url, body.read(), headers))
+            resp = StringIO('Attachment stored')
+            resp.code = 201
+            return resp
+        self.slave.request = request
+
+        file_elem = self._attach_file('hello bar')
+        self.assertEqual(True, self.slave._upload_attachment(
+                                    'http://example.org/builds/1', file_elem))
+        method, url, body, headers = requests[0]
+        self.assertEqual('POST', method)
+        self.assert_(url.startswith(
+                     'http://example.org/builds/1/attachments/?'))
+        self.assert_('filename=bar.txt' in url)
+        self.assert_('description=bar+bar' in url)
+        self.assertEqual('hello bar', body)
+        self.assertEqual('9', headers['Content-Length'])
+        self.assertEqual([], file_elem.children)
+
+    def test_upload_attachment_not_supported(self):
+        def request(method, url, body=None, headers=None):
+            raise urllib2.HTTPError(url, 404, 'Not Found', {}, None)
+        self.slave.request = request
+
+        file_elem = self._attach_file('hello bar')
+        self.assertEqual(False, self.slave._upload_attachment(
+                                    'http://example.org/builds/1', file_elem))
+        self.assertEqual({'filename': 'bar.txt', 'description': 'bar bar',
+                          'resource': 'build'}, file_elem.attr)
+        self.assertEqual(['aGVsbG8gYmFy\n'], file_elem.children)
+
+    def test_upload_attachment_failed(self):
+        def request(method, url, body=None, headers=None):
+            raise urllib2.HTTPError(url, 400, 'Bad Request', {}, None)
+        self.slave.request = request
+
+        file_elem = self._attach_file('hello bar')
+        self.assertEqual(False, self.slave._upload_attachment(
+                                    'http://example.org/builds/1', file_elem))
+        self.assertEqual(['aGVsbG8gYmFy\n'], file_elem.children)
+
+    def _record_requests(self, code=201):
+        requests = []
+        def request(method, url, body=None, headers=None):
+            if headers.get('Content-Encoding') == 'gzip':
+                body = GzipReader(StringIO(body)).read()
+            if url.endswith('/logs/') and code == 404:
+                raise urllib2.HTTPError(url, 404, 'Not Found', {}, None)
+            requests.append((url, xmlio.parse(body)))
+            resp = StringIO('')
+            resp.code = 201
+            return resp
+        self.slave.request = request
+        return requests
+
+    def _execute_step(self):
+        recipe = Recipe(xmlio.parse('<build '
+                'xmlns:sh="http://bitten.edgewall.org/tools/sh">'
+                '<step id="foo"><sh:exec executable="echo" args="hello"/>'
+                '</step></build>'), self.work_dir)
+        step = list(recipe)[0]
+        self.assertEqual(True, self.slave._execute_step(
+                                    'http://example.org/builds/1', recipe, step))
+        self.assertEqual(None, recipe.ctxt.log_listener)
+
+    def test_execute_step_streams_log(self):
+        requests = self._record_requests()
+        self._execute_step()
+        self.assertEqual(['http://example.org/builds/1/logs/',
+                          'http://example.org/builds/1/steps/'],
+                         [url for url, xml in requests])
+        xml = requests[0][1]
+        self.assertEqual('foo', xml.attr['step'])
+        self.assertEqual('http://bitten.edgewall.org/tools/sh#exec',
+                         xml.attr['generator'])
+        self.assertEqual(['hello'], [message.gettext() for message
+                                     in xml.children('message')])
+        self.assertEqual([], list(requests[1][1].children('log')))
+
+    def test_execute_step_removes_temporary_attachments(self):
+        urls = []
+        def request(method, url, body=None, headers=None):
+            urls.append(url)
+            resp = StringIO('')
+            resp.code = 201
+            return resp
+        self.slave.request = request
+        recipe = Recipe(xmlio.parse('<build><step id="foo"/></build>'),
+                        self.work_dir)
+        step = list(recipe)[0]
+        filename = self._create_file('output.log')
+        recipe.ctxt.attach_temporary(filename)
+        step.execute = lambda ctxt: iter(ctxt.output)
+        self.assertEqual(True, self.slave._execute_step(
+                                    'http://example.org/builds/1', recipe, step))
+        self.assertEqual(False, os.path.exists(filename))
+        self.assert_(urls[0].startswith(
+                     'http://example.org/builds/1/attachments/?'))
+        self.assert_('temporary' not in urls[0])
+
+    def test_execute_step_log_streaming_not_supported(self):
+        requests = self._record_requests(code=404)
+        self._execute_step()
+        self.assertEqual(False, self.slave.stream_logs)
+        self.assertEqual(['http://example.org/builds/1/steps/'],
+                         [url for url, xml in requests])
+        log_elem = list(requests[0][1].children('log'))[0]
+        self.assertEqual(['hello'], [message.gettext() for message
+                                     in log_elem.children('message')])
+
+
+class ParallelStepsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='bitten_test')
+        self.slave = BuildSlave([], work_dir=self.work_dir,
+                                max_parallel_steps=2)
+        self.slave._execute_step = self._execute_step
+        self.executed = []
+        self.failing = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _execute_step(self, build_url, recipe, step, ctxt=None):
+        self.lock.acquire()
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        self.lock.release()
+        time.sleep(0.1)
+        self.lock.acquire()
+        self.active -= 1
+        self.executed.append(step.id)
+        self.lock.release()
+        return step.id not in self.failing
+
+    def _recipe(self, xml):
+        return Recipe(xmlio.parse(xml), self.work_dir)
+
+    def test_independent_steps(self):
+        recipe = self._recipe('<build>'
+                              '<step id="checkout"><cmd/></step>'
+                              '<step id="lint"><cmd/></step>'
+                              '<step id="test" depends="checkout"><cmd/></step>'
+                              '<step id="dist" depends="lint test"><cmd/></step>'
+                              '</build>')
+        self.assertEqual(True, self.slave._execute_steps(None, recipe))
+        self.assertEqual(2, self.max_active)
+        self.assertEqual('checkout', self.executed[0])
+        self.assertEqual('dist', self.executed[-1])
+        self.assertEqual(['checkout', 'dist', 'lint', 'test'],
+                         sorted(self.executed))
+
+    def test_sequential_steps(self):
+        recipe = self._recipe('<build>'
+                              '<step id="foo"><cmd/></step>'
+                              '<step id="bar"><cmd/></step>'
+                              '</build>')
+        self.assertEqual(True, self.slave._execute_steps(None, recipe))
+        self.assertEqual(1, self.max_active)
+        self.assertEqual(['foo', 'bar'], self.executed)
+
+    def test_failed_step_skips_dependent_steps(self):
+        self.failing.append('test')
+        recipe = self._recipe('<build>'
+                              '<step id="test"><cmd/></step>'
+                              '<step id="dist"><cmd/></step>'
+                              '<step id="docs" depends=""><cmd/></step>'
+                              '</build>')
+        self.assertEqual(False, self.slave._execute_steps(None, recipe))
+        self.assertEqual(['docs', 'test'], sorted(self.executed))
+
+    def test_step_error_raised(self):
+        def _execute_step(build_url, recipe, step, ctxt=None):
+            raise urllib2.URLError('Connection refused')
+        self.slave._execute_step = _execute_step
+        recipe = self._recipe('<build>'
+                              '<step id="foo"><cmd/></step>'
+                              '<step id="bar" depends=""><cmd/></step>'
+                              '</build>')
+        self.assertRaises(urllib2.URLError, self.slave._execute_steps, None,
+                          recipe)
+
+
+class ConcurrentBuildsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='bitten_test')
+        self.slave = BuildSlave(['http://example.org/builds'],
+                                work_dir=self.work_dir,
+                                build_dir='build_${config}',
+                                max_concurrent_builds=2)
+        self.started = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.slave._join_workers()
+        shutil.rmtree(self.work_dir)
+
+    def _initiate_build(self, build_url):
+        self.started.append(build_url)
+        self.release.wait()
+        if build_url.endswith('/exit'):
+            raise ExitSlave(76)
+
+    def test_build_dir_includes_build(self):
+        self.assertEqual('build_${config}_${build}', self.slave.build_dir)
+
+    def test_builds_run_concurrently(self):
+        self.slave._initiate_build = self._initiate_build
+        self.slave._start_build('http://example.org/builds/1')
+        self.slave._start_build('http://example.org/builds/2')
+        self.assertEqual(2, len(self.slave._workers))
+        self.release.set()
+        self.slave._join_workers()
+        self.assertEqual(['http://example.org/builds/1',
+                          'http://example.org/builds/2'], self.started)
+        self.assertEqual([], self.slave._workers)
+        self.slave._wait_for_worker_slot()
+
+    def test_worker_exits_slave(self):
+        self.slave._initiate_build = self._initiate_build
+        self.slave._start_build('http://example.org/builds/exit')
+        self.release.set()
+        self.slave._join_workers()
+        try:
+            self.slave._wait_for_worker_slot()
+            self.fail('Expected ExitSlave')
+        except ExitSlave, e:
+            self.assertEqual(76, e.exit_code)
+
+
+class _KeepAliveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.append(self.client_address)
+        body = 'Build pending'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.drop_connections:
+            # Close the connection without announcing it to the client
+            self.close_connection = 1
+
+    def do_POST(self):
+        self.server.clients.append(self.client_address)
+        self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.bad_status:
+            # A response that breaks off after the request was processed
+            self.wfile.write('HTTP/1.1 xyz Broken\r\n\r\n')
+            self.close_connection = 1
+            return
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_DELETE(self):
+        self.server.clients.append(self.client_address)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class PersistentConnectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='bitten_test')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                _KeepAliveRequestHandler)
+        self.server.clients = []
+        self.server.drop_connections = False
+        self.server.bad_status = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/builds' % self.server.server_port
+        self.slave = BuildSlave([self.url], work_dir=self.work_dir)
+
+    def tearDown(self):
+        self.slave.connections.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def test_connection_reused(self):
+        for idx in range(3):
+            resp = self.slave.request('GET', self.url)
+            self.assertEqual(200, resp.code)
+            self.assertEqual('Build pending', resp.read())
+        resp = self.slave.request('DELETE', self.url + '/1')
+        self.assertEqual(204, resp.code)
+        self.assertEqual(4, len(self.server.clients))
+        self.assertEqual(1, len(set(self.server.clients)))
+
+    def test_unread_response(self):
+        self.slave.request('GET', self.url)
+        resp = self.slave.request('GET', self.url)
+        self.assertEqual('Build pending', resp.read())
+        self.assertEqual(1, len(set(self.server.clients)))
+
+    def test_connection_closed_by_server(self):
+        self.server.drop_connections = True
+        for idx in range(3):
+            resp = self.slave.request('GET', self.url)
+            self.assertEqual('Build pending', resp.read())
+        self.assertEqual(3, len(set(self.server.clients)))
+
+    def test_connection_reused_without_buffering(self):
+        # httplib only supports buffered responses as of Python 2.7
+        getresponse = httplib.HTTPConnection.getresponse
+        httplib.HTTPConnection.getresponse = lambda conn: getresponse(conn)
+        try:
+            for idx in range(3):
+                resp = self.slave.request('GET', self.url)
+                self.assertEqual('Build pending', resp.read())
+                resp.close()
+        finally:
+            httplib.HTTPConnection.getresponse = getresponse
+        self.assertEqual(1, len(set(self.server.clients)))
+
+    def test_request_not_sent_twice(self):
+        self.assertEqual('Build pending',
+                         self.slave.request('GET', self.url).read())
+        self.server.bad_status = True
+        self.assertRaises(urllib2.URLError, self.slave.request, 'POST',
+                          self.url + '/1/steps/', 'result',
+                          {'Content-Type': 'application/x-bitten+xml'})
+        self.assertEqual(2, len(self.server.clients))
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(BuildSlaveTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ParallelStepsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ConcurrentBuildsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(PersistentConnectionTestCase, 'test'))
     return suite
 
 if __name__ == '__main__':
@@ -472,6 +472,60 @@ def fix_sequences(env, db):
     update_sequence(env, db, 'bitten_platform', 'id')
     update_sequence(env, db, 'bitten_report', 'id')
 
+def add_queue_mark_table(env, db):
+    """Add the bitten_queue_mark table for recording the youngest revision of
+    each build configuration already examined when populating the build
+    queue."""
+    from bitten.model import QueueMark
+    cursor = db.cursor()
+
+    connector, _ = DatabaseManager(env)._get_connector()
+    for table in QueueMark._schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
+
+def add_last_activity_to_build(env, db):
+    """Add a column to the build table for recording when the slave last
+    reported progress on a build, so that orphaned builds can be detected
+    without scanning all builds in progress."""
+    from bitten.model import Build
+    cursor = db.cursor()
+
+    cursor.execute("CREATE TEMPORARY TABLE old_build_v11 AS "
+                   "SELECT * FROM bitten_build")
+    cursor.execute("DROP TABLE bitten_build")
+
+    connector, _ = DatabaseManager(env)._get_connector()
+    for stmt in connector.to_sql(Build._schema[0]):
+        cursor.execute(stmt)
+
+    cursor.execute("INSERT INTO bitten_build (id,config,rev,rev_time,platform,"
+                   "slave,started,stopped,status,last_activity) "
+                   "SELECT id,config,rev,rev_time,platform,slave,started,"
+                   "stopped,status,started FROM old_build_v11")
+    update_sequence(env, db, 'bitten_build', 'id')
+
+def add_order_to_step(env, db):
+    """Add a column to the step table for recording the position of each step
+    in the recipe, so that steps are listed in that order without relying on
+    their completion times. Existing steps keep being ordered by the time
+    they were completed."""
+    from bitten.model import BuildStep
+    cursor = db.cursor()
+
+    cursor.execute("CREATE TEMPORARY TABLE old_step_v12 AS "
+                   "SELECT * FROM bitten_step")
+    cursor.execute("DROP TABLE bitten_step")
+
+    connector, _ = DatabaseManager(env)._get_connector()
+    for stmt in connector.to_sql(BuildStep._schema[0]):
+        cursor.execute(stmt)
+
+    cursor.execute("INSERT INTO bitten_step (build,name,description,status,"
+                   "started,stopped,orderno) "
+                   "SELECT build,name,description,status,started,stopped,0 "
+                   "FROM old_step_v12")
+
 
 map = {
     2: [add_log_table],
@@ -483,4 +537,7 @@ map = {
     8: [add_filename_to_logs,migrate_logs_to_files],
     9: [recreate_rule_with_int_id],
    10: [add_config_platform_rev_index_to_build, fix_sequences],
+   11: [add_queue_mark_table],
+   12: [add_last_activity_to_build],
+   13: [add_order_to_step],
 }
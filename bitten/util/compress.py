@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://bitten.edgewall.org/wiki/License.
+
+"""Support for the ``gzip`` content encoding of HTTP message bodies.
+
+Unlike the ``gzip`` module of the standard library, this works with streams
+that can not be seeked, such as the body of an HTTP request or response, and
+decompresses the data as it is read:
+
+>>> from StringIO import StringIO
+>>> GzipReader(StringIO(gzip('<root/>'))).read()
+'<root/>'
+"""
+
+import zlib
+
+__all__ = ['GzipReader', 'accepts_gzip', 'gzip']
+__docformat__ = 'restructuredtext en'
+
+# Window size parameter that makes zlib read and write the gzip format
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def gzip(data, level=6):
+    """Compress a string to the ``gzip`` format.
+
+    :param data: the string to compress
+    :param level: the compression level, from 1 (fastest) to 9 (best)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def accepts_gzip(accept_encoding):
+    """Return whether the given value of an ``Accept-Encoding`` header allows
+    the ``gzip`` content encoding.
+
+    >>> accepts_gzip('gzip, deflate')
+    True
+    >>> accepts_gzip('gzip;q=0, identity')
+    False
+    >>> accepts_gzip(None)
+    False
+    """
+    for coding in (accept_encoding or '').split(','):
+        params = [param.strip() for param in coding.split(';')]
+        if params[0].lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        for param in params[1:]:
+            name, value = (param.split('=', 1) + [''])[:2]
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    pass
+        return True
+    return False
+
+
+class GzipReader(object):
+    """File-like object that decompresses ``gzip`` data read from another
+    file-like object.
+    """
+
+    def __init__(self, fileobj, size=None, bufsize=16384):
+        """Create the reader.
+
+        :param fileobj: the file-like object to read the compressed data from
+        :param size: the length of the compressed data, if known, so that no
+                     data beyond it is requested from `fileobj`
+        :param bufsize: the number of compressed bytes to read at once
+        """
+        self.fileobj = fileobj
+        self.remaining = size
+        self.bufsize = bufsize
+        self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+        self._buffer = ''
+        self._eof = False
+
+    def read(self, size=-1):
+        """Read at most `size` bytes of decompressed data, or all of the
+        remaining data if `size` is negative.
+        """
+        chunks = [self._buffer]
+        available = len(self._buffer)
+        while not self._eof and (size < 0 or available < size):
+            chunk = self._decompress()
+            chunks.append(chunk)
+            available += len(chunk)
+        data = ''.join(chunks)
+        if size < 0 or len(data) <= size:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def _decompress(self):
+        bufsize = self.bufsize
+        if self.remaining is not None:
+            bufsize = min(bufsize, self.remaining)
+        data = bufsize and self.fileobj.read(bufsize) or ''
+        if not data:
+            self._eof = True
+            return self._decompressor.flush()
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        try:
+            return self._decompressor.decompress(data)
+        except zlib.error, e:
+            raise IOError('Invalid gzip data: %s' % e)
+
+    def close(self):
+        """Close the underlying file-like object."""
+        self.fileobj.close()
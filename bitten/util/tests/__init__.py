@@ -11,11 +11,15 @@
 import doctest
 import unittest
 
+from bitten.util import compress as compress_module
 from bitten.util import xmlio as xmlio_module
+from bitten.util.tests import compress as compress_tests
 from bitten.util.tests import xmlio as xmlio_tests
 
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(compress_module))
+    suite.addTest(compress_tests.suite())
     suite.addTest(doctest.DocTestSuite(xmlio_module))
     suite.addTest(xmlio_tests.suite())
     return suite
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://bitten.edgewall.org/wiki/License.
+
+import gzip
+from StringIO import StringIO
+import unittest
+
+from bitten.util import compress
+
+
+class GzipTestCase(unittest.TestCase):
+
+    def test_gzip(self):
+        data = 'Build log line\n' * 1000
+        compressed = compress.gzip(data)
+        self.assert_(len(compressed) < len(data) / 10)
+        self.assertEqual(data,
+                         gzip.GzipFile(fileobj=StringIO(compressed)).read())
+
+    def test_read(self):
+        data = ''.join([str(i) for i in range(10000)])
+        reader = compress.GzipReader(StringIO(compress.gzip(data)),
+                                     bufsize=100)
+        chunks = []
+        while True:
+            chunk = reader.read(333)
+            if not chunk:
+                break
+            self.assert_(len(chunk) <= 333)
+            chunks.append(chunk)
+        self.assertEqual(data, ''.join(chunks))
+        self.assertEqual('', reader.read())
+
+    def test_read_size(self):
+        compressed = compress.gzip('<root/>')
+        fileobj = StringIO(compressed + 'next request')
+        reader = compress.GzipReader(fileobj, len(compressed))
+        self.assertEqual('<root/>', reader.read())
+        self.assertEqual('next request', fileobj.read())
+
+    def test_read_invalid(self):
+        reader = compress.GzipReader(StringIO('<root/>'))
+        self.assertRaises(IOError, reader.read)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(GzipTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -9,6 +9,7 @@
 # are also available at http://bitten.edgewall.org/wiki/License.
 
 import os
+from StringIO import StringIO
 import shutil
 import tempfile
 import unittest
@@ -17,6 +18,14 @@ from bitten.util import xmlio
 
 class XMLIOTestCase(unittest.TestCase):
 
+    backend = xmlio.BACKENDS[0]
+
+    def setUp(self):
+        self.previous_backend = xmlio.set_backend(self.backend)
+
+    def tearDown(self):
+        xmlio.set_backend(self.previous_backend)
+
     def test_parse(self):
         """Tests that simple test data is parsed correctly"""
         s = """<build xmlns:c="http://bitten.edgewall.org/tools/c">
@@ -27,10 +36,105 @@ class XMLIOTestCase(unittest.TestCase):
         x = xmlio.parse(s)
         assert x.name == "build"
 
+    def test_parse_namespaces(self):
+        s = """<build xmlns:c="http://bitten.edgewall.org/tools/c" path="trunk">
+                 <step id="build"><c:configure file="x"/></step>
+               </build>"""
+        x = xmlio.parse(s)
+        self.assertEquals('trunk', x.attr['path'])
+        step = list(x.children())[0]
+        self.assertEquals('step', step.name)
+        self.assertEquals(None, step.namespace)
+        cmd = list(step.children('c:configure'))[0]
+        self.assertEquals('configure', cmd.name)
+        self.assertEquals('http://bitten.edgewall.org/tools/c', cmd.namespace)
+        self.assertEquals({'file': 'x'}, dict(cmd.attr.items()))
+        self.assertEquals([], list(step.children('configure')))
+
+    def test_parse_serialize(self):
+        x = xmlio.parse("""<build xmlns:c="http://bitten.edgewall.org/tools/c" path="trunk">
+  <step id="build" description="&quot;a&quot; &amp; &lt;b&gt;">
+    <c:configure file="x"/>
+    Some text
+  </step>
+</build>""")
+        x.attr['config'] = 'test'
+        self.assertEquals("""<build config="test" path="trunk" xmlns:c="http://bitten.edgewall.org/tools/c">
+  <step description="&quot;a&quot; &amp; &lt;b&gt;" id="build">
+    <c:configure file="x"/>
+    Some text
+  </step>
+</build>""", str(x))
+
+    def test_parse_gettext(self):
+        x = xmlio.parse('<root>foo<![CDATA[ <bar> ]]><child/>baz</root>')
+        self.assertEquals('foo <bar> baz', x.gettext())
+
+    def test_parse_error(self):
+        self.assertRaises(xmlio.ParseError, xmlio.parse, '<root></rot>')
+
+    def test_iterparse(self):
+        xml = '<root><a x="1">foo</a>bar<b><c/></b></root>'
+        elems = [(elem.name, elem.attr.items(), elem.gettext(),
+                  [child.name for child in elem.children()])
+                 for elem in xmlio.iterparse(xml)]
+        self.assertEquals([('a', [('x', '1')], 'foo', []),
+                           ('b', [], '', ['c'])], elems)
+
+    def test_iterparse_tag(self):
+        xml = """<testsuites>
+          <testsuite name="a"><testcase name="1"/><testcase name="2"/></testsuite>
+          <other><testcase name="3"><error>failed</error></testcase></other>
+        </testsuites>"""
+        elems = [(elem.attr['name'], [str(child) for child in elem.children()])
+                 for elem in xmlio.iterparse(StringIO(xml), 'testcase')]
+        self.assertEquals([('1', []), ('2', []),
+                           ('3', ['<error>failed</error>'])], elems)
+
+    def test_iterparse_tag_nested(self):
+        xml = '<root><s n="1"><s n="2"><t/></s><t/></s><t/></root>'
+        elems = [(elem.name, elem.attr.get('n'), len(list(elem.children())))
+                 for elem in xmlio.iterparse(xml, ('s', 't'))]
+        self.assertEquals([('t', None, 0), ('s', '2', 0), ('t', None, 0),
+                           ('s', '1', 0), ('t', None, 0)], elems)
+
+    def test_iterparse_tag_root(self):
+        elems = [elem.attr['name'] for elem in
+                 xmlio.iterparse('<t name="1"><t name="2"/></t>', 't')]
+        self.assertEquals(['2', '1'], elems)
+
+    def test_iterparse_namespaces(self):
+        xml = '<root xmlns:c="urn:c"><c:item c:x="1"/><item/></root>'
+        elems = [(elem.name, elem.namespace, elem.attr.items())
+                 for elem in xmlio.iterparse(xml, 'c:item')]
+        self.assertEquals([('item', 'urn:c', [('c:x', '1')])], elems)
+
+    def test_iterparse_error(self):
+        self.assertRaises(xmlio.ParseError, list,
+                          xmlio.iterparse('<root><a/><b></root>'))
+
+    def test_set_backend_unknown(self):
+        self.assertRaises(ValueError, xmlio.set_backend, 'sax')
+
     def test_Element_encoding(self):
         self.assertEquals('<\xc3\xb8\xc3\xbc arg="\xc3\xa9\xe2\x82\xac"/>',
             str(xmlio.Element(u'\xf8\xfc', arg=u'\xe9\u20ac'.encode('utf-8'))))
 
+    def test_Element_escaping(self):
+        xml = xmlio.Element('foo', a='"1" & <2>\x01')[
+            u'Me\x01 & you\x86!', xmlio.Element('bar', b=3)['<baz/>'], 42
+        ]
+        self.assertEquals('<foo a="&quot;1&quot; &amp; &lt;2&gt;">'
+                          'Me &amp; you!<bar b="3"><![CDATA[<baz/>]]></bar>'
+                          '42</foo>', str(xml))
+
+    def test_Element_newlines(self):
+        xml = xmlio.Element('foo')[xmlio.Element('bar'), u'\xe9']
+        buf = StringIO()
+        xml.write(buf, newlines=True)
+        self.assertEquals('<foo><bar/>' + os.linesep + '\xc3\xa9</foo>' +
+                          os.linesep, buf.getvalue())
+
     def test_ParsedElement_encoding(self):
         u = u'<root foo="øüé€"/>'
         s = '<root foo="\xc3\xb8\xc3\xbc\xc3\xa9\xe2\x82\xac"/>'
@@ -68,9 +172,16 @@ class XMLIOTestCase(unittest.TestCase):
         # not basestring
         self.assertEquals(42, xmlio._escape_text(42))
 
+
+class MinidomXMLIOTestCase(XMLIOTestCase):
+
+    backend = 'minidom'
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(XMLIOTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(MinidomXMLIOTestCase, 'test'))
     return suite
 
 if __name__ == '__main__':
@@ -10,7 +10,9 @@
 
 """Utility code for easy input and output of XML.
 
-The current implementation uses ``xml.dom.minidom`` under the hood for parsing.
+Parsing is done with ``cElementTree`` when it is available, and with
+``xml.dom.minidom`` otherwise (see `set_backend()`). Both backends are used
+through the same `ParsedElement` API.
 """
 
 import os
@@ -19,11 +21,20 @@ try:
 except ImportError:
     from StringIO import StringIO
 from UserDict import DictMixin
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    try:
+        import cElementTree as ElementTree
+    except ImportError:
+        ElementTree = None
 
 import cgi
+import re
 import string
 
-__all__ = ['Fragment', 'Element', 'ParsedElement', 'parse']
+__all__ = ['Fragment', 'Element', 'ParsedElement', 'iterparse', 'parse',
+           'set_backend']
 __docformat__ = 'restructuredtext en'
 
 def _from_utf8(text):
@@ -68,6 +79,81 @@ def _escape_attr(attr):
     else:
         return attr
 
+# Patterns used by `_serialize()` to check in a single scan whether text needs
+# escaping at all, which is rarely the case
+_text_special = re.compile(u'[&<>%s]' % __todel.decode('latin-1'))
+_attr_special = re.compile(u'[&<>"%s]' % __todel.decode('latin-1'))
+_invalid_chars = re.compile(u'[%s]' % __todel.decode('latin-1'))
+
+def _escape_unicode(text, quote=False):
+    """Fast equivalent of `_escape_text()` and `_escape_attr()` for unicode
+    strings that are known to contain special characters."""
+    if _invalid_chars.search(text):
+        text = text.translate(__uni_trans)
+    text = text.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+               .replace(u'>', u'&gt;')
+    if quote:
+        text = text.replace(u'"', u'&quot;')
+    return text
+
+# Cache of serialized attribute names, each followed by `="`
+_attr_names = {}
+
+def _to_unicode(value):
+    """Convert utf-8 strings and other values to unicode."""
+    if isinstance(value, unicode):
+        return value
+    elif isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+def _serialize(nodes, buf, newlines=False):
+    """Append the serialized XML of the given nodes to the list `buf` as
+    unicode strings.
+
+    This produces the same output as writing the nodes one by one, but
+    avoids the overhead of the many small writes that would require.
+    """
+    append = buf.append
+    for node in nodes:
+        if isinstance(node, Element):
+            name = _to_unicode(node.name)
+            append(u'<' + name)
+            for attrname, value in node.attr.items():
+                prefix = _attr_names.get(attrname)
+                if prefix is None:
+                    prefix = _attr_names[attrname] = u' %s="' % \
+                                                     _to_unicode(attrname)
+                append(prefix)
+                if isinstance(value, basestring):
+                    value = _to_unicode(value)
+                    if _attr_special.search(value):
+                        value = _escape_unicode(value, quote=True)
+                else:
+                    value = unicode(value)
+                append(value)
+                append(u'"')
+            if node.children:
+                append(u'>')
+                _serialize(node.children, buf, newlines)
+                append(u'</' + name + u'>')
+            else:
+                append(u'/>')
+            if newlines:
+                append(os.linesep)
+        elif isinstance(node, ParsedElement):
+            out = StringIO()
+            node.write(out, newlines=newlines)
+            append(out.getvalue().decode('utf-8'))
+        else:
+            node = _to_unicode(node)
+            if node.startswith(u'<'):
+                append(u'<![CDATA[' + node + u']]>')
+            elif _text_special.search(node):
+                append(_escape_unicode(node))
+            else:
+                append(node)
+
 
 class Fragment(object):
     """A collection of XML elements."""
@@ -107,14 +193,9 @@ class Fragment(object):
         """Serializes the element and writes the XML to the given output
         stream.
         """
-        for child in self.children:
-            if isinstance(child, (Element, ParsedElement)):
-                child.write(out, newlines=newlines)
-            else:
-                if child.startswith('<'):
-                    out.write('<![CDATA[' + _to_utf8(child) + ']]>')
-                else:
-                    out.write(_to_utf8(_escape_text(child)))
+        buf = []
+        _serialize(self.children, buf, newlines)
+        out.write(u''.join(buf).encode('utf-8'))
 
 
 class Element(Fragment):
@@ -188,30 +269,45 @@ class Element(Fragment):
         """Serializes the element and writes the XML to the given output
         stream.
         """
-        out.write('<')
-        out.write(_to_utf8(self.name))
-        for name, value in self.attr.items():
-            out.write(_to_utf8(' %s="%s"' % (name, _escape_attr(value))))
-        if self.children:
-            out.write('>')
-            Fragment.write(self, out, newlines)
-            out.write('</' + _to_utf8(self.name) + '>')
-        else:
-            out.write('/>')
-        if newlines:
-            out.write(os.linesep)
+        buf = []
+        _serialize([self], buf, newlines)
+        out.write(u''.join(buf).encode('utf-8'))
 
 
 class ParseError(Exception):
     """Exception thrown when there's an error parsing an XML document."""
 
 
-def parse(text_or_file):
+BACKENDS = ['minidom']
+if ElementTree is not None:
+    BACKENDS.insert(0, 'etree')
+
+_backend = BACKENDS[0]
+
+def set_backend(name):
+    """Select the parser used by `parse()`.
+
+    :param name: either ``'etree'`` (``cElementTree``, the default when it is
+                 available) or ``'minidom'``
+    :return: the name of the previously selected backend
+    """
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError('Unsupported XML parser backend %r' % name)
+    previous, _backend = _backend, name
+    return previous
+
+def parse(text_or_file, backend=None):
     """Parse an XML document provided as string or file-like object.
     
     Returns an instance of `ParsedElement` that can be used to traverse the
     parsed document.
+
+    :param backend: the parser to use (see `set_backend()`), defaults to the
+                    selected backend
     """
+    if (backend or _backend) == 'etree':
+        return _parse_etree(text_or_file)
     from xml.dom import minidom
     from xml.parsers import expat
     try:
@@ -223,6 +319,114 @@ def parse(text_or_file):
     except expat.error, e:
         raise ParseError(e)
 
+def _parse_etree(text_or_file):
+    """Parse an XML document using ``cElementTree``."""
+    from xml.parsers import expat
+    if isinstance(text_or_file, basestring):
+        text_or_file = StringIO(_to_utf8(text_or_file))
+    namespaces = _Namespaces()
+    root = None
+    try:
+        for event, item in ElementTree.iterparse(text_or_file,
+                                                 ('start', 'start-ns')):
+            if event == 'start-ns':
+                namespaces.declare(*item)
+            elif root is None:
+                root = item
+    except (SyntaxError, expat.error), e:
+        raise ParseError(e)
+    return _ElementTreeElement(root, namespaces)
+
+
+def iterparse(text_or_file, tag=None, backend=None):
+    """Incrementally parse an XML document provided as string or file-like
+    object.
+
+    This is a generator that yields a `ParsedElement` for every element as soon
+    as the parser has read its end tag, so that large documents do not need to
+    be held in memory completely. If `tag` is provided, all elements with a
+    matching qualified name (or one of several names, if `tag` is a sequence)
+    are yielded, nested elements before the elements that contain them.
+    Otherwise, the immediate children of the root element are yielded.
+
+    Every element is removed from the document once the consumer advances to
+    the next one, so it must not be used after that:
+
+    >>> for elem in iterparse('<root><a>1</a><b><a>2</a></b></root>', 'a'):
+    ...     print elem
+    <a>1</a>
+    <a>2</a>
+
+    :param tag: the name(s) of the elements to yield
+    :param backend: the parser to use (see `set_backend()`), defaults to the
+                    selected backend
+    """
+    if isinstance(tag, basestring):
+        tag = [tag]
+    if isinstance(text_or_file, basestring):
+        text_or_file = StringIO(_to_utf8(text_or_file))
+    if (backend or _backend) == 'etree':
+        return _iterparse_etree(text_or_file, tag)
+    return _iterparse_minidom(text_or_file, tag)
+
+def _iterparse_etree(fileobj, tag):
+    """Incrementally parse an XML document using ``cElementTree``."""
+    from xml.parsers import expat
+    namespaces = _Namespaces()
+    stack = []
+    try:
+        for event, item in ElementTree.iterparse(fileobj,
+                                                 ('start', 'end', 'start-ns')):
+            if event == 'start':
+                stack.append(item)
+            elif event == 'end':
+                stack.pop()
+                if tag is None:
+                    match = len(stack) == 1
+                else:
+                    match = namespaces.qname(item.tag) in tag
+                if match:
+                    yield _ElementTreeElement(item, namespaces)
+                if stack and (match or tag is not None and len(stack) == 1):
+                    # Any matching elements inside have been yielded already
+                    item.clear()
+                    stack[-1].remove(item)
+            else:
+                namespaces.declare(*item)
+    except (SyntaxError, expat.error), e:
+        raise ParseError(e)
+
+def _iterparse_minidom(fileobj, tag):
+    """Incrementally parse an XML document using ``xml.dom.pulldom``."""
+    from xml.dom import pulldom
+    from xml.sax import SAXException
+    # Only the subtrees of matching elements are built, all other nodes are
+    # dropped as they are read
+    stack = []
+    try:
+        for event, node in pulldom.parse(fileobj):
+            if event == pulldom.START_ELEMENT:
+                if tag is None:
+                    match = len(stack) == 1
+                else:
+                    match = node.tagName in tag
+                inside = bool(stack) and stack[-1][2]
+                if inside:
+                    stack[-1][0].appendChild(node)
+                stack.append((node, match, match or inside))
+            elif event == pulldom.END_ELEMENT:
+                node, match = stack.pop()[:2]
+                if match:
+                    yield ParsedElement(node)
+                    if stack and stack[-1][2]:
+                        stack[-1][0].removeChild(node)
+                    node.unlink()
+            elif event in (pulldom.CHARACTERS, pulldom.IGNORABLE_WHITESPACE):
+                if stack and stack[-1][2]:
+                    stack[-1][0].appendChild(node)
+    except SAXException, e:
+        raise ParseError(e)
+
 
 class ParsedElement(object):
     """Representation of an XML element that was parsed from a string or
@@ -346,6 +550,167 @@ class ParsedElement(object):
         return buf.getvalue()
 
 
+def _write_data(text):
+    """Escape text the way ``xml.dom.minidom`` does when serializing."""
+    return text.replace('&', '&amp;').replace('<', '&lt;') \
+               .replace('"', '&quot;').replace('>', '&gt;')
+
+
+class _Namespaces(object):
+    """The namespace prefixes declared in a document parsed with
+    ``cElementTree``, used to map the ``{uri}local`` names of the element tree
+    back to qualified names."""
+
+    def __init__(self):
+        self.prefixes = {}
+        self._uris = {}
+
+    def declare(self, prefix, uri):
+        if uri in self.prefixes:
+            return
+        if prefix in self._uris:
+            # Prefix rebound to another namespace in a nested element
+            prefix = 'ns%d' % len(self.prefixes)
+        self.prefixes[uri] = prefix
+        self._uris[prefix] = uri
+
+    def split(self, name):
+        """Split a ``{uri}local`` name into namespace URI and local name."""
+        if name[:1] == '{':
+            uri, local = name[1:].split('}', 1)
+            return uri, local
+        return None, name
+
+    def qname(self, name):
+        """Return the qualified name for a ``{uri}local`` name."""
+        uri, local = self.split(name)
+        if uri is None:
+            return local
+        prefix = self.prefixes.get(uri)
+        if prefix is None:
+            if uri == 'http://www.w3.org/XML/1998/namespace':
+                return 'xml:' + local
+            return local
+        return prefix and prefix + ':' + local or local
+
+    def clark(self, qname):
+        """Return the ``{uri}local`` name for a qualified attribute name."""
+        if ':' in qname:
+            prefix, local = qname.split(':', 1)
+            if prefix in self._uris:
+                return '{%s}%s' % (self._uris[prefix], local)
+        return qname
+
+    def declarations(self):
+        """Return the namespace declarations as ``(name, uri)`` tuples."""
+        return [(prefix and 'xmlns:' + prefix or 'xmlns', uri)
+                for uri, prefix in self.prefixes.items()]
+
+
+class _ElementTreeElement(ParsedElement):
+    """`ParsedElement` implementation for documents parsed with
+    ``cElementTree``."""
+    __slots__ = ['_elem', '_namespaces']
+
+    class _Attrs(DictMixin):
+        """Dictionary interface for the element attributes, using qualified
+        names as keys."""
+        def __init__(self, elem, namespaces):
+            self._elem = elem
+            self._namespaces = namespaces
+        def __getitem__(self, name):
+            value = self._elem.get(self._namespaces.clark(name))
+            if value is None:
+                raise KeyError(name)
+            return _to_utf8(value)
+        def __setitem__(self, name, value):
+            self._elem.set(self._namespaces.clark(name), value)
+        def __delitem__(self, name):
+            del self._elem.attrib[self._namespaces.clark(name)]
+        def keys(self):
+            return [_to_utf8(self._namespaces.qname(key))
+                    for key in self._elem.keys()]
+
+    def __init__(self, elem, namespaces):
+        self._elem = elem
+        self._namespaces = namespaces
+        self.attr = _ElementTreeElement._Attrs(elem, namespaces)
+
+    name = property(fget=lambda self: self._namespaces.split(self._elem.tag)[1],
+                    doc='Local name of the element')
+    namespace = property(fget=lambda self:
+                                self._namespaces.split(self._elem.tag)[0],
+                         doc='Namespace URI of the element')
+
+    def children(self, name=None):
+        """Iterate over the child elements of this element.
+
+        If the parameter `name` is provided, only include elements with a
+        matching qualified name. Otherwise, include all elements.
+        """
+        qname = self._namespaces.qname
+        for child in self._elem:
+            if not isinstance(child.tag, basestring):
+                continue # comment or processing instruction
+            if name in (None, qname(child.tag)):
+                yield _ElementTreeElement(child, self._namespaces)
+
+    def gettext(self):
+        """Return the text content of this element.
+        
+        This concatenates the values of all text and CDATA nodes that are
+        immediate children of this element.
+        """
+        text = [self._elem.text or '']
+        text += [child.tail or '' for child in self._elem]
+        return ''.join([_to_utf8(t) for t in text])
+
+    def write(self, out, newlines=False):
+        """Serializes the element and writes the XML to the given output
+        stream.
+        
+        The output matches that of the ``minidom`` backend, except that the
+        namespace declarations of the document are added to the serialized
+        element.
+        """
+        buf = []
+        self._serialize(self._elem, buf, '', newlines and '\t' or '',
+                        newlines and '\n' or '',
+                        self._namespaces.declarations())
+        out.write(u''.join(buf).encode('utf-8'))
+
+    def _serialize(self, elem, buf, indent, addindent, newl, extra_attrs=()):
+        qname = self._namespaces.qname
+        tag = _from_utf8(qname(elem.tag))
+        buf.append(indent + u'<' + tag)
+        attrs = [(_from_utf8(qname(name)), value)
+                 for name, value in elem.items()] + list(extra_attrs)
+        attrs.sort()
+        for name, value in attrs:
+            buf.append(u' %s="%s"' % (name, _write_data(_from_utf8(value))))
+        children = [child for child in elem
+                    if isinstance(child.tag, basestring)]
+        if elem.text or children:
+            buf.append(u'>')
+            if not children:
+                buf.append(_write_data(_from_utf8(elem.text)))
+            else:
+                buf.append(newl)
+                if elem.text:
+                    buf.append(_write_data(u'%s%s%s' % (indent + addindent,
+                                          _from_utf8(elem.text), newl)))
+                for child in children:
+                    self._serialize(child, buf, indent + addindent,
+                                    addindent, newl)
+                    if child.tail:
+                        buf.append(_write_data(u'%s%s%s' % (indent + addindent,
+                                              _from_utf8(child.tail), newl)))
+                buf.append(indent)
+            buf.append(u'</%s>%s' % (tag, newl))
+        else:
+            buf.append(u'/>%s' % newl)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
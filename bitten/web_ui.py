@@ -35,6 +35,8 @@ from bitten.master import BuildMaster
 from bitten.model import BuildConfig, TargetPlatform, Build, BuildStep, \
                          BuildLog, Report
 from bitten.queue import collect_changes
+from bitten.recipe import Recipe
+from bitten.util import xmlio
 
 _status_label = {Build.PENDING: 'pending',
                  Build.IN_PROGRESS: 'in progress',
@@ -70,6 +72,16 @@ def _get_build_data(env, req, build):
     }
     return data
 
+def _get_steps_data(build_data, steps):
+    return [{'name': step.name,
+             'description': step.description,
+             'duration': to_datetime(step.stopped, utc) - \
+                         to_datetime(step.started, utc),
+             'failed': not step.successful,
+             'errors': step.errors,
+             'href': build_data['href'] + '#step_' + step.name}
+            for step in steps]
+
 
 class BittenChrome(Component):
     """Provides the Bitten templates and static resources."""
@@ -271,6 +283,17 @@ class BuildConfigController(Component):
 
         repos = self.env.get_repository(req.authname)
 
+        # Fetch all in-progress builds with their steps up front, so that the
+        # page is rendered with a constant number of queries
+        in_progress_builds = {}
+        for build in Build.select(self.env, status=Build.IN_PROGRESS, db=db):
+            in_progress_builds.setdefault(build.config, []).append(build)
+        build_steps = BuildStep.select_for_builds(self.env,
+                    [build.id for builds in in_progress_builds.values()
+                     for build in builds], db=db)
+        platform_names = dict([(platform.id, platform.name) for platform
+                               in TargetPlatform.select(self.env, db=db)])
+
         configs = []
         for config in BuildConfig.select(self.env, include_inactive=False):
             if not repos.authz.has_permission(config.path):
@@ -280,32 +303,18 @@ class BuildConfigController(Component):
             if not config.active:
                 continue
 
-            in_progress_builds = Build.select(self.env, config=config.name,
-                                              status=Build.IN_PROGRESS, db=db)
-
             current_builds = 0
             builds = []
             # sort correctly by revision.
-            for build in sorted(in_progress_builds,
+            for build in sorted(in_progress_builds.get(config.name, []),
                                 cmp=lambda x, y: int(y.rev) - int(x.rev)):
                 rev = build.rev
                 build_data = _get_build_data(self.env, req, build)
                 build_data['rev'] = rev
                 build_data['rev_href'] = req.href.changeset(rev)
-                platform = TargetPlatform.fetch(self.env, build.platform)
-                build_data['platform'] = platform.name
-                build_data['steps'] = []
-
-                for step in BuildStep.select(self.env, build=build.id, db=db):
-                    build_data['steps'].append({
-                        'name': step.name,
-                        'description': step.description,
-                        'duration': to_datetime(step.stopped, utc) - \
-                                    to_datetime(step.started, utc),
-                        'failed': not step.successful,
-                        'errors': step.errors,
-                        'href': build_data['href'] + '#step_' + step.name
-                    })
+                build_data['platform'] = platform_names.get(build.platform)
+                build_data['steps'] = _get_steps_data(build_data,
+                                                      build_steps[build.id])
 
                 builds.append(build_data)
                 current_builds += 1
@@ -385,7 +394,8 @@ class BuildConfigController(Component):
         ]
 
         has_reports = False
-        for report in Report.select(self.env, config=config.name, db=db):
+        for report in Report.select(self.env, config=config.name, db=db,
+                                    lazy=True):
             has_reports = True
             break
 
@@ -410,6 +420,7 @@ class BuildConfigController(Component):
         builds_per_page = 12 * len(platforms)
         idx = 0
         builds = {}
+        page_builds = []
         for platform, rev, build in collect_changes(repos, config):
             if idx >= page * builds_per_page:
                 more = True
@@ -419,20 +430,16 @@ class BuildConfigController(Component):
                 builds[rev].setdefault('href', req.href.changeset(rev))
                 if build and build.status != Build.PENDING:
                     build_data = _get_build_data(self.env, req, build)
-                    build_data['steps'] = []
-                    for step in BuildStep.select(self.env, build=build.id,
-                                                 db=db):
-                        build_data['steps'].append({
-                            'name': step.name,
-                            'description': step.description,
-                            'duration': to_datetime(step.stopped, utc) - \
-                                        to_datetime(step.started, utc),
-                            'failed': not step.successful,
-                            'errors': step.errors,
-                            'href': build_data['href'] + '#step_' + step.name
-                        })
                     builds[rev][platform.id] = build_data
+                    page_builds.append((build, build_data))
             idx += 1
+
+        # Load the steps of all builds on the page at once
+        build_steps = BuildStep.select_for_builds(self.env,
+                                [build.id for build, _ in page_builds], db=db)
+        for build, build_data in page_builds:
+            build_data['steps'] = _get_steps_data(build_data,
+                                                  build_steps[build.id])
         data['config']['builds'] = builds
 
         if page > 1:
@@ -524,11 +531,30 @@ class BuildController(Component):
                 'name': step.name, 'description': step.description,
                 'duration': pretty_timedelta(step.started, step.stopped),
                 'failed': step.status == BuildStep.FAILURE,
+                'running': False,
                 'errors': step.errors,
                 'log': self._render_log(req, build, formatters, step),
                 'reports': self._render_reports(req, config, build, summarizers,
                                                 step)
             })
+        if build.status == Build.IN_PROGRESS:
+            # Steps that are still being executed only have the log output
+            # that the slave has sent so far
+            completed = [step['name'] for step in steps]
+            logged = [log.step for log in BuildLog.select(self.env,
+                      build=build.id, db=db, lazy=True)]
+            for recipe_step in Recipe(xmlio.parse(config.recipe)):
+                if recipe_step.id in completed or recipe_step.id not in logged:
+                    continue
+                step = BuildStep(self.env, build=build.id, name=recipe_step.id,
+                                 description=recipe_step.description)
+                steps.append({
+                    'name': step.name, 'description': step.description,
+                    'duration': 'in progress', 'failed': False,
+                    'running': True, 'errors': [],
+                    'log': self._render_log(req, build, formatters, step),
+                    'reports': []
+                })
         data['build']['steps'] = steps
         data['build']['can_delete'] = ('BUILD_DELETE' in req.perm \
                                    and build.status != build.PENDING)
@@ -641,8 +667,11 @@ class BuildController(Component):
     def _do_invalidate(self, req, build, db):
         self.log.info('Invalidating build %d', build.id)
 
-        for step in BuildStep.select(self.env, build=build.id, db=db):
+        for step in list(BuildStep.select(self.env, build=build.id, db=db)):
             step.delete(db=db)
+        for log in list(BuildLog.select(self.env, build=build.id, db=db,
+                                        lazy=True)):
+            log.delete(db=db)
 
         build.slave = None
         build.started = build.stopped = 0
@@ -665,7 +694,8 @@ class BuildController(Component):
 
     def _render_reports(self, req, config, build, summarizers, step):
         reports = []
-        for report in Report.select(self.env, build=build.id, step=step.name):
+        for report in Report.select(self.env, build=build.id, step=step.name,
+                                    lazy=True):
             summarizer = summarizers.get(report.category)
             if summarizer:
                 tmpl, data = summarizer.render_summary(req, config, build,
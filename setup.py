@@ -138,6 +138,7 @@ setup(
                   "bitten.recipe",
                   "bitten.slave",
                   "bitten.util.__init__",
+                  "bitten.util.compress",
                   "bitten.util.loc",
                   "bitten.util.testrunner",
                   "bitten.util.xmlio",